@@ -0,0 +1,59 @@
+"""
+Compares the codecs of the mappers on encode/decode throughput and the size of the stored values.
+
+    PYTHONPATH=. python tests/bench_tfci/bench_codec.py 100000
+"""
+import sys
+import time
+from uuid import uuid4
+
+from tfci.db.codec import codec_set
+from tfci.dsm.struct import StackFrame, ThreadContext
+
+
+def generate_values():
+    sp = [uuid4().hex for _ in range(5)]
+
+    return [
+        ('ThreadContext', ThreadContext('t1', 'ep_2_plus_2:entry', sp, 1)),
+        ('ThreadContext (offset)', ThreadContext('t1', 12, sp, 1)),
+        ('StackFrame (small)', StackFrame('sf1', {'x': 1, '_ret': 'ret_fn', 'req_id': uuid4().hex}, 1, False)),
+        ('StackFrame (large)', StackFrame('sf1', {
+            f'var_{i}': [i, f'value {i}', {'nested': i * 0.5, 'flag': i % 2 == 0}] for i in range(50)
+        }, 1, False)),
+    ]
+
+
+def bench(x, n):
+    t = time.perf_counter()
+
+    for _ in range(n):
+        bts = x.serialize()
+
+    a = time.perf_counter() - t
+
+    if isinstance(bts, str):
+        bts = bts.encode()
+
+    t = time.perf_counter()
+
+    for _ in range(n):
+        x.deserialize(x.id, 1, bts)
+
+    b = time.perf_counter() - t
+
+    return a, b, len(bts)
+
+
+def main(n):
+    for name, x in generate_values():
+        for codec in ['json', 'binary']:
+            codec_set(codec)
+
+            a, b, size = bench(x, n)
+
+            print(f'{name:<24} {codec:<8} encode {a / n * 1e6:6.2f}us decode {b / n * 1e6:6.2f}us {size:6d} bytes')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
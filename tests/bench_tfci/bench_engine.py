@@ -0,0 +1,90 @@
+"""
+Runs a counting loop on the execution engine backed by the in-memory and the SQLite stores and reports the instructions
+per second.
+
+    PYTHONPATH=. python tests/bench_tfci/bench_engine.py 10000
+"""
+import os
+import sys
+import tempfile
+import time
+
+import tfci_core.opcodes
+import tfci_std.opcodes
+from tfci.db.db_util import Lease
+from tfci.db.mem import MemoryEtcd3Client
+from tfci.db.sqlite import SQLiteEtcd3Client
+from tfci.dsm.rt import ProgramPages
+from tfci.dsm.struct import StackFrame, ThreadContext
+from tfci.opcode import OpcodeDef
+from tfci_core.daemons.worker.worker import ExecutionEngine
+
+PROGRAM = '''
+loop:
+    ld i=%0
+loop_body: exr "x[0] + 1" i i
+    jne i n @loop_body
+    hlt
+'''
+
+
+class BenchProgramPages(ProgramPages):
+    def source(self):
+        return 'bench_engine.txt', PROGRAM
+
+
+def load_opcodes(*mods):
+    return {o.name: o() for mod in mods for o in OpcodeDef.find_module(mod)}
+
+
+def bench(db, n, max_steps):
+    opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+    eng = ExecutionEngine(
+        'bench',
+        Lease(db.lease(60).id),
+        opcodes,
+        BenchProgramPages(db, opcodes),
+        db,
+        max_steps,
+    )
+
+    sf = StackFrame.new('sf1', {'n': n})
+    thread = ThreadContext.new('t1', 'loop', [sf.id])
+
+    ok, _, _ = sf.create().merge(thread.create()).exec(db)
+    assert ok
+
+    steps = 0
+    t = time.perf_counter()
+
+    while thread is not None:
+        ok, thread = eng.step(thread)
+        assert ok
+        steps += 1
+
+    t = time.perf_counter() - t
+
+    ok, (sf,), _ = StackFrame.load_exists('sf1').exec(db)
+    assert sf.vals['i'] == n
+
+    # one `ld`, `n` times `exr` and `jne`, one `hlt`
+    return 2 * n + 2, steps, t
+
+
+def main(n):
+    with tempfile.TemporaryDirectory() as dir:
+        for max_steps in [1, 64]:
+            for name, db in [
+                ('memory', MemoryEtcd3Client()),
+                ('sqlite', SQLiteEtcd3Client(os.path.join(dir, f'bench_{max_steps}.sqlite'))),
+            ]:
+                with db:
+                    instructions, steps, t = bench(db, n, max_steps)
+
+                print(f'{name:<6} max_steps={max_steps:<3d} {instructions / t:10.0f} instructions/s '
+                      f'{steps / t:10.0f} steps/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,69 @@
+"""
+Measures the overhead of dispatching an instruction to an opcode, with the arguments bound when the program is loaded
+and with the arguments bound on every execution.
+
+    PYTHONPATH=. python tests/bench_tfci/bench_opcode.py 100000
+"""
+import sys
+import time
+
+import tfci_core.opcodes
+from tfci.dsl.ast import Constant, ConstantType, Identifier, Location, Map
+from tfci.dsm.executor import ExecutionContext
+from tfci.dsm.struct import StackFrame, ThreadContext
+from tfci.opcode import OpcodeDef, OpArg, RefOpArg
+
+LOC = Location(0)
+
+
+class AddOpcode(OpcodeDef):
+    name = 'add'
+
+    def fn(self, ctx: ExecutionContext, ret: RefOpArg[int], a: OpArg[int], b: OpArg[int], c: OpArg[int] = None):
+        ret.set(a.get(ctx) + b.get(ctx) + (0 if c is None else c.get(ctx)), ctx)
+
+
+def bench(opcode, args, n):
+    stack = [StackFrame.new('sf1', {'a': 1, 'c': 3, 'ret': 0})]
+    thread = ThreadContext.new('t1', 0, ['sf1'])
+
+    r = {}
+
+    for name, bound in [('per-step', None), ('load-time', opcode.bind(args))]:
+        t = time.perf_counter()
+
+        for _ in range(n):
+            opcode(ExecutionContext.new(None, args, 1, thread, stack, None, bound))
+
+        r[name] = time.perf_counter() - t
+
+    return r
+
+
+def main(n):
+    add_args = [
+        Identifier(0, 'ret', LOC),
+        Identifier(0, 'a', LOC),
+        Constant(ConstantType.Integer, 2, LOC),
+        Map(Identifier(0, 'c', LOC), Identifier(0, 'c', LOC), LOC),
+    ]
+
+    je_args = [
+        Identifier(0, 'a', LOC),
+        Constant(ConstantType.Integer, 2, LOC),
+        Constant(ConstantType.Address, 0, LOC),
+    ]
+
+    for name, opcode, args in [
+        ('add (OpcodeDef)', AddOpcode(), add_args),
+        ('je (SysOpcodeDef)', tfci_core.opcodes.JEOpcode(), je_args),
+    ]:
+        r = bench(opcode, args, n)
+
+        a, b = r['per-step'], r['load-time']
+
+        print(f'{name:<20} per-step {a / n * 1e6:6.2f}us load-time {b / n * 1e6:6.2f}us x{a / b:.2f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
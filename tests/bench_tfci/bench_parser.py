@@ -0,0 +1,52 @@
+"""
+Compares the pyparsing grammar against the hand-written scanner on generated programs.
+
+    PYTHONPATH=. python tests/bench_tfci/bench_parser.py 10000 100000
+"""
+import random
+import sys
+import time
+
+from tfci.dsl.compiler import compiler_first_pass, Parser
+
+LINES = [
+    'ld i=%{i} l=%{n}',
+    'label_{i}: ld x=^y z="string {i}"',
+    'je i l @label_{i}',
+    'jne a b @label_{i}',
+    'exr ^^r "return x + 1" x',
+    'j @{i}.proc:entry  # jump elsewhere',
+    '    # comment {i}',
+    '',
+]
+
+
+def generate_program(n, seed=0) -> str:
+    rnd = random.Random(seed)
+    return '\n'.join(rnd.choice(LINES).format(i=i, n=n) for i in range(n)) + '\n'
+
+
+def bench(text, parser, repeat=3):
+    r = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        compiler_first_pass(text, parser)
+        t = time.perf_counter() - t
+        r = t if r is None else min(r, t)
+    return r
+
+
+def main(sizes):
+    for n in sizes:
+        text = generate_program(n)
+
+        assert compiler_first_pass(text, Parser.PyParsing) == compiler_first_pass(text, Parser.Scanner)
+
+        a = bench(text, Parser.PyParsing)
+        b = bench(text, Parser.Scanner)
+
+        print(f'{n:>8d} lines: pyparsing {a:8.3f}s scanner {b:8.3f}s x{a / b:.1f}')
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10000, 50000, 100000])
@@ -0,0 +1,52 @@
+"""
+Keeps the processes of a pool busy with tasks that return the thread they are given and reports the round trip
+overhead per task, for the pickled and the thread specific wire formats.
+
+    PYTHONPATH=. python tests/bench_tfci/bench_pool.py 5000 [window]
+"""
+import sys
+import time
+
+from tfci.dsm.struct import ThreadContext
+from tfci_core.daemons.generic.pool import TaskProcessPool, WorkerInstance, PICKLE
+from tfci_core.daemons.worker.wire import THREAD_TASKS
+
+
+class EchoInstance(WorkerInstance):
+    def __call__(self, task_id, payload):
+        return True, payload
+
+
+def bench(parallel, window, codec, n):
+    pool = TaskProcessPool(parallel, EchoInstance, (), window, preload=[], codec=codec)
+
+    threads = [ThreadContext(f'{i:032x}', 'ep:entrypoint', [f'{i:032x}', f'{i + 1:032x}'], i) for i in range(n)]
+
+    try:
+        done = 0
+        t = time.perf_counter()
+
+        while done < n:
+            while pool.available and len(threads):
+                x = threads.pop()
+                pool.assign(x.id, x)
+
+            for _, ok, _ in pool.poll_many(5):
+                assert ok
+                done += 1
+
+        return time.perf_counter() - t
+    finally:
+        pool.close()
+
+
+def main(n, window):
+    for parallel in [1, 2, 4, 8, 16, 32]:
+        for name, codec in [('pickle', PICKLE), ('thread', THREAD_TASKS)]:
+            t = bench(parallel, window, codec, n)
+
+            print(f'-P {parallel:<3d} --window {window:<3d} {name:<6} {t / n * 1e6:8.1f} us/task {n / t:10.0f} tasks/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import tfci.dsl.compiler
+import tfci_core.opcodes
+import tfci_std.opcodes
+from test_tfci.compiler.test_compiler import load_opcodes
+from tfci.dsl.cache import ProgramCache
+from tfci.dsl.compiler import compiler_compile_bytecode
+
+TEXT = """entry:
+    exr "x[0] + x[1]" x %2
+    je x %4 @end
+    j @entry
+end: hlt
+"""
+
+
+class TestProgramCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hit(self):
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        a = ProgramCache(self.path).compile('<inmem>', TEXT, opcodes)
+
+        cache = ProgramCache(self.path)
+        b = cache.compile('<inmem>', TEXT, opcodes)
+
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(a, b)
+        self.assertEqual(b, compiler_compile_bytecode('<inmem>', TEXT, opcodes))
+
+    def test_key(self):
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        key = ProgramCache.key(TEXT, opcodes)
+
+        self.assertNotEqual(key, ProgramCache.key(TEXT + '\n', opcodes))
+        self.assertNotEqual(key, ProgramCache.key(TEXT, load_opcodes(tfci_core.opcodes)))
+
+        with patch('tfci.dsl.compiler.COMPILER_VERSION', tfci.dsl.compiler.COMPILER_VERSION + 1):
+            self.assertNotEqual(key, ProgramCache.key(TEXT, opcodes))
+
+    def test_corrupted(self):
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        cache = ProgramCache(self.path)
+        cache.compile('<inmem>', TEXT, opcodes)
+
+        with open(cache.key_path(cache.key(TEXT, opcodes)), 'wb') as f_out:
+            f_out.write(b'garbage')
+
+        x = cache.compile('<inmem>', TEXT, opcodes)
+
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(x, compiler_compile_bytecode('<inmem>', TEXT, opcodes))
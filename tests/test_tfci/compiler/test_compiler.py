@@ -4,7 +4,7 @@ import unittest
 from typing import Tuple
 
 import tfci_core.opcodes
-from tfci.dsl.compiler import compiler_compile_text
+from tfci.dsl.compiler import compiler_compile_text, compiler_bytecode_pass, compiler_compile_bytecode
 from tfci.dsl.exception import CompilerException
 from tfci.dsl.struct import ProgramDefinition
 from tfci.opcode import OpcodeDef
@@ -55,3 +55,90 @@ class TestCompiler(unittest.TestCase):
             self.assertEqual(e.col, 10)
 
 
+class TestBytecode(unittest.TestCase):
+    TEXT = """entry:
+    ld i=%0
+loop:
+    je i %3 @end
+    j @loop
+end: hlt
+"""
+
+    def test_bytecode(self):
+        x = compiler_bytecode_pass(compiler_compile_text('<inmem>', self.TEXT, load_opcodes(tfci_core.opcodes)))
+
+        self.assertEqual(list(x.labels.keys())[:2], ['entry', '$1'])
+        self.assertEqual(x.resolve('loop'), 2)
+        self.assertEqual(x.resolve(2), 2)
+        self.assertEqual(x.resolve(len(x.items)), None)
+        self.assertEqual(x.resolve('missing'), None)
+
+        je = x.items[x.labels['$3']]
+
+        self.assertEqual(x.opcodes[je.opcode], 'je')
+        self.assertEqual(je.next_ip, x.labels['$4'])
+        self.assertEqual(je.args[2].value, x.labels['end'])
+
+        j = x.items[x.labels['$4']]
+
+        self.assertEqual(j.args[0].value, x.labels['loop'])
+        self.assertEqual(x.items[x.labels['entry']].opcode, x.items[x.labels['loop']].opcode)
+        self.assertIsNone(x.items[-1].next_ip)
+
+    def test_levels(self):
+        x = compiler_bytecode_pass(compiler_compile_text('<inmem>', self.TEXT, load_opcodes(tfci_core.opcodes)))
+
+        self.assertEqual([y.levels for y in x.items], [0, 1, 0, 1, 0, 0, 0])
+
+        x = compiler_bytecode_pass(
+            compiler_compile_text('<inmem>', 'ld ^^a=%1 b=^c\npush ^^^^d\n', load_opcodes(tfci_core.opcodes))
+        )
+
+        self.assertEqual([y.levels for y in x.items[:2]], [3, 5])
+
+
+class TestOptimizer(unittest.TestCase):
+    TEXT = """entry:
+    ld i=%0
+loop:
+    je i %3 @end
+    j @next
+next:
+    j @loop
+    ld dead=%1
+end:
+    jne "a" "a" @entry
+    je %1 %1 @out
+    ld dead=%2
+out: hlt
+spin: j @spin
+"""
+
+    def test_optimize(self):
+        x = compiler_compile_bytecode('<inmem>', self.TEXT, load_opcodes(tfci_core.opcodes), optimize=True)
+
+        self.assertEqual([x.opcodes[y.opcode] for y in x.items], ['ld', 'je', 'hlt', 'j'])
+
+        self.assertEqual(x.resolve('entry'), 0)
+        self.assertEqual(x.resolve('loop'), 1)
+        self.assertEqual(x.resolve('next'), 1)
+        self.assertEqual(x.resolve('end'), 2)
+        self.assertEqual(x.resolve('out'), 2)
+        self.assertEqual(x.resolve('spin'), 3)
+
+        self.assertEqual(x.items[0].next_ip, 1)
+
+        je = x.items[1]
+
+        self.assertEqual(je.next_ip, 1)
+        self.assertEqual(je.args[2].value, 2)
+
+        self.assertEqual(x.items[3].args[0].value, 3)
+
+    def test_disabled(self):
+        opcodes = load_opcodes(tfci_core.opcodes)
+
+        self.assertEqual(
+            compiler_compile_bytecode('<inmem>', self.TEXT, opcodes),
+            compiler_bytecode_pass(compiler_compile_text('<inmem>', self.TEXT, opcodes)),
+        )
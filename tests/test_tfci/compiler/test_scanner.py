@@ -0,0 +1,68 @@
+import glob
+import os
+import random
+import unittest
+
+import pyparsing
+
+from tfci.dsl.compiler import compiler_first_pass, Parser
+from tfci.dsl.exception import CompilerException
+
+TESTS_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+TOKENS = [
+    'ld', 'J', 'jne', 'label_1', 'a.b-c', '9', 'x:', 'x :', '^', '^^', '^ ^', '=', ' = ', '@', '@ ', 'a:b/c', '%',
+    '% ', '%12', '%-3', '"str"', '"a""b"', '"a\\"b"', '"\\x1f"', "'s'", "''", '"', "'", '#', '# comment', ' ', '  ',
+    '\t', ' \t ', '\n', '\n', '\n', '\r', '!', ',', '$',
+]
+
+PARSERS_AGREE = pyparsing.__version__.startswith('2.')
+
+
+def generate_text(rnd: random.Random, n):
+    return ''.join(rnd.choice(TOKENS) for _ in range(n))
+
+
+def first_pass(text, parser):
+    try:
+        return compiler_first_pass(text, parser)
+    except CompilerException as e:
+        return e.loc
+    except ValueError:
+        return ValueError
+
+
+@unittest.skipUnless(PARSERS_AGREE, 'The reference grammar relies on the whitespace semantics of pyparsing 2')
+class TestScanner(unittest.TestCase):
+    def assertSameParse(self, text):
+        a = first_pass(text, Parser.PyParsing)
+        b = first_pass(text, Parser.Scanner)
+
+        if a is ValueError:
+            # pyparsing lets the conversion error of an integer constant escape, the scanner reports it
+            self.assertIsInstance(b, int, repr(text))
+        else:
+            self.assertEqual(a, b, repr(text))
+
+    def test_programs(self):
+        filenames = glob.glob(os.path.join(TESTS_DIR, '**', '*.txt'), recursive=True)
+
+        self.assertTrue(filenames)
+
+        for filename in filenames:
+            with open(filename) as f_in:
+                self.assertSameParse(f_in.read())
+
+    def test_edge_cases(self):
+        for text in [
+            '', '\n', '  \n', 'a', 'a\n', 'a:', 'a: \n', 'a: b', 'a:\tb c\td', 'a:b:c', 'a: # c', '# c\n#',
+            'ld x\n  \n', 'ld  ^ ^x =  ^y', 'ld x=', 'ld x= y', 'ld x="a', 'ld "a""', "ld 'a''b'", 'ld x,y',
+            'exr "\t"', '\tj @ a:b/c', 'hlt #', 'a\rb',
+        ]:
+            self.assertSameParse(text)
+
+    def test_random(self):
+        rnd = random.Random(0)
+
+        for i in range(3000):
+            self.assertSameParse(generate_text(rnd, rnd.randint(1, 40)))
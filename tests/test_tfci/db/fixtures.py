@@ -5,6 +5,7 @@ import tempfile
 import time
 import unittest
 from typing import Any
+from uuid import uuid4
 
 from etcd3.exceptions import ConnectionFailedError
 
@@ -12,6 +13,7 @@ from tfci.dsm.executor import ExecutionContext
 from tfci.opcode import OpcodeDef, OpArg
 from tfci.settings import Settings
 from tfci.db.db_util import Lease
+from tfci.db.mem import MemoryEtcd3Client
 
 
 def callback_fixture(opcode, callback):
@@ -28,7 +30,7 @@ def callback_fixture(opcode, callback):
             super().__init__()
 
         def fn(self, ctx: ExecutionContext, *args: OpArg[Any], **kwargs: OpArg[Any]):
-            self.callback(*(x.get() for x in args), **{k: v.get() for k, v in kwargs.items()})
+            self.callback(*(x.get(ctx) for x in args), **{k: v.get(ctx) for k, v in kwargs.items()})
 
     return CallbackFixture(callback)
 
@@ -88,3 +90,31 @@ class Etcd3ServerFixture(unittest.TestCase):
     def tearDownClass(cls):
         cls.etcd3_serv.terminate()
         shutil.rmtree(cls.etcd3_dir)
+
+
+class MemoryServerFixture(unittest.TestCase):
+    """
+    Same as `Etcd3ServerFixture`, but every test gets a fresh in-process store instead of an etcd server.
+    """
+
+    plugins = []
+
+    def setUp(self):
+        self.mem_name = uuid4().hex
+
+    def _settings(self):
+        return Settings(
+            self.plugins,
+            [
+                {
+                    'mem': self.mem_name,
+                }
+            ]
+        )
+
+    def _db_lease(self):
+        db = self._settings().get_db()
+        return db, Lease(db.lease(20).id)
+
+    def tearDown(self):
+        MemoryEtcd3Client.clients.pop(self.mem_name, None)
@@ -0,0 +1,74 @@
+import json
+import unittest
+
+from tfci.db import codec
+from tfci.db.codec import BINARY, THREAD, codec_decode, codec_set
+from tfci.dsl.struct import ProgramOffset
+from tfci.dsm.struct import StackFrame, StackVars, ThreadContext
+from tfci_std.struct import FrozenThreadContext
+
+VALUES = [
+    None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 2 ** 100, 1.5, '', 'ü' * 300, [], list(range(300)),
+    {'a': [1, {'b': None}], 'c': 'd'}, {str(i): i for i in range(300)},
+]
+
+
+class TestCodec(unittest.TestCase):
+    def tearDown(self):
+        codec_set('json')
+
+    def test_binary(self):
+        for x in VALUES:
+            bts = BINARY.encode(x)
+
+            self.assertEqual(bts[0], BINARY.tag)
+            self.assertEqual(codec_decode(bts), x, repr(x))
+
+        self.assertEqual(codec_decode(BINARY.encode((1, 2))), [1, 2])
+        self.assertEqual(codec_decode(BINARY.encode(StackVars({'a': 1}))), {'a': 1})
+
+        with self.assertRaises(TypeError):
+            BINARY.encode({1: 2})
+
+        with self.assertRaises(ValueError):
+            BINARY.decode(BINARY.encode(1) + b'\x00')
+
+    def test_thread(self):
+        for x in [[0, []], [-5, ['a']], ['/sys/eg:entrypoint', [f'{i:032x}' for i in range(50)]], ['', ['', 'ü']]]:
+            self.assertEqual(codec_decode(THREAD.encode(x)), x)
+
+        for ip in [ProgramOffset('d1', 3, 'ep'), ProgramOffset('', -1, None)]:
+            ip2, sp = codec_decode(THREAD.encode([ip, ['sf1']]))
+
+            self.assertEqual((type(ip2), ip2, sp), (ProgramOffset, ip, ['sf1']))
+
+    def test_legacy(self):
+        for x in VALUES[:-1]:
+            self.assertEqual(codec_decode(json.dumps(x).encode()), x)
+
+    def test_set(self):
+        with self.assertRaises(KeyError):
+            codec_set('thread')
+
+        codec_set('binary')
+
+        self.assertIs(codec.codec_get(), BINARY)
+
+    def test_mappers(self):
+        t = ThreadContext('t1', 'ep:entry', ['sf1', 'sf2'], 1)
+        t2 = ThreadContext('t2', ProgramOffset('d1', 3, 'ep'), ['sf1'], 1)
+        sf = StackFrame('sf1', {'x': [1, 2]}, 1, False)
+        frz = FrozenThreadContext('t1', t, 1)
+        frz2 = FrozenThreadContext('t2', t2, 1)
+
+        legacy = [(x, x.serialize()) for x in [t, t2, sf, frz, frz2]]
+
+        codec_set('binary')
+
+        self.assertEqual(t.serialize()[0], THREAD.tag)
+        self.assertEqual(sf.serialize()[0], BINARY.tag)
+
+        for x, bts in legacy + [(x, x.serialize()) for x in [t, t2, sf, frz, frz2]]:
+            if isinstance(bts, str):
+                bts = bts.encode()
+            self.assertEqual(x.deserialize(x.id, 1, bts), x)
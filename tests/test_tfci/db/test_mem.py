@@ -0,0 +1,142 @@
+import unittest
+
+from etcd3.events import DeleteEvent, PutEvent
+from etcd3.exceptions import PreconditionFailedError
+
+from tfci.db.db_util import watch_range_single, Ev
+from tfci.db.mem import MemoryEtcd3Client
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestMemoryEtcd3Client(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.db = MemoryEtcd3Client(clock=self.clock)
+
+    def test_transaction(self):
+        db = self.db
+        tx = db.transactions
+
+        ok, _ = db.transaction(compare=[tx.version('/a') == 0], success=[tx.put('/a', '1'), tx.put('/b', '2')])
+
+        self.assertTrue(ok)
+
+        ok, (r,) = db.transaction(compare=[tx.version('/a') == 0], success=[], failure=[tx.get('/a')])
+
+        self.assertFalse(ok)
+        self.assertEqual([(v, m.version) for v, m in r], [(b'1', 1)])
+
+        # a value compare on a missing key never succeeds
+        ok, _ = db.transaction(compare=[tx.value('/c') != '1'], success=[])
+
+        self.assertFalse(ok)
+
+        ok, (r, _) = db.transaction(compare=[tx.value('/a') == '1'], success=[tx.get('/', '/c'), tx.delete('/a')])
+
+        self.assertTrue(ok)
+        self.assertEqual([v for v, _ in r], [b'1', b'2'])
+        self.assertEqual(db.get('/a'), (None, None))
+
+        with self.assertRaises(PreconditionFailedError):
+            db.transaction(compare=[], success=[tx.put('/b', '3'), tx.delete('/b')])
+
+        self.assertEqual(db.get('/b')[0], b'2')
+
+    def test_transaction_atomic(self):
+        db = self.db
+        tx = db.transactions
+
+        events = []
+        rev = db.revision
+
+        w = db.add_watch_prefix_callback('/', events.append)
+
+        # the lease of the second put does not exist, the first one must not be applied either
+        with self.assertRaises(PreconditionFailedError):
+            db.transaction(compare=[], success=[tx.put('/a', '1'), tx.put('/b', '2', lease=999)])
+
+        self.assertEqual(db.get('/a'), (None, None))
+        self.assertEqual(db.revision, rev)
+        self.assertEqual(events, [])
+
+        db.cancel_watch(w)
+
+    def test_range(self):
+        db = self.db
+
+        for x in ['/b/2', '/a', '/b/1', '/c', '/b/3']:
+            db.put(x, x)
+
+        db.put('/b/1', 'again')
+        db.delete('/b/3')
+
+        self.assertEqual([m.key for _, m in db.get_prefix('/b/')], [b'/b/1', b'/b/2'])
+        self.assertEqual([m.key for _, m in db.get_range('/a', '/c')], [b'/a', b'/b/1', b'/b/2'])
+        self.assertEqual([m.key for _, m in db.get_range('/c', '/a')], [])
+        self.assertEqual([v for v, _ in db.get_all()], [b'/a', b'again', b'/b/2', b'/c'])
+
+        db.delete_prefix('/')
+
+        self.assertEqual(list(db.get_all()), [])
+
+    def test_watch(self):
+        db = self.db
+
+        db.put('/x/1', 'a')
+        rev = db.revision
+
+        db.put('/x/2', 'b')
+        db.put('/y/1', 'c')
+        db.delete('/x/1')
+
+        events = []
+
+        w = db.add_watch_prefix_callback('/x/', events.append, start_revision=rev)
+
+        self.assertEqual([(isinstance(x, PutEvent), isinstance(x, DeleteEvent), x.key) for x in events],
+                         [(True, False, b'/x/1'), (True, False, b'/x/2'), (False, True, b'/x/1')])
+
+        db.cancel_watch(w)
+        db.put('/x/3', 'd')
+
+        self.assertEqual(len(events), 3)
+
+        token = watch_range_single(db, '/x/')
+
+        db.put('/x/4', 'e')
+
+        ev = token.get()
+
+        self.assertEqual((ev.ident, ev.event, ev.body), ('4', Ev.Put, b'e'))
+
+    def test_lease(self):
+        db = self.db
+
+        lease = db.lease(10)
+
+        db.put('/a', '1', lease=lease)
+        db.put('/b', '2')
+
+        self.clock.now = 8.
+        list(db.refresh_lease(lease.id))
+
+        self.clock.now = 15.
+
+        self.assertEqual(db.get('/a')[0], b'1')
+        self.assertEqual(db.get_lease_info(lease.id).TTL, 3)
+
+        self.clock.now = 18.
+
+        self.assertEqual(db.get('/a'), (None, None))
+        self.assertEqual(db.get('/b')[0], b'2')
+        self.assertEqual(db.get_lease_info(lease.id).TTL, -1)
+
+        with self.assertRaises(PreconditionFailedError):
+            db.put('/c', '3', lease=lease)
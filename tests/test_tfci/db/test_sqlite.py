@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+
+from tfci.db.sqlite import SQLiteEtcd3Client
+from test_tfci.db import test_mem
+
+
+class TestSQLiteEtcd3Client(test_mem.TestMemoryEtcd3Client):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db.sqlite')
+        self.clock = test_mem.Clock()
+        self.db = SQLiteEtcd3Client(self.path, clock=self.clock)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_durable(self):
+        tx = self.db.transactions
+
+        lease = self.db.lease(10)
+
+        ok, _ = self.db.transaction(compare=[], success=[tx.put('/a', '1'), tx.put('/b', '2', lease=lease)])
+
+        self.assertTrue(ok)
+
+        rev = self.db.revision
+
+        self.db.close()
+
+        self.clock.now = 20.
+        self.db = SQLiteEtcd3Client(self.path, clock=self.clock)
+
+        self.assertEqual(self.db.get('/a')[1].mod_revision, rev)
+        self.assertEqual(self.db.get('/b'), (None, None))
+
+        ok, _ = self.db.transaction(compare=[tx.version('/a') == 1], success=[tx.put('/a', '3')])
+
+        self.assertTrue(ok)
+
+    def test_shared(self):
+        other = SQLiteEtcd3Client(self.path, poll=0.01, clock=self.clock)
+
+        try:
+            events = []
+
+            other.add_watch_prefix_callback('/x/', events.append)
+
+            self.db.put('/x/1', 'a')
+
+            self.assertEqual(other.get('/x/1')[0], b'a')
+
+            for _ in range(100):
+                if len(events):
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual([x.key for x in events], [b'/x/1'])
+        finally:
+            other.close()
@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import tfci_core.opcodes
+import tfci_std.opcodes
+from test_tfci.compiler.test_compiler import load_opcodes
+from test_tfci.db.fixtures import MemoryServerFixture
+from test_tfci_core.test_execution_engine import TestProgramPages, TEST_IDENT
+from tfci.db.ops import Transaction
+from tfci.dsm.executor import ExecutionContext
+from tfci.dsm.struct import StackFrame, ThreadContext
+from tfci.opcode import OpcodeDef, RefOpArg, OpArg
+from tfci_core.daemons.worker.aio import AsyncExecutionEngine, AsyncTaskPool
+from tfci_core.daemons.worker.worker import ExecutionEngine
+
+
+class AsyncAddOpcode(OpcodeDef):
+    name = 'test_async_add'
+
+    async def fn(self, ctx: ExecutionContext, ret: RefOpArg[Any], x: OpArg[Any]):
+        await asyncio.sleep(0.2)
+        ret.set(ret.get(ctx) + x.get(ctx), ctx)
+
+
+class TestAsyncExecutionEngine(MemoryServerFixture):
+    def _engine(self, cls=AsyncExecutionEngine, **kwargs):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        opcodes[AsyncAddOpcode.name] = AsyncAddOpcode()
+
+        return db, cls(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_async.txt', db, opcodes),
+            db,
+            **kwargs
+        )
+
+    def _threads(self, db, n):
+        sfs = [StackFrame.new(f'sf{i}', {'x': i}) for i in range(n)]
+        ts = [ThreadContext.new(f't{i}', 'ep_async', [x.id]) for i, x in enumerate(sfs)]
+
+        tx = Transaction.new()
+
+        for x in sfs + ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        return ts
+
+    def _check(self, db, n):
+        for i in range(n):
+            ok, (sf,), _ = StackFrame.load_exists(f'sf{i}').exec(db)
+
+            self.assertEqual(sf.vals['x'], i + 1, "Return value must be equal")
+
+    def test_step_async(self):
+        db, eng = self._engine()
+        ts = self._threads(db, 20)
+
+        async def steps(threads):
+            return await asyncio.gather(*[eng.step_async(x) for x in threads])
+
+        loop = asyncio.new_event_loop()
+
+        try:
+            t = time.monotonic()
+
+            r = loop.run_until_complete(steps(ts))
+
+            # the opcode of every thread had been awaited concurrently
+            self.assertLess(time.monotonic() - t, 1.)
+            self.assertTrue(all(ok for ok, _ in r))
+
+            r = loop.run_until_complete(steps([x for _, x in r]))
+
+            self.assertEqual(r, [(True, None)] * 20)
+        finally:
+            loop.close()
+
+        self._check(db, 20)
+
+    def _sleeps(self, db, ts):
+        sfs = [StackFrame.new(f'sf{i}', {'t': x}) for i, x in enumerate(ts)]
+        ts = [ThreadContext.new(f't{i}', 'ep_sleep', [x.id]) for i, x in enumerate(sfs)]
+
+        tx = Transaction.new()
+
+        for x in sfs + ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        return ts
+
+    def test_sleep(self):
+        db, eng = self._engine(executor=ThreadPoolExecutor(4))
+        ts = self._sleeps(db, [0.2] * 20 + ['never'])
+
+        loop = asyncio.new_event_loop()
+        threads = []
+
+        def execute_context(*args):
+            threads.append(threading.current_thread())
+            return ExecutionEngine.execute_context(eng, *args)
+
+        eng.execute_context = execute_context
+
+        async def steps(threads):
+            return await asyncio.gather(*[eng.step_async(x) for x in threads])
+
+        try:
+            t = time.monotonic()
+
+            r = loop.run_until_complete(steps(ts))
+
+            # the opcode of every thread had been awaited concurrently
+            self.assertLess(time.monotonic() - t, 1.)
+        finally:
+            loop.close()
+            eng.executor.shutdown()
+
+        self.assertTrue(all(ok for ok, _ in r[:-1]), "Steps must execute succ")
+        self.assertEqual(r[-1], (False, None), "The thread must fail")
+        self.assertEqual(set(ThreadContext.load_all(db)), {f't{i}' for i in range(20)})
+
+        self.assertEqual(len(threads), 21)
+        # the loop runs on this thread
+        self.assertNotIn(threading.current_thread(), threads, "The frames must not be loaded on the loop")
+
+    def test_sync(self):
+        db, eng = self._engine(ExecutionEngine)
+        ts = self._threads(db, 1)
+
+        ok, upd = eng.step(ts[0])
+
+        self.assertTrue(ok, "Step must execute succ")
+
+        self._check(db, 1)
+
+    def test_pool(self):
+        pool = AsyncTaskPool(8, lambda executor: self._engine(executor=executor)[1])
+
+        try:
+            db = pool.engine.db
+            ts = self._threads(db, 8)
+
+            for x in ts:
+                pool.assign(x.id, x)
+
+            self.assertEqual(pool.available, 0)
+
+            r = []
+
+            while len(r) < 8:
+                r += pool.poll_many(5)
+
+            self.assertEqual(sorted(x for x, _, _ in r), sorted(x.id for x in ts))
+            self.assertTrue(all(ok and step_ok for _, ok, (step_ok, _) in r))
+            self.assertEqual(pool.available, 8)
+        finally:
+            pool.close()
+
+        self._check(db, 8)
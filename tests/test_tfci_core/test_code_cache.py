@@ -0,0 +1,48 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from tfci.dsl.ast import Constant, ConstantType, Identifier, Location
+from tfci_std.opcodes import CodeCache, ExecOpcode
+
+
+class TestCodeCache(unittest.TestCase):
+    def test_lru(self):
+        cache = CodeCache(2)
+
+        a = cache.compile('1 + 1')
+        cache.compile('2 + 2')
+
+        self.assertIs(cache.compile('1 + 1'), a)
+
+        cache.compile('3 + 3')
+
+        self.assertEqual(list(cache.items.keys()), ['1 + 1', '3 + 3'])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        self.assertEqual(eval(a), 2)
+
+    def test_threads(self):
+        cache = CodeCache(4)
+
+        codes = [f'{i % 8} + 1' for i in range(2000)]
+
+        with ThreadPoolExecutor(8) as ex:
+            self.assertEqual(list(ex.map(lambda x: eval(cache.compile(x)), codes)), [i % 8 + 1 for i in range(2000)])
+
+        stats = cache.stats()
+
+        self.assertEqual(stats['hits'] + stats['misses'], len(codes))
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual(len(cache.items), 4)
+
+    def test_prepare(self):
+        op = ExecOpcode()
+
+        loc = Location(0)
+
+        code = op.prepare([Constant(ConstantType.String, 'x[1] + 1', loc), Identifier(0, 'r', loc)])
+
+        self.assertEqual(eval(code, {'x': [None, 2]}), 3)
+
+        self.assertIsNone(op.prepare([Identifier(0, 'code', loc), Identifier(0, 'r', loc)]))
+        self.assertIsNone(op.prepare([Constant(ConstantType.String, 'x[', loc), Identifier(0, 'r', loc)]))
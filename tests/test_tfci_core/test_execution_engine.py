@@ -1,16 +1,28 @@
+import atexit
+import json
 import os
-from typing import Tuple
+import shutil
+import tempfile
+from typing import Tuple, Any
 
 import tfci_core.opcodes
 import tfci_std.opcodes
 from test_tfci.compiler.test_compiler import load_opcodes
-from test_tfci.db.fixtures import Etcd3ServerFixture, callback_fixture
-from tfci.dsl.compiler import compiler_compile_text
-from tfci.dsl.struct import ProgramDefinition
-from tfci.dsm.struct import ThreadContext, StackFrame
-from tfci.dsm.rt import ProgramPages, OpcodeDefinition
+from test_tfci.db.fixtures import MemoryServerFixture, callback_fixture
+from tfci.dsl.cache import ProgramCache
+from tfci.dsl.compiler import compiler_compile_text, Parser
+from tfci.dsl.struct import ProgramDefinition, ProgramOffset
+from tfci.dsm.executor import ExecutionContext
+from tfci.dsm.struct import ThreadContext, StackFrame, FollowUp
+from tfci.dsm.rt import FileProgramPages, OpcodeDefinition
 from tfci.db.ops import Transaction
-from tfci_core.daemons.worker.worker import ExecutionEngine
+from tfci.opcode import OpcodeDef, OpArg
+from tfci.settings import TFException
+from tfci_core.const import JOBS_COMMIT, JOBS_OPCODES
+from tfci_core.daemons.worker.wire import THREAD_TASKS
+from tfci_core.daemons.worker.worker import ExecutionEngine, GroupCommit, ThreadExecutorInstance
+from tfci_core.plugin import CorePlugin
+from tfci_std.plugin import StdPlugin
 
 TEST_IDENT = 'test_ident'
 
@@ -23,20 +35,20 @@ def load_test_program(filename: str, supported_opcodes: OpcodeDefinition) -> Tup
         return filename, text, compiler_compile_text(filename, text, supported_opcodes)
 
 
-class TestProgramPages(ProgramPages):
+# a fresh cache for every run, so that none of the runs sees the programs compiled by another
+TEST_CACHE_DIR = tempfile.mkdtemp(prefix='tfci_test_cache')
+TEST_CACHE = ProgramCache(TEST_CACHE_DIR)
 
-    def __init__(self, filename, db, opcodes: OpcodeDefinition):
-        super().__init__(db, opcodes)
-        self.filename = filename
+atexit.register(shutil.rmtree, TEST_CACHE_DIR, True)
 
-    def __getitem__(self, item):
-        if not self._cache:
-            self.p_filename, self.p_text, self._cache = load_test_program(self.filename, self.opcodes)
 
-        return self._cache[item]
+class TestProgramPages(FileProgramPages):
 
+    def __init__(self, filename, db, opcodes: OpcodeDefinition, cache=TEST_CACHE):
+        super().__init__(os.path.join(os.path.dirname(__file__), filename), db, opcodes, cache)
 
-class TestExecutionEngine(Etcd3ServerFixture):
+
+class TestExecutionEngine(MemoryServerFixture):
     def test_nonexistent_stack_arg(self):
         db, lease = self._db_lease()
         opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
@@ -131,6 +143,155 @@ class TestExecutionEngine(Etcd3ServerFixture):
 
         self.assertFalse(ok, "ThreadContext must not exist")
 
+    def test_ok_delta(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db
+        )
+
+        sf1 = StackFrame.new(
+            'sf1',
+            {'x': 1, 'y': 'unchanged'},
+            delta=True
+        )
+
+        t1 = ThreadContext.new(
+            't1',
+            'ep_2_plus_2',
+            [sf1.id]
+        )
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        _, y_meta = db.get(StackFrame.var_key_fn('sf1', 'y'))
+
+        for i in range(3):
+            ok, upd = eng.step(t1)
+
+            self.assertTrue(ok, f"Step must execute succ {i}")
+
+        ok, (sf,), _ = StackFrame.load_exists('sf1').exec(db)
+
+        self.assertTrue(ok, "StackFrame must exist")
+        self.assertTrue(sf.delta, "StackFrame must keep its layout")
+        self.assertEqual(sf.vals, {'x': 3, 'y': 'unchanged'})
+        self.assertGreater(sf.version, 1, "StackFrame version must be updated")
+
+        _, y_meta_after = db.get(StackFrame.var_key_fn('sf1', 'y'))
+
+        self.assertEqual(y_meta.mod_revision, y_meta_after.mod_revision, "Unchanged variables must not be written")
+
+    def test_ok_batched(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db,
+            max_steps=10
+        )
+
+        sf1 = StackFrame.new(
+            'sf1',
+            {'x': 1}
+        )
+
+        t1 = ThreadContext.new(
+            't1',
+            'ep_2_plus_2',
+            [sf1.id]
+        )
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        ok, upd = eng.step(t1)
+
+        self.assertTrue(ok, "Step must execute succ")
+        self.assertIsNone(upd, "Thread must halt within a single step")
+
+        ok, (sf,), _ = StackFrame.load_exists('sf1').exec(db)
+
+        self.assertTrue(ok, "StackFrame must exist")
+        self.assertEqual(sf.vals['x'], 3, "Return value must be equal")
+
+    def test_nonexistent_stack_arg_batched(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db,
+            max_steps=10
+        )
+
+        sf1 = StackFrame.new(
+            'sf1'
+        )
+
+        t1 = ThreadContext.new(
+            't1',
+            'ep_2_plus_2',
+            [sf1.id]
+        )
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        ok, upd = eng.step(t1)
+
+        self.assertTrue(ok, "Instructions before the failing one must be committed")
+
+        ok, upd = eng.step(upd)
+
+        self.assertFalse(ok, "Failing instruction must be executed on its own")
+
+    def test_lock_levels(self):
+        db, lease = self._db_lease()
+
+        sfs = [StackFrame.new(f'sf{i}', {'i': i}) for i in range(3)]
+
+        t1 = ThreadContext.new(
+            't1',
+            'ep_2_plus_2',
+            [x.id for x in sfs]
+        )
+
+        tx = t1.create()
+
+        for x in sfs:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        ok, thread, stack = t1.lock(db, TEST_IDENT, lease.to_etcd3(), 1)
+
+        self.assertTrue(ok, "Lock must succeed")
+        self.assertEqual(len(stack), 3)
+        self.assertEqual([x.vals['i'] for x in stack.loaded], [0])
+
+        self.assertEqual(stack[-1].vals['i'], 2)
+        self.assertEqual([x.vals['i'] for x in stack.loaded], [0, 2])
+
+        self.assertTrue(t1.unlock(db, TEST_IDENT))
+
     def test_multi_proc(self):
         db, lease = self._db_lease()
 
@@ -183,8 +344,452 @@ class TestExecutionEngine(Etcd3ServerFixture):
 
         self.assertEqual(sorted([y['v'] for _, y in returns]), PAYLOAD)
 
+    def _run_multi_proc(self, cb_fix):
+        db, lease = self._db_lease()
+
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        opcodes[cb_fix.name] = cb_fix
+
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_multi_proc.txt', db, opcodes),
+            db
+        )
+
+        sf1 = StackFrame.new('sf1', {'v': list(range(5)), 'x': 'callback_fn', '_ret': 'ret_fn'})
+        t1 = ThreadContext.new('t1', 'fork_loop', [sf1.id])
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        tcxs = [t1]
+
+        while len(tcxs):
+            for t in tcxs:
+                ok, upd = eng.step(t)
+
+                self.assertTrue(ok, 'Must be OK')
+                tcxs = ThreadContext.load_all(db).values()
+
+    def test_shared_args(self):
+        accessors = []
+        returns = []
+
+        class SharedFixture(OpcodeDef):
+            name = 'callback_fix'
+
+            def fn(self, ctx: ExecutionContext, **kwargs: OpArg[Any]):
+                accessors.append(kwargs['v'])
+                returns.append(kwargs['v'].get(ctx))
+
+        self._run_multi_proc(SharedFixture())
+
+        self.assertEqual(sorted(returns), list(range(5)))
+        # every execution of the instruction is passed the same accessors
+        self.assertEqual(len({id(x) for x in accessors}), 1)
+        self.assertIsNone(accessors[0].ctx)
+
+    def test_bound_args(self):
+        accessors = []
+        returns = []
+
+        class BoundFixture(OpcodeDef):
+            name = 'callback_fix'
+            bind_args = True
+
+            def fn(self, ctx: ExecutionContext, **kwargs: OpArg[Any]):
+                accessors.append(kwargs['v'])
+                returns.append(kwargs['v'].get())
+
+        self._run_multi_proc(BoundFixture())
+
+        self.assertEqual(sorted(returns), list(range(5)))
+        self.assertEqual(len({id(x) for x in accessors}), 5)
+
+    def test_step_many(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db
+        )
+
+        sfs = [StackFrame.new(f'sf{i}', {'x': i}) for i in range(6)]
+        ts = [ThreadContext.new(f't{i}', 'ep_2_plus_2', [x.id]) for i, x in enumerate(sfs)]
+
+        tx = Transaction.new()
+
+        for x in sfs + ts[:-1]:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        # t1 is locked by someone else and t5 does not exist
+        db.put(ts[1].lock_key, 'other')
+
+        locked = ThreadContext.lock_many(db, ts[:3], TEST_IDENT, lease.to_etcd3(), max_ops=8)
+
+        self.assertEqual([(x.id, y.id, [z.id for z in s]) for x, y, s in locked],
+                         [('t0', 't0', ['sf0']), ('t2', 't2', ['sf2'])])
+
+        for x, _, _ in locked:
+            x.unlock(db, TEST_IDENT)
+
+        r = eng.step_many(ts)
+
+        self.assertEqual([x.id for x, _, _ in r], ['t0', 't2', 't3', 't4'])
+
+        while len(r):
+            for x, ok, upd in r:
+                self.assertTrue(ok, f"Step of {x.id} must execute succ")
+
+            r = eng.step_many([upd for _, _, upd in r if upd is not None])
+
+        ok, (sf,), _ = StackFrame.load_exists('sf2').exec(db)
+
+        self.assertEqual(sf.vals['x'], 4, "Return value must be equal")
+
+    def test_follow_many(self):
+        db, lease = self._db_lease()
+
+        ts = [ThreadContext.new(f't{i}', 'ep_2_plus_2', []) for i in range(3)]
+
+        tx = Transaction.new()
+
+        for x in ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        locked = ThreadContext.lock_many(db, ts, TEST_IDENT, lease.to_etcd3())
+
+        self.assertEqual(len(locked), 3)
+
+        # the lock of t1 is lost in the meantime
+        db.put(ts[1].lock_key, 'other')
+
+        r, txs = ThreadContext.follow_many(db, TEST_IDENT, [(x, FollowUp.new()) for x in ts])
+
+        self.assertEqual(r, [(True, None), (False, None), (True, None)])
+        self.assertEqual(txs, 5)
+
+        self.assertEqual(sorted(ThreadContext.load_all(db)), ['t1'])
+
+    def test_step_many_group_commit(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        group_commit = GroupCommit(db, TEST_IDENT, max_size=2, max_delay=60.)
+
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db,
+            group_commit=group_commit
+        )
+
+        sfs = [StackFrame.new(f'sf{i}', {'x': i}) for i in range(5)]
+        ts = [ThreadContext.new(f't{i}', 'ep_2_plus_2', [x.id]) for i, x in enumerate(sfs)]
+
+        tx = Transaction.new()
+
+        for x in sfs + ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        r = eng.step_many(ts)
+
+        while len(r):
+            for x, ok, upd in r:
+                self.assertTrue(ok, f"Step of {x.id} must execute succ")
+
+            r = eng.step_many([upd for _, _, upd in r if upd is not None])
+
+        for i, x in enumerate(sfs):
+            ok, (sf,), _ = StackFrame.load_exists(x.id).exec(db)
+
+            self.assertEqual(sf.vals['x'], i + 2, "Return value must be equal")
+
+        stats = group_commit.stats()
+
+        self.assertEqual(stats['items'], 15)
+        self.assertEqual(stats['batches'], 9)
+        self.assertEqual(stats['transactions'], 9)
+        self.assertEqual(stats['failed'], 0)
+
+    def test_claim(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        def engine(ident, lease):
+            return ExecutionEngine(
+                ident,
+                lease,
+                opcodes,
+                TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+                db,
+                claim=True
+            )
+
+        _, lease_other = self._db_lease()
+
+        eng, eng_same, eng_other = engine(TEST_IDENT, lease), engine(TEST_IDENT, lease), engine('other', lease_other)
+
+        sfs = [StackFrame.new(f'sf{i}', {'x': i}) for i in range(1, 3)]
+        t1, t2 = [ThreadContext.new(f't{i}', 'ep_2_plus_2', [x.id]) for i, x in enumerate(sfs, 1)]
+
+        tx = Transaction.new()
+
+        for x in sfs + [t1, t2]:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        ok, upd = eng.step(t1)
+
+        self.assertTrue(ok, "Step must execute succ I")
+        self.assertEqual(eng.claimed, {'t1'})
+
+        lock, lock_meta = db.get(t1.lock_key)
+
+        self.assertEqual(lock, TEST_IDENT.encode())
+
+        ok, _ = eng_other.step(t1)
+
+        self.assertFalse(ok, "Claimed thread must not be stepped by others")
+
+        # another process of the same daemon
+        ok, upd = eng_same.step(upd)
+
+        self.assertTrue(ok, "Step must execute succ II")
+        self.assertEqual(db.get(t1.lock_key)[1].mod_revision, lock_meta.mod_revision, "Lock must not be rewritten")
+
+        ok, upd = eng.step(upd)
+
+        self.assertTrue(ok, "Step must execute succ III")
+        self.assertIsNone(upd)
+        self.assertEqual(eng.claimed, set())
+        self.assertEqual(db.get(t1.lock_key), (None, None), "Lock must be deleted once the thread halts")
+
+        ok, upd = eng.step(t2)
+
+        self.assertTrue(ok, "Step must execute succ")
+        self.assertTrue(eng.release('t2'))
+        self.assertEqual(db.get(t2.lock_key), (None, None), "Lock must be released")
+
+        ok, upd = eng.step(upd)
+
+        self.assertTrue(ok, "Step must execute succ")
+
+        db.revoke_lease(lease.id)
+
+        self.assertEqual(db.get(t2.lock_key), (None, None), "Lock must be released with the lease")
+
+        ok, upd = eng_other.step(upd)
+
+        self.assertTrue(ok, "Thread must be reclaimed once the lease expires")
+        self.assertIsNone(upd)
+
+        ok, (sf,), _ = StackFrame.load_exists('sf2').exec(db)
+
+        self.assertEqual(sf.vals['x'], 4, "Return value must be equal")
+
+    def test_program_offset(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db
+        )
+
+        sf1 = StackFrame.new('sf1', {'x': [2, 2]})
+        t1 = ThreadContext.new('t1', 'ep_2_plus_2', [sf1.id])
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        ok, upd = eng.step(t1)
+
+        self.assertTrue(ok, "Step must execute succ")
+        self.assertIsInstance(upd.ip, ProgramOffset)
+
+        ok, (upd,), _ = ThreadContext.load('t1').exec(db)
+
+        self.assertIsInstance(upd.ip, ProgramOffset, "Offset must survive the codec")
+
+        pages = eng.pages
+        digest, offset, _ = upd.ip
+        entry = pages.resolve('ep_2_plus_2')
+
+        self.assertEqual(pages.resolve(upd.ip), offset)
+        self.assertEqual(pages.resolve(offset), offset, "Bare offsets are resolved as they are")
+        # the program changed since the offset was taken
+        self.assertEqual(pages.resolve(ProgramOffset('other', offset, 'ep_2_plus_2')), entry)
+        self.assertIsNone(pages.resolve(ProgramOffset('other', offset, None)))
+        self.assertIsNone(pages.resolve(ProgramOffset('other', offset, 'missing')))
+
+    def test_stored_address(self):
+        db, lease = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        eng = ExecutionEngine(
+            TEST_IDENT,
+            lease,
+            opcodes,
+            TestProgramPages('dasm_stored_address.txt', db, opcodes),
+            db
+        )
+
+        sf1 = StackFrame.new('sf1')
+        t1 = ThreadContext.new('t1', 'ep_stored_address', [sf1.id])
+
+        ok, _, _ = sf1.create().merge(t1.create()).exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        labels = []
+        upd = t1
+
+        while upd is not None:
+            # as sent to a process of the pool and back
+            (_, upd), = THREAD_TASKS.decode_tasks(THREAD_TASKS.encode_tasks([(upd.id, upd)]))
+            (_, _, (ok, upd)), = THREAD_TASKS.decode_results(THREAD_TASKS.encode_results([('t1', True, eng.step(upd))]))
+
+            self.assertTrue(ok, "Step must execute succ")
+
+            if upd is not None:
+                self.assertIsInstance(upd.ip, ProgramOffset)
+                labels.append(upd.ip.label)
+
+        # the address had been loaded from the stack frame
+        self.assertEqual(labels, ['$1', '$2', '$3', 'target', '$9'])
+
+    def test_settings_program(self):
+        db, _ = self._db_lease()
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+        settings = self._settings()
+
+        with self.assertRaises(TFException):
+            settings.get_program_pages(db, opcodes)
+
+        settings.program = os.path.join(os.path.dirname(__file__), 'dasm_ep_2_plus_2.txt')
+        settings.cache = TEST_CACHE_DIR
+
+        pages = settings.get_program_pages(db, opcodes)
+
+        self.assertIn('ep_2_plus_2', pages)
+        self.assertEqual(pages.p_filename, settings.program)
+        self.assertEqual((pages.parser, pages.optimize), (Parser.PyParsing, False))
+
+        settings.parser = 'scanner'
+        settings.optimize = True
+
+        pages = settings.get_program_pages(db, opcodes)
+
+        self.assertEqual((pages.parser, pages.optimize), (Parser.Scanner, True))
+        self.assertIn('ep_2_plus_2', pages)
+
+        settings.parser = 'yacc'
+
+        with self.assertRaises(TFException):
+            settings.get_program_pages(db, opcodes)
+
+    def test_instance_call_many(self):
+        db, lease = self._db_lease()
+        settings = self._settings()
+        settings.program = os.path.join(os.path.dirname(__file__), 'dasm_ep_2_plus_2.txt')
+        settings.plugins = [CorePlugin(), StdPlugin()]
+
+        inst = ThreadExecutorInstance('p1', TEST_IDENT, lease.id, settings)
+
+        sfs = [StackFrame.new(f'sf{i}', {'x': [i, i]}) for i in range(1, 3)]
+        t1, t2 = [ThreadContext.new(f't{i}', 'ep_2_plus_2', [x.id]) for i, x in enumerate(sfs, 1)]
+        t3 = ThreadContext.new('t3', 'ep_2_plus_2', [])
+
+        tx = Transaction.new()
+
+        for x in sfs + [t1, t2]:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        r = {task_id: (ok, rtn) for task_id, ok, rtn in inst.call_many([('t1', t1), ('t2', t2), ('t3', t3)])}
+
+        self.assertEqual(set(r), {'t1', 't2', 't3'})
+        self.assertTrue(all(ok for ok, _ in r.values()), "No step may raise")
+        self.assertTrue(r['t1'][1][0] and r['t2'][1][0], "Steps must execute succ")
+        self.assertEqual([r[x][1][1].ip.offset for x in ['t1', 't2']], [1, 1])
+        self.assertEqual(r['t3'][1], (False, None), "A thread that does not exist must not be stepped")
+
+    def test_instance_group_commit(self):
+        db, lease = self._db_lease()
+        settings = self._settings()
+        settings.program = os.path.join(os.path.dirname(__file__), 'dasm_ep_2_plus_2.txt')
+        settings.plugins = [CorePlugin(), StdPlugin()]
+
+        inst = ThreadExecutorInstance('p1', TEST_IDENT, lease.id, settings, group_commit=2, group_commit_delay=60.)
+
+        sfs = [StackFrame.new(f'sf{i}', {'x': [i, i]}) for i in range(3)]
+        ts = [ThreadContext.new(f't{i}', 'ep_2_plus_2', [x.id]) for i, x in enumerate(sfs)]
+
+        tx = Transaction.new()
+
+        for x in sfs + ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        r = inst.call_many([(x.id, x) for x in ts])
+
+        self.assertTrue(all(ok and step_ok for _, ok, (step_ok, _) in r), "Steps must execute succ")
+
+        stats, meta = db.get(JOBS_COMMIT % (f'{TEST_IDENT}/p1',))
+
+        self.assertEqual(json.loads(stats), inst.group_commit.stats())
+        self.assertEqual((json.loads(stats)['items'], json.loads(stats)['batches']), (3, 2))
+        self.assertEqual(meta.lease_id, lease.id, "Statistics must live as long as the daemon")
+
+        opcodes, meta = db.get(JOBS_OPCODES % (f'{TEST_IDENT}/p1',))
+
+        self.assertEqual(json.loads(opcodes), {'exr': inst.engine.opcodes['exr'].stats()})
+        self.assertEqual(meta.lease_id, lease.id, "Statistics must live as long as the daemon")
+
+        # not yet due
+        inst.call_many([(x.id, x) for _, _, (_, x) in r])
+
+        self.assertEqual(db.get(JOBS_COMMIT % (f'{TEST_IDENT}/p1',))[0], stats)
+
+        inst.stats_publish(inst.stats_last + inst.stats_interval)
+
+        self.assertEqual(json.loads(db.get(JOBS_COMMIT % (f'{TEST_IDENT}/p1',))[0])['items'], 6)
+
     def tearDown(self):
         db = self._settings().get_db()
         for x, kv in db.get_all():
             print(kv.key, x)
             db.delete(kv.key)
+
+        super().tearDown()
@@ -0,0 +1,186 @@
+import os
+import signal
+import time
+import unittest
+from unittest.mock import patch
+
+from tfci_core.daemons.generic.pool import TaskProcessPool, WorkerInstance, PoolScaler, TaskLost
+
+
+class SleepInstance(WorkerInstance):
+    def __init__(self, proc_ident, *args):
+        super().__init__()
+        self.proc_ident = proc_ident
+
+    def __call__(self, task_id, payload):
+        time.sleep(payload)
+        return self.proc_ident
+
+
+class TestTaskProcessPool(unittest.TestCase):
+    def setUp(self):
+        # the processes of the pool import this module
+        path = os.path.dirname(os.path.dirname(__file__))
+        self.env = patch.dict(os.environ, {'PYTHONPATH': os.pathsep.join([path, os.environ.get('PYTHONPATH', '')])})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+
+    def test_window(self):
+        pool = TaskProcessPool(2, SleepInstance, (), window=3)
+
+        try:
+            self.assertEqual(pool.available, 6)
+
+            t = time.monotonic()
+
+            for i in range(6):
+                pool.assign(f't{i}', 0.5)
+
+            self.assertEqual(pool.available, 0)
+            self.assertEqual(sorted(pool.load.values()), [3, 3])
+
+            r = []
+
+            while len(r) < 6:
+                r += pool.poll_many(5)
+
+            # all of the tasks had been executed concurrently
+            self.assertLess(time.monotonic() - t, 1.5)
+
+            self.assertEqual(sorted(x for x, _, _ in r), [f't{i}' for i in range(6)])
+            self.assertTrue(all(ok for _, ok, _ in r))
+            self.assertEqual(len({x for _, _, x in r}), 2)
+            self.assertEqual(pool.available, 6)
+        finally:
+            pool.close()
+
+    def test_preload(self):
+        pool = TaskProcessPool(2, SleepInstance, (), preload=['tfci.db.codec'])
+
+        try:
+            pool.assign('t1', 0.)
+            pool.assign('t2', 10.)
+
+            r = []
+
+            while len(r) < 1:
+                r += pool.poll_many(5)
+
+            self.assertEqual([(x, ok) for x, ok, _ in r], [('t1', True)])
+
+            # the process is replaced by a new one
+            pool.cancel('t2')
+
+            self.assertEqual(pool.available, 2)
+            self.assertEqual(pool.stats()['started'], 3)
+        finally:
+            pool.close()
+
+    def test_resize(self):
+        pool = TaskProcessPool(1, SleepInstance, ())
+
+        try:
+            self.assertEqual(pool.resize(3), 3)
+
+            pool.wait_started()
+
+            pool.assign('t1', 10.)
+
+            # the busy process is kept
+            self.assertEqual(pool.resize(1), 1)
+            self.assertEqual(list(pool.load.values()), [1])
+            self.assertEqual(len(pool.retired), 2)
+
+            for x in pool.retired:
+                x.process.wait()
+
+            pool.reap()
+
+            self.assertEqual(pool.retired, [])
+        finally:
+            pool.close()
+
+    def test_supervise(self):
+        pool = TaskProcessPool(2, SleepInstance, (), deadline=1.)
+
+        try:
+            pool.assign('t1', 10.)
+            pool.assign('t2', 10.)
+
+            os.kill(pool.processes[pool.assigned['t2']].process.pid, signal.SIGKILL)
+
+            r = []
+
+            while len(r) < 2:
+                r += pool.poll_many(5)
+
+            self.assertEqual([(x, ok) for x, ok, _ in r], [('t2', False), ('t1', False)])
+            self.assertTrue(all(isinstance(e, TaskLost) for _, _, e in r))
+            self.assertEqual([e.reason for _, _, e in r], ['exited', 'hung'])
+
+            # the replacements are started without waiting for them
+            pool.wait_started()
+
+            self.assertEqual(pool.available, 2)
+            self.assertEqual(pool.stats()['lost'], {'exited': 1, 'hung': 1, 'start': 0})
+        finally:
+            pool.close()
+
+    def test_restart_backoff(self):
+        pool = TaskProcessPool(1, SleepInstance, (), restart_backoff=0.4)
+
+        try:
+            # the replacements exit before they connect
+            with patch('sys.executable', '/bin/false'):
+                os.kill(next(iter(pool.processes.values())).process.pid, signal.SIGKILL)
+
+                t = time.monotonic()
+
+                while time.monotonic() - t < 2.:
+                    pool.poll_many(0.05)
+
+                # started at once, then after 0.4s and 0.8s
+                self.assertEqual(pool.lost['start'], 3)
+                self.assertEqual(pool.start_failures, 3)
+
+            while not pool.available:
+                pool.poll_many(0.05)
+
+            self.assertEqual(pool.stats()['start_failures'], 0)
+        finally:
+            pool.close()
+
+
+class TestPoolScaler(unittest.TestCase):
+    def test_decide(self):
+        s = PoolScaler(1, 8, window=2, interval=1., idle=2)
+        s.last = 0.
+
+        s.sample(4, 4)
+
+        self.assertIsNone(s.decide(2, 10, 0., now=0.5))
+
+        # 4 slots in flight and 10 tasks of 0.5s of the backlog take 9 slots
+        d = s.decide(2, 10, 0.5, now=1.)
+
+        self.assertEqual((d.target, d.reason, d.busy), (5, 'backlog', 1.))
+
+        # a backlog without the pool being saturated does not grow it
+        s.sample(2, 10)
+
+        self.assertEqual(s.decide(5, 1, 0.5, now=2.).reason, 'hold')
+
+        s.sample(1, 10)
+
+        self.assertEqual(s.decide(5, 0, 0.5, now=3.).reason, 'hold')
+
+        s.sample(1, 10)
+
+        d = s.decide(5, 0, 0.5, now=4.)
+
+        self.assertEqual((d.target, d.reason), (1, 'idle'))
+        self.assertEqual((s.ups, s.downs), (1, 1))
+
+        self.assertEqual(s.decide(0, 0, 0., now=5.).target, 1)
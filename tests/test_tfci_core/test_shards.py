@@ -0,0 +1,389 @@
+import json
+import multiprocessing.connection
+import unittest
+
+import tfci_core.opcodes
+import tfci_std.opcodes
+from test_tfci.compiler.test_compiler import load_opcodes
+from test_tfci.db.fixtures import MemoryServerFixture
+from test_tfci_core.test_execution_engine import TestProgramPages
+from tfci.db.db_util import Lease
+from tfci.db.codec import THREAD, codec_set
+from tfci.db.ops import Transaction
+from tfci.dsl.struct import ProgramOffset
+from tfci.dsm.struct import ThreadContext, ThreadLock, StackFrame, thread_shard
+from tfci_core.const import JOBS_SHARDS, JOBS_BACKLOG, JOBS_SCALE, JOBS_STEALS
+from tfci_core.daemons.generic.pool import PoolScaler, TaskLost
+from tfci_core.daemons.worker.daemon import shards_assign, WorkerDaemon
+from tfci_core.daemons.worker.worker import ExecutionEngine, StolenThread
+
+
+class TestShards(unittest.TestCase):
+    def test_keys(self):
+        t = ThreadContext.new('t1', 'ep', [])
+        shard = thread_shard(t.id)
+
+        self.assertTrue(t.key.startswith(ThreadContext.prefix(shard)))
+        self.assertTrue(t.lock_key.startswith(ThreadLock.prefix(shard)))
+        self.assertTrue(ThreadContext.prefix(shard).startswith(ThreadContext.prefix()))
+
+        self.assertEqual(ThreadContext.key_fn_rev(t.key), t.id)
+        self.assertEqual(ThreadLock.key_fn_rev(t.lock_key), t.id)
+
+    def test_assign(self):
+        members = [f'w{i}' for i in range(5)]
+
+        assigned = {x: shards_assign(x, members) for x in members}
+
+        self.assertEqual(sorted(y for x in assigned.values() for y in x), list(range(JOBS_SHARDS)))
+
+        assigned_more = {x: shards_assign(x, members + ['w5']) for x in members + ['w5']}
+
+        # only the shards taken over by the new member move
+        for x in members:
+            self.assertEqual(set(assigned[x]) - set(assigned_more[x]), set(assigned[x]) & set(assigned_more['w5']))
+            self.assertLessEqual(set(assigned_more[x]), set(assigned[x]))
+
+        self.assertEqual(shards_assign('w0', []), list(range(JOBS_SHARDS)))
+
+
+class TestMigrate(MemoryServerFixture):
+    def test_flat(self):
+        db, lease = self._db_lease()
+
+        t = ThreadContext.new('t1', 'ep', ['sf1'])
+
+        # as written before the sharding
+        db.put(ThreadContext.prefix() + t.id, t.serialize())
+        db.put(ThreadLock.prefix() + t.id, 'other', lease=lease.to_etcd3())
+
+        self.assertEqual(ThreadContext.key_fn_rev(ThreadContext.prefix() + t.id), t.id)
+        self.assertEqual(ThreadContext.load_all(db)['t1'].sp, ['sf1'])
+
+        self.assertEqual((ThreadLock.migrate(db), ThreadContext.migrate(db)), (1, 1))
+        self.assertEqual((ThreadLock.migrate(db), ThreadContext.migrate(db)), (0, 0))
+
+        self.assertEqual(db.get(ThreadContext.prefix() + t.id), (None, None))
+        self.assertEqual(db.get(t.key)[0], t.serialize().encode())
+
+        lock, lock_meta = db.get(t.lock_key)
+
+        self.assertEqual((lock, lock_meta.lease_id), (b'other', lease.id))
+
+
+class TestPool:
+    def __init__(self, parallel):
+        self.parallel = parallel
+        self.assigned = {}
+
+    @property
+    def available(self):
+        return self.parallel - len(self.assigned)
+
+    @property
+    def busy(self):
+        return len(self.assigned)
+
+    @property
+    def capacity(self):
+        return self.parallel
+
+    @property
+    def latency(self):
+        return 0.
+
+    def resize(self, parallel):
+        self.parallel = parallel
+        return parallel
+
+    def __contains__(self, item):
+        return item in self.assigned
+
+    def assign(self, task_id, task):
+        self.assigned[task_id] = task
+
+    def close(self):
+        pass
+
+
+class TestWorkerDaemon(MemoryServerFixture):
+    def _worker(self, **kwargs):
+        kwargs = dict(
+            dict(parallel_min=None, parallel_max=None, scale_interval=0., window=1, preload=False, async_steps=0,
+                 max_steps=1, max_time=None, deadline=0., claim=False, group_commit=0, group_commit_delay=0.01),
+            **kwargs
+        )
+
+        return WorkerDaemon(settings=self._settings(), **kwargs)
+
+    def test_ready(self):
+        w = self._worker(parallel=1, steal_interval=0.)
+        w.startup()
+        w.pool = TestPool(0)
+
+        w.get_prefix('/daemons/worker/', w.daemon_put)
+
+        for i in range(4):
+            w.ctx_put(f't{i}', ThreadContext.new(f't{i}', 'ep', []).serialize())
+
+        w.lock_put('t1', b'other')
+
+        self.assertEqual(list(w.ready), ['t0', 't2', 't3'])
+
+        w.ctx_delete('t2')
+        w.lock_delete('t1')
+
+        self.assertEqual(list(w.ready), ['t0', 't3', 't1'])
+
+        w.pool.parallel = 2
+        w.lease_renew(False)
+        w.ctx_pool_fill()
+
+        self.assertEqual(list(w.pool.assigned), ['t0', 't3'])
+        self.assertEqual(list(w.ready), ['t1'])
+
+        # updates of the assigned threads do not queue them again
+        w.ctx_put('t0', ThreadContext.new('t0', 'ep2', []).serialize())
+
+        self.assertEqual(list(w.ready), ['t1'])
+
+
+    def test_events(self):
+        w = self._worker(parallel=1, steal_interval=0.)
+        w.startup()
+        w.pool = TestPool(0)
+
+        w.get_prefix('/daemons/worker/', w.daemon_put)
+        w.watch_restart()
+
+        self.assertEqual(multiprocessing.connection.wait([w.route_recv], timeout=0), [])
+
+        for i in range(3):
+            t = ThreadContext.new(f't{i}', 'ep', [])
+            w.db.put(t.key, t.serialize())
+
+        self.assertEqual(multiprocessing.connection.wait([w.route_recv], timeout=1), [w.route_recv])
+
+        w.events_process()
+
+        self.assertEqual(list(w.ready), ['t0', 't1', 't2'])
+        self.assertEqual(multiprocessing.connection.wait([w.route_recv], timeout=0), [])
+
+        w.watch_stop()
+
+    def test_events_binary(self):
+        w = self._worker(parallel=1, steal_interval=0.)
+        w.settings.codec = 'binary'
+        w.startup()
+        w.pool = TestPool(0)
+
+        try:
+            t0, t1 = [ThreadContext.new(f't{i}', ProgramOffset('d1', i, None), []) for i in range(2)]
+            w.db.put(t0.key, t0.serialize())
+            w.db.put(t1.lock_key, w.ident)
+
+            self.assertEqual(w.db.get(t0.key)[0][0], THREAD.tag)
+
+            w.get_prefix('/daemons/worker/', w.daemon_put)
+            w.watch_restart()
+
+            w.db.put(t1.key, t1.serialize())
+
+            self.assertEqual(multiprocessing.connection.wait([w.route_recv], timeout=1), [w.route_recv])
+
+            w.events_process()
+
+            self.assertEqual(w.ctx, {'t0': t0._replace(version=-1), 't1': t1._replace(version=-1)})
+            self.assertEqual(w.lock, {'t1': w.ident})
+            self.assertEqual(list(w.ready), ['t0'])
+        finally:
+            w.watch_stop()
+            codec_set('json')
+
+    def test_scale(self):
+        w = self._worker(parallel=1, parallel_min=1, parallel_max=4, steal_interval=0.)
+        w.startup()
+        w.pool = TestPool(1)
+        w.scaler = PoolScaler(1, 4, interval=0., idle=2)
+
+        w.get_prefix('/daemons/worker/', w.daemon_put)
+
+        for i in range(5):
+            w.ctx_put(f't{i}', ThreadContext.new(f't{i}', 'ep', []).serialize())
+
+        w.lease_renew(False)
+        w.ctx_pool_fill()
+        w.pool_scale()
+
+        # the backlog of 4 threads is taken by the processes started
+        self.assertEqual(w.pool.parallel, 4)
+        self.assertEqual(len(w.pool.assigned), 4)
+
+        scale = json.loads(w.db.get(JOBS_SCALE % (w.ident,))[0])
+
+        self.assertEqual((scale['processes'], scale['target'], scale['reason'], scale['ups']), (1, 4, 'backlog', 1))
+
+        w.pool.assigned = {}
+        w.ready.clear()
+
+        w.pool_scale()
+
+        self.assertEqual(w.pool.parallel, 4)
+
+        w.pool_scale()
+
+        self.assertEqual(w.pool.parallel, 1)
+        self.assertEqual(json.loads(w.db.get(JOBS_SCALE % (w.ident,))[0])['reason'], 'idle')
+
+    def test_lost(self):
+        w = self._worker(parallel=1, steal_interval=0.)
+        w.startup()
+        w.pool = TestPool(1)
+
+        w.get_prefix('/daemons/worker/', w.daemon_put)
+
+        t = ThreadContext.new('t0', 'ep', [])
+        w.db.put(t.key, t.serialize())
+        w.get_prefix(ThreadContext.prefix(thread_shard(t.id)), w.ctx_put)
+
+        w.lease_renew(False)
+        w.ctx_pool_fill()
+
+        ok, _, _ = t.lock(w.db, w.ident, Lease(w.lease.id).to_etcd3())
+
+        self.assertTrue(ok)
+
+        del w.pool.assigned['t0']
+        w.task_done('t0', False, TaskLost('t0', 'exited'))
+
+        # the thread is unlocked for it to be stepped again
+        self.assertEqual(w.db.get(t.lock_key), (None, None))
+        self.assertEqual(list(w.ready), ['t0'])
+
+    def test_rebalance_claim(self):
+        w1, w2 = [self._worker(parallel=1, steal_interval=0., claim=True) for _ in range(2)]
+
+        w1.startup()
+        w1.pool = TestPool(1)
+        w1.get_prefix('/daemons/worker/', w1.daemon_put)
+
+        db = w1.db
+        lease = Lease(w1.lease.id).to_etcd3()
+
+        ts = [ThreadContext.new(f't{i}', 'ep', []) for i in range(32)]
+
+        for x in ts:
+            db.put(x.key, x.serialize())
+
+        # the threads claimed by the processes of the first worker
+        for x in ts:
+            ok, _, _ = x.lock(db, w1.ident, lease)
+
+            self.assertTrue(ok)
+
+        for x in w1.shards:
+            w1.get_prefix(ThreadLock.prefix(x), w1.lock_put)
+
+        w2.startup()
+        w2.pool = TestPool(0)
+
+        moved = [x for x in ts if thread_shard(x.id) in shards_assign(w2.ident, [w1.ident])]
+        kept = [x for x in ts if x not in moved]
+
+        self.assertTrue(len(moved) > 1 and len(kept))
+
+        # one of the threads that move is in flight
+        w1.pool.assign(moved[0].id, moved[0])
+
+        w1.get_prefix('/daemons/worker/', w1.daemon_put)
+
+        for x in moved[1:]:
+            self.assertEqual(db.get(x.lock_key), (None, None), "Lock must be released")
+
+        for x in [moved[0]] + kept:
+            self.assertEqual(db.get(x.lock_key)[0], w1.ident.encode(), "Lock must be kept")
+
+        del w1.pool.assigned[moved[0].id]
+        w1.task_done(moved[0].id, True, (True, moved[0]))
+
+        self.assertEqual(db.get(moved[0].lock_key), (None, None), "Lock must be released once the step is done")
+
+        w2.get_prefix('/daemons/worker/', w2.daemon_put)
+
+        self.assertEqual(set(w2.ready), {x.id for x in moved}, "Threads must be runnable by the new owner")
+
+        w1.teardown()
+
+        for x in kept:
+            self.assertEqual(db.get(x.lock_key), (None, None), "Lock must be released on teardown")
+
+    def test_steal(self):
+        w = self._worker(parallel=2, steal_interval=0.01)
+        w.startup()
+        w.pool = TestPool(w.parallel)
+
+        db = w.db
+        db.put('/daemons/worker/other', '')
+
+        w.get_prefix('/daemons/worker/', w.daemon_put)
+
+        shard = min(set(range(JOBS_SHARDS)) - w.shards)
+
+        sfs, ts = [], []
+
+        for i in range(1000):
+            if len(ts) == 6:
+                break
+
+            if thread_shard(f't{i}') == shard:
+                sfs.append(StackFrame.new(f'sf{i}', {'x': i}))
+                ts.append(ThreadContext.new(f't{i}', 'ep_2_plus_2', [sfs[-1].id]))
+
+        tx = Transaction.new()
+
+        for x in sfs + ts:
+            tx = tx.merge(x.create())
+
+        ok, _, _ = tx.exec(db)
+
+        self.assertTrue(ok, "Transaction must execute successfully")
+
+        # nothing to steal from
+        w.steal()
+
+        self.assertEqual(w.pool.assigned, {})
+        self.assertEqual(db.get(JOBS_STEALS % (w.ident,)), (None, None))
+
+        # as published by the worker the shard is assigned to
+        db.put(JOBS_BACKLOG % (f'{shard:02x}',), '6')
+
+        w.steal_last = 0.
+        w.steal()
+
+        self.assertEqual(len(w.pool.assigned), 2)
+        self.assertEqual(w.steals, {'attempts': 2, 'stolen': 2, 'contended': 0})
+
+        steals, steals_meta = db.get(JOBS_STEALS % (w.ident,))
+
+        self.assertEqual(json.loads(steals), w.steals)
+        self.assertEqual(steals_meta.lease_id, w.lease.id, "Counters must live as long as the daemon")
+
+        opcodes = load_opcodes(tfci_core.opcodes, tfci_std.opcodes)
+
+        eng = ExecutionEngine(
+            w.ident,
+            Lease(w.lease.id),
+            opcodes,
+            TestProgramPages('dasm_ep_2_plus_2.txt', db, opcodes),
+            db
+        )
+
+        for k, x in w.pool.assigned.items():
+            self.assertIsInstance(x, StolenThread)
+            self.assertEqual(db.get(x.thread.lock_key)[0], w.ident.encode())
+
+            ok, upd = eng.step(x.thread, stolen=True)
+
+            self.assertTrue(ok, "Step must execute succ")
+            self.assertEqual(db.get(x.thread.lock_key), (None, None), "Lock must be released")
+
@@ -0,0 +1,39 @@
+import unittest
+
+from tfci.dsl.struct import ProgramOffset
+from tfci.dsm.struct import ThreadContext
+from tfci_core.daemons.worker.wire import THREAD_TASKS
+from tfci_core.daemons.worker.worker import StolenThread
+
+
+class TestThreadTaskCodec(unittest.TestCase):
+    def test_tasks(self):
+        items = [
+            ('t1', ThreadContext('t1', 'ep:entry', ['sf1', 'sf2'], 3)),
+            ('t2', StolenThread(ThreadContext('t2', 12, [], -1))),
+            ('t3', ThreadContext('other', 'ü', ['sf3'], 0)),
+            ('t4', ThreadContext('t4', ProgramOffset('d1', 3, 'ep'), ['sf4'], 1)),
+            ('t5', ThreadContext('t5', ProgramOffset('d1', 4, None), [], 1)),
+        ]
+
+        self.assertEqual(THREAD_TASKS.decode_tasks(THREAD_TASKS.encode_tasks(items)), items)
+
+        with self.assertRaises(TypeError):
+            THREAD_TASKS.encode_tasks([('t1', 1.)])
+
+    def test_results(self):
+        items = [
+            ('t1', True, (True, ThreadContext('t1', 'ep:entry', ['sf1'], 4))),
+            ('t2', True, (True, None)),
+            ('t3', True, (False, None)),
+        ]
+
+        self.assertEqual(THREAD_TASKS.decode_results(THREAD_TASKS.encode_results(items)), items)
+
+        (task_id, ok, e), (_, _, e2) = THREAD_TASKS.decode_results(
+            THREAD_TASKS.encode_results([('t4', False, KeyError('x')), ('t5', False, lambda: None)])
+        )
+
+        self.assertEqual((task_id, ok, type(e), e.args), ('t4', False, KeyError, ('x',)))
+        # an exception that can not be pickled is lost
+        self.assertIsNone(e2)
@@ -90,6 +90,7 @@ class Daemon:
 
     def startup(self):
         self.settings.setup_logging()
+        self.settings.setup_codec()
 
         if self.is_daemon:
 
@@ -0,0 +1,308 @@
+"""
+Codecs of the values stored by the mappers.
+
+Every value written by a binary codec starts with the tag byte of the codec. JSON values are written without a tag (a
+JSON document never starts with one of the tags), so that the values written before the codecs were introduced can
+still be decoded, whatever the codec a mapper is configured to write with.
+"""
+import json
+import struct
+from typing import Any, Dict, List, Tuple, Union
+
+from tfci.dsl.struct import ProgramAddress, ProgramOffset
+
+
+class Codec:
+    name = None  # type: str
+    tag = None  # type: int
+
+    def encode(self, x) -> Union[str, bytes]:
+        raise NotImplementedError('')
+
+    def decode(self, bts: bytes) -> Any:
+        """
+        :param bts: the value including the tag byte
+        """
+        raise NotImplementedError('')
+
+
+class JSONCodec(Codec):
+    name = 'json'
+
+    def encode(self, x) -> str:
+        return json.dumps(x)
+
+    def decode(self, bts: bytes):
+        return json.loads(bts)
+
+
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+LEN32 = struct.Struct('<I')
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_BIGINT, T_FLOAT, T_STR8, T_STR32, T_LIST8, T_LIST32, T_DICT8, T_DICT32 = range(12)
+
+
+class BinaryCodec(Codec):
+    """
+    A compact msgpack-like encoding of anything JSON can encode: every item is a type byte followed by its payload,
+    lengths take a single byte unless they do not fit.
+    """
+    name = 'binary'
+    tag = 0x01
+
+    def __init__(self):
+        self._encoders = {
+            type(None): self._encode_none,
+            bool: self._encode_bool,
+            int: self._encode_int,
+            float: self._encode_float,
+            str: self._encode_str,
+            list: self._encode_list,
+            tuple: self._encode_list,
+            dict: self._encode_dict,
+        }
+
+        self._decoders = [
+            self._decode_none,
+            self._decode_false,
+            self._decode_true,
+            self._decode_int,
+            self._decode_bigint,
+            self._decode_float,
+            self._decode_str8,
+            self._decode_str32,
+            self._decode_list8,
+            self._decode_list32,
+            self._decode_dict8,
+            self._decode_dict32,
+        ]
+
+    def _encode(self, x, r: List[bytes]):
+        fn = self._encoders.get(type(x))
+
+        if fn is None:
+            # subclasses, e.g. the variables of a stack frame
+            for t, fn in self._encoders.items():
+                if t is not bool and isinstance(x, t):
+                    break
+            else:
+                raise TypeError(f'Object of type {type(x).__name__} is not serializable')
+
+        fn(x, r)
+
+    def _encode_len(self, t8, t32, n, r: List[bytes]):
+        if n < 256:
+            r.append(bytes((t8, n)))
+        else:
+            r.append(bytes((t32,)) + LEN32.pack(n))
+
+    def _encode_none(self, x, r: List[bytes]):
+        r.append(bytes((T_NONE,)))
+
+    def _encode_bool(self, x, r: List[bytes]):
+        r.append(bytes((T_TRUE if x else T_FALSE,)))
+
+    def _encode_int(self, x, r: List[bytes]):
+        if -2 ** 63 <= x < 2 ** 63:
+            r.append(bytes((T_INT,)) + INT.pack(x))
+        else:
+            bts = str(x).encode()
+            if len(bts) > 255:
+                raise OverflowError('int too large to encode')
+            r.append(bytes((T_BIGINT, len(bts))) + bts)
+
+    def _encode_float(self, x, r: List[bytes]):
+        r.append(bytes((T_FLOAT,)) + FLOAT.pack(x))
+
+    def _encode_str(self, x: str, r: List[bytes]):
+        bts = x.encode()
+        self._encode_len(T_STR8, T_STR32, len(bts), r)
+        r.append(bts)
+
+    def _encode_list(self, x, r: List[bytes]):
+        self._encode_len(T_LIST8, T_LIST32, len(x), r)
+        encode = self._encode
+        for y in x:
+            encode(y, r)
+
+    def _encode_dict(self, x, r: List[bytes]):
+        self._encode_len(T_DICT8, T_DICT32, len(x), r)
+        encode = self._encode
+        for k, v in x.items():
+            if type(k) is not str:
+                raise TypeError(f'keys must be str, not {type(k).__name__}')
+            self._encode_str(k, r)
+            encode(v, r)
+
+    def encode(self, x) -> bytes:
+        r = [bytes((self.tag,))]
+        self._encode(x, r)
+        return b''.join(r)
+
+    def _decode(self, bts: bytes, i) -> Tuple[Any, int]:
+        try:
+            fn = self._decoders[bts[i]]
+        except IndexError:
+            raise ValueError(f'Unknown type at {i}')
+
+        return fn(bts, i + 1)
+
+    def _decode_none(self, bts: bytes, i):
+        return None, i
+
+    def _decode_false(self, bts: bytes, i):
+        return False, i
+
+    def _decode_true(self, bts: bytes, i):
+        return True, i
+
+    def _decode_int(self, bts: bytes, i):
+        return INT.unpack_from(bts, i)[0], i + 8
+
+    def _decode_bigint(self, bts: bytes, i):
+        n = bts[i]
+        return int(bts[i + 1:i + 1 + n].decode()), i + 1 + n
+
+    def _decode_float(self, bts: bytes, i):
+        return FLOAT.unpack_from(bts, i)[0], i + 8
+
+    def _decode_str8(self, bts: bytes, i):
+        n = bts[i]
+        return bts[i + 1:i + 1 + n].decode(), i + 1 + n
+
+    def _decode_str32(self, bts: bytes, i):
+        n, = LEN32.unpack_from(bts, i)
+        return bts[i + 4:i + 4 + n].decode(), i + 4 + n
+
+    def _decode_items(self, bts: bytes, i, n):
+        decode = self._decode
+        r = []
+        for _ in range(n):
+            x, i = decode(bts, i)
+            r.append(x)
+        return r, i
+
+    def _decode_list8(self, bts: bytes, i):
+        return self._decode_items(bts, i + 1, bts[i])
+
+    def _decode_list32(self, bts: bytes, i):
+        return self._decode_items(bts, i + 4, LEN32.unpack_from(bts, i)[0])
+
+    def _decode_dict8(self, bts: bytes, i):
+        r, i = self._decode_items(bts, i + 1, 2 * bts[i])
+        return dict(zip(r[::2], r[1::2])), i
+
+    def _decode_dict32(self, bts: bytes, i):
+        r, i = self._decode_items(bts, i + 4, 2 * LEN32.unpack_from(bts, i)[0])
+        return dict(zip(r[::2], r[1::2])), i
+
+    def decode(self, bts: bytes):
+        r, i = self._decode(bts, 1)
+
+        if i != len(bts):
+            raise ValueError(f'Trailing data at {i}')
+
+        return r
+
+
+class ThreadCodec(Codec):
+    """
+    A fixed layout of the `[ip, sp]` pair of a thread: the tag, the number of stack frames, the instruction pointer and
+    then the identifiers of the stack frames, each of them prefixed by its length.
+
+    The instruction pointer is either an offset, a label or a `ProgramOffset`, which is its program, offset and label.
+    """
+    name = 'thread'
+    tag = 0x02
+
+    def encode(self, x: Tuple[ProgramAddress, List[str]]) -> bytes:
+        ip, sp = x
+
+        if isinstance(ip, int):
+            r = [struct.pack('<BHBq', self.tag, len(sp), 0, ip)]
+        elif isinstance(ip, str):
+            ip = ip.encode()
+            r = [struct.pack('<BHBH', self.tag, len(sp), 1, len(ip)), ip]
+        else:
+            program, offset, label = ip
+            program = program.encode()
+            label = b'' if label is None else label.encode()
+            r = [
+                struct.pack('<BHBH', self.tag, len(sp), 2, len(program)), program,
+                struct.pack('<qH', offset, len(label)), label,
+            ]
+
+        sp = [y.encode() for y in sp]
+
+        r.append(struct.pack(f'<{len(sp)}H', *(len(y) for y in sp)))
+        r.extend(sp)
+
+        return b''.join(r)
+
+    def decode(self, bts: bytes) -> Tuple[ProgramAddress, List[str]]:
+        _, n, kind = struct.unpack_from('<BHB', bts)
+
+        if kind == 0:
+            ip, = INT.unpack_from(bts, 4)
+            i = 12
+        elif kind == 1:
+            size, = struct.unpack_from('<H', bts, 4)
+            ip = bts[6:6 + size].decode()
+            i = 6 + size
+        else:
+            size, = struct.unpack_from('<H', bts, 4)
+            program = bts[6:6 + size].decode()
+            i = 6 + size
+            offset, size = struct.unpack_from('<qH', bts, i)
+            i += 10
+            ip = ProgramOffset(program, offset, bts[i:i + size].decode() or None)
+            i += size
+
+        sizes = struct.unpack_from(f'<{n}H', bts, i)
+        i += 2 * n
+
+        sp = []
+
+        for size in sizes:
+            sp.append(bts[i:i + size].decode())
+            i += size
+
+        return [ip, sp]
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+THREAD = ThreadCodec()
+
+# the codecs that can encode any value, mappers may specialize them for their own schema
+CODECS = {x.name: x for x in [JSON, BINARY]}  # type: Dict[str, Codec]
+CODECS_BY_TAG = {x.tag: x for x in [BINARY, THREAD]}  # type: Dict[int, Codec]
+
+_codec = JSON
+
+
+def codec_get() -> Codec:
+    """
+    :return: the codec new values are written with
+    """
+    return _codec
+
+
+def codec_set(name: str):
+    global _codec
+
+    if name not in CODECS:
+        raise KeyError(f'Unknown codec `{name}`, expected one of {sorted(CODECS)}')
+
+    _codec = CODECS[name]
+
+
+def codec_decode(bts: Union[str, bytes]):
+    """
+    Decode a value written by any of the codecs
+    """
+    if isinstance(bts, bytes) and len(bts) and bts[0] in CODECS_BY_TAG:
+        return CODECS_BY_TAG[bts[0]].decode(bts)
+    else:
+        return JSON.decode(bts)
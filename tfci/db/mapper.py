@@ -4,6 +4,7 @@ from typing import Type, Optional, Dict, TypeVar, NamedTupleMeta
 from etcd3 import Etcd3Client
 
 from tfci.db import ops
+from tfci.db.codec import Codec, codec_get, codec_decode
 from tfci.db.ops import Transaction
 from tfci.db.db_util import RangeEvent
 
@@ -13,13 +14,29 @@ logger = logging.getLogger(__name__)
 
 
 class MapperBase:
+    # codecs specialized for the schema of the mapper, by the name of the codec they replace
+    codecs = {}  # type: Dict[str, Codec]
+
+    @classmethod
+    def encode(cls, x):
+        c = codec_get()
+        return cls.codecs.get(c.name, c).encode(x)
+
+    @classmethod
+    def decode(cls, bts):
+        return codec_decode(bts)
+
     @classmethod
     def key_fn(self, id) -> str:
         raise NotImplementedError('')
 
     @classmethod
     def key_fn_rev(cls, key):
-        return key[len(cls.key_fn('')):]
+        return key[len(cls.prefix()):]
+
+    @classmethod
+    def prefix(cls) -> str:
+        return cls.key_fn('')
 
     def serialize(self) -> str:
         raise NotImplementedError('')
@@ -86,7 +103,7 @@ class MapperBase:
     def load_all(cls: Type[T], db: Etcd3Client) -> Dict[str, T]:
         r = {}
 
-        prefix = cls.key_fn('')
+        prefix = cls.prefix()
 
         for v, v_m in db.get_prefix(prefix):
             k = cls.key_fn_rev(v_m.key.decode())
@@ -0,0 +1,631 @@
+import logging
+import threading
+from bisect import bisect_left, insort
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+from typing import Dict, List, Optional, Tuple, Callable, Any, Deque
+
+from etcd3 import utils, Lease as LeaseEtcd3
+from etcd3.client import Transactions
+from etcd3.events import PutEvent, DeleteEvent
+from etcd3.exceptions import PreconditionFailedError, RevisionCompactedError
+from etcd3.transactions import BaseCompare, Value, Version, Create, Mod, Put, Get, Delete
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryHeader:
+    def __init__(self, revision):
+        self.revision = revision
+
+
+class MemoryKeyValue:
+    __slots__ = ('key', 'value', 'create_revision', 'mod_revision', 'version', 'lease')
+
+    def __init__(self, key: bytes, value: bytes, create_revision: int, mod_revision: int, version: int, lease: int):
+        self.key = key
+        self.value = value
+        self.create_revision = create_revision
+        self.mod_revision = mod_revision
+        self.version = version
+        self.lease = lease
+
+
+class MemoryKVMetadata:
+    # mirrors `etcd3.client.KVMetadata`
+    def __init__(self, kv: MemoryKeyValue, header: MemoryHeader):
+        self.key = kv.key
+        self.create_revision = kv.create_revision
+        self.mod_revision = kv.mod_revision
+        self.version = kv.version
+        self.lease_id = kv.lease
+        self.response_header = header
+
+
+class MemoryEventMixin:
+    def __init__(self, kv: MemoryKeyValue):
+        self.key = kv.key
+        self.value = kv.value
+        self.version = kv.version
+        self.create_revision = kv.create_revision
+        self.mod_revision = kv.mod_revision
+        self.lease = kv.lease
+
+
+class MemoryPutEvent(MemoryEventMixin, PutEvent):
+    pass
+
+
+class MemoryDeleteEvent(MemoryEventMixin, DeleteEvent):
+    pass
+
+
+class MemoryResponse:
+    def __init__(self, header: MemoryHeader, deleted=0):
+        self.header = header
+        self.deleted = deleted
+
+
+class MemoryLeaseInfo:
+    def __init__(self, id, ttl, granted_ttl, keys):
+        self.ID = id
+        self.TTL = ttl
+        self.grantedTTL = granted_ttl
+        self.keys = keys
+
+
+class MemoryLease:
+    __slots__ = ('id', 'ttl', 'deadline')
+
+    def __init__(self, id, ttl, deadline):
+        self.id = id
+        self.ttl = ttl
+        self.deadline = deadline
+
+
+class MemoryWatch:
+    __slots__ = ('id', 'key', 'range_end', 'callback', 'revision')
+
+    def __init__(self, id, key: bytes, range_end: Optional[bytes], callback: Callable[[Any], None], revision: int):
+        self.id = id
+        self.key = key
+        self.range_end = range_end
+        self.callback = callback
+        # the revision of the next event to deliver
+        self.revision = revision
+
+    def matches(self, key: bytes):
+        return key_in_range(key, self.key, self.range_end)
+
+
+def key_in_range(key: bytes, start: bytes, end: Optional[bytes]):
+    if end is None:
+        return key == start
+    elif end == b'\0':
+        return key >= start
+    else:
+        return start <= key < end
+
+
+class BaseEtcd3Client:
+    """
+    The part of `etcd3.Etcd3Client` we rely on, implemented on top of a handful of storage primitives.
+
+    Implements transactions with version/value/create/mod compares, put/get/delete/range inside and outside of
+    transactions, prefix watches with revisions and leases with TTL. Watches are delivered from the history of the
+    store, so that a store shared between processes notifies each of them.
+    """
+
+    def __init__(self, clock):
+        self.transactions = Transactions()
+
+        self.clock = clock
+
+        self._lock = threading.RLock()
+        self._deliver_lock = threading.RLock()
+        self._delivering = False
+        self._watches = {}  # type: Dict[int, MemoryWatch]
+        self._watch_ids = count(1)
+
+    # storage
+
+    def _storage(self, write=True):
+        """
+        :return: a context manager of a transaction of the storage, the changes are discarded if it raises
+        """
+        raise NotImplementedError('')
+
+    def _revision_get(self) -> int:
+        raise NotImplementedError('')
+
+    def _revision_set(self, revision: int):
+        raise NotImplementedError('')
+
+    def _kv_get(self, key: bytes) -> Optional[MemoryKeyValue]:
+        raise NotImplementedError('')
+
+    def _kv_range(self, key: bytes, range_end: bytes) -> List[MemoryKeyValue]:
+        raise NotImplementedError('')
+
+    def _kv_set(self, kv: MemoryKeyValue):
+        raise NotImplementedError('')
+
+    def _kv_del(self, key: bytes):
+        raise NotImplementedError('')
+
+    def _history_append(self, revision: int, events: List[Any]):
+        raise NotImplementedError('')
+
+    def _history_first(self) -> Optional[int]:
+        raise NotImplementedError('')
+
+    def _history_since(self, revision: int) -> List[Tuple[int, Any]]:
+        raise NotImplementedError('')
+
+    def _lease_get(self, lease_id: int) -> Optional[MemoryLease]:
+        raise NotImplementedError('')
+
+    def _lease_set(self, lease: MemoryLease):
+        raise NotImplementedError('')
+
+    def _lease_del(self, lease_id: int):
+        raise NotImplementedError('')
+
+    def _lease_next_id(self) -> int:
+        raise NotImplementedError('')
+
+    def _lease_keys(self, lease_id: int) -> List[bytes]:
+        raise NotImplementedError('')
+
+    def _leases_expired(self, now) -> List[int]:
+        raise NotImplementedError('')
+
+    @property
+    def revision(self):
+        with self._lock:
+            return self._revision_get()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # KV
+
+    def _header(self):
+        return MemoryHeader(self._revision_get())
+
+    def _range(self, key: bytes, range_end: Optional[bytes]) -> List[MemoryKeyValue]:
+        if range_end is None:
+            r = self._kv_get(key)
+            return [] if r is None else [r]
+        else:
+            return self._kv_range(key, range_end)
+
+    def _put(self, key: bytes, value: bytes, lease_id: int, revision: int, events: List[Any]):
+        prev = self._kv_get(key)
+
+        if lease_id and self._lease_get(lease_id) is None:
+            raise PreconditionFailedError(f'requested lease not found: {lease_id}')
+
+        if prev is None:
+            kv = MemoryKeyValue(key, value, revision, revision, 1, lease_id)
+        else:
+            kv = MemoryKeyValue(key, value, prev.create_revision, revision, prev.version + 1, lease_id)
+
+        self._kv_set(kv)
+        events.append(MemoryPutEvent(kv))
+
+    def _delete(self, key: bytes, range_end: Optional[bytes], revision: int, events: List[Any]) -> int:
+        items = self._range(key, range_end)
+
+        for kv in items:
+            self._kv_del(kv.key)
+            events.append(MemoryDeleteEvent(MemoryKeyValue(kv.key, b'', 0, revision, 0, 0)))
+
+        return len(items)
+
+    def _compare(self, c: BaseCompare) -> bool:
+        if c.op is None:
+            raise ValueError('op must be one of =, !=, < or >')
+
+        key = utils.to_bytes(c.key)
+        range_end = None if c.range_end is None else utils.to_bytes(c.range_end)
+
+        items = self._range(key, range_end)
+
+        if len(items) == 0:
+            if isinstance(c, Value):
+                return False
+            items = [MemoryKeyValue(key, b'', 0, 0, 0, 0)]
+
+        for kv in items:
+            if isinstance(c, Value):
+                a, b = kv.value, utils.to_bytes(c.value)
+            elif isinstance(c, Version):
+                a, b = kv.version, int(c.value)
+            elif isinstance(c, Create):
+                a, b = kv.create_revision, int(c.value)
+            elif isinstance(c, Mod):
+                a, b = kv.mod_revision, int(c.value)
+            else:
+                raise NotImplementedError(f'{c}')
+
+            # the ops are mapped to the etcdrpc.Compare enum: EQUAL=0, GREATER=1, LESS=2, NOT_EQUAL=3
+            if not {0: a == b, 1: a > b, 2: a < b, 3: a != b}[c.op]:
+                return False
+
+        return True
+
+    def _apply(self, ops, revision: int, events: List[Any]):
+        rtn = []
+
+        keys = [utils.to_bytes(x.key) for x in ops if isinstance(x, (Put, Delete))]
+
+        if len(keys) != len(set(keys)):
+            raise PreconditionFailedError('duplicate key given in txn request')
+
+        # a transaction either applies all of its ops or none of them, whatever may fail is checked beforehand
+        for op in ops:
+            if not isinstance(op, (Put, Get, Delete)):
+                raise NotImplementedError(f'Unknown request class {op.__class__}')
+
+            if isinstance(op, Put) and op.lease and self._lease_get(utils.lease_to_id(op.lease)) is None:
+                raise PreconditionFailedError(f'requested lease not found: {utils.lease_to_id(op.lease)}')
+
+        for op in ops:
+            if isinstance(op, Put):
+                self._put(utils.to_bytes(op.key), utils.to_bytes(op.value), utils.lease_to_id(op.lease), revision,
+                          events)
+                rtn.append(MemoryResponse(self._header()))
+            elif isinstance(op, Get):
+                key = utils.to_bytes(op.key)
+                range_end = None if op.range_end is None else utils.to_bytes(op.range_end)
+                header = self._header()
+                rtn.append([(x.value, MemoryKVMetadata(x, header)) for x in self._range(key, range_end)])
+            elif isinstance(op, Delete):
+                key = utils.to_bytes(op.key)
+                range_end = None if op.range_end is None else utils.to_bytes(op.range_end)
+                rtn.append(MemoryResponse(self._header(), self._delete(key, range_end, revision, events)))
+            else:
+                raise NotImplementedError(f'Unknown request class {op.__class__}')
+
+        return rtn
+
+    def _commit_events(self, fn):
+        events = []
+        revision = self._revision_get() + 1
+
+        rtn = fn(revision, events)
+
+        if len(events):
+            self._revision_set(revision)
+            self._history_append(revision, events)
+
+        return rtn
+
+    def _commit(self, fn):
+        with self._lock:
+            with self._storage():
+                # expiry is committed as its own revision, before the operation that had noticed it
+                self._expire()
+                rtn = self._commit_events(fn)
+
+        self._deliver()
+
+        return rtn
+
+    def _locked(self, fn):
+        with self._lock:
+            with self._storage():
+                self._expire()
+                rtn = fn()
+
+        self._deliver()
+
+        return rtn
+
+    def _deliver(self):
+        with self._deliver_lock:
+            # the callbacks may change the store themselves, the outermost call delivers these changes as well
+            if self._delivering:
+                return
+
+            self._delivering = True
+
+            try:
+                while True:
+                    with self._lock:
+                        watches = list(self._watches.values())
+
+                        if len(watches) == 0:
+                            return
+
+                        with self._storage(False):
+                            events = self._history_since(min(w.revision for w in watches))
+
+                    if len(events) == 0:
+                        return
+
+                    for w in watches:
+                        for rev, ev in events:
+                            if rev >= w.revision and w.matches(ev.key) and w.id in self._watches:
+                                self._notify(w, ev)
+
+                        w.revision = max(w.revision, events[-1][0] + 1)
+            finally:
+                self._delivering = False
+
+    def _notify(self, w: MemoryWatch, ev):
+        try:
+            w.callback(ev)
+        except:
+            logger.exception(f'Watch callback `{w.id}` raised')
+
+    def transaction(self, compare, success=None, failure=None):
+        success = [] if success is None else success
+        failure = [] if failure is None else failure
+
+        def fn(revision, events):
+            ok = all(self._compare(x) for x in compare)
+            return ok, self._apply(success if ok else failure, revision, events)
+
+        return self._commit(fn)
+
+    def get(self, key, **kwargs):
+        def fn():
+            kv = self._kv_get(utils.to_bytes(key))
+
+            if kv is None:
+                return None, None
+            else:
+                return kv.value, MemoryKVMetadata(kv, self._header())
+
+        return self._locked(fn)
+
+    def get_range(self, range_start, range_end, **kwargs):
+        def fn():
+            header = self._header()
+            return [(x.value, MemoryKVMetadata(x, header)) for x in
+                    self._range(utils.to_bytes(range_start), utils.to_bytes(range_end))]
+
+        return (x for x in self._locked(fn))
+
+    def get_prefix(self, key_prefix, **kwargs):
+        key_prefix = utils.to_bytes(key_prefix)
+        return self.get_range(key_prefix, utils.increment_last_byte(key_prefix))
+
+    def get_all(self, **kwargs):
+        return self.get_range(b'\0', b'\0')
+
+    def put(self, key, value, lease=None, prev_kv=False):
+        return self._commit(
+            lambda revision, events: self._put(utils.to_bytes(key), utils.to_bytes(value), utils.lease_to_id(lease),
+                                               revision, events)
+        )
+
+    def delete(self, key, prev_kv=False, return_response=False):
+        deleted = self._commit(lambda revision, events: self._delete(utils.to_bytes(key), None, revision, events))
+
+        if return_response:
+            return MemoryResponse(self._locked(self._header), deleted)
+        return deleted >= 1
+
+    def delete_prefix(self, prefix):
+        prefix = utils.to_bytes(prefix)
+        deleted = self._commit(
+            lambda revision, events: self._delete(prefix, utils.increment_last_byte(prefix), revision, events)
+        )
+        return MemoryResponse(self._locked(self._header), deleted)
+
+    # watches
+
+    def add_watch_callback(self, key, callback, range_end=None, start_revision=None, **kwargs):
+        key = utils.to_bytes(key)
+        range_end = None if range_end is None else utils.to_bytes(range_end)
+
+        with self._lock:
+            with self._storage(False):
+                revision = self._revision_get()
+
+                if start_revision is None:
+                    start_revision = revision + 1
+                else:
+                    first = self._history_first()
+
+                    if first is not None and first > start_revision and start_revision <= revision:
+                        raise RevisionCompactedError(first)
+
+            w = MemoryWatch(next(self._watch_ids), key, range_end, callback, start_revision)
+
+            self._watches[w.id] = w
+
+        self._deliver()
+
+        return w.id
+
+    def add_watch_prefix_callback(self, key_prefix, callback, **kwargs):
+        key_prefix = utils.to_bytes(key_prefix)
+        kwargs['range_end'] = utils.increment_last_byte(key_prefix)
+        return self.add_watch_callback(key_prefix, callback, **kwargs)
+
+    def cancel_watch(self, watch_id):
+        with self._lock:
+            self._watches.pop(watch_id, None)
+
+    # leases
+
+    def _expire(self):
+        expired = self._leases_expired(self.clock())
+
+        if len(expired) == 0:
+            return
+
+        def fn(revision, events):
+            for x in expired:
+                self._revoke(x, revision, events)
+
+        self._commit_events(fn)
+
+    def _revoke(self, lease_id, revision, events):
+        if self._lease_get(lease_id) is None:
+            return
+
+        self._lease_del(lease_id)
+
+        for key in sorted(self._lease_keys(lease_id)):
+            self._delete(key, None, revision, events)
+
+    def lease(self, ttl, lease_id=None):
+        def fn():
+            nonlocal lease_id
+
+            if lease_id is None:
+                lease_id = self._lease_next_id()
+            elif self._lease_get(lease_id) is not None:
+                raise PreconditionFailedError(f'lease already exists: {lease_id}')
+
+            self._lease_set(MemoryLease(lease_id, ttl, self.clock() + ttl))
+
+        self._locked(fn)
+
+        return LeaseEtcd3(lease_id, ttl, etcd_client=self)
+
+    def revoke_lease(self, lease_id):
+        self._commit(lambda revision, events: self._revoke(lease_id, revision, events))
+
+    def refresh_lease(self, lease_id):
+        def fn():
+            lease = self._lease_get(lease_id)
+
+            if lease is None:
+                return 0
+            else:
+                lease.deadline = self.clock() + lease.ttl
+                self._lease_set(lease)
+                return lease.ttl
+
+        ttl = self._locked(fn)
+
+        yield MemoryLeaseInfo(lease_id, ttl, ttl, [])
+
+    def get_lease_info(self, lease_id):
+        def fn():
+            lease = self._lease_get(lease_id)
+
+            if lease is None:
+                return MemoryLeaseInfo(lease_id, -1, 0, [])
+
+            return MemoryLeaseInfo(
+                lease_id,
+                int(max(0., lease.deadline - self.clock())),
+                lease.ttl,
+                sorted(self._lease_keys(lease_id))
+            )
+
+        return self._locked(fn)
+
+
+class MemoryEtcd3Client(BaseEtcd3Client):
+    """
+    An in-process stand-in for `etcd3.Etcd3Client`.
+
+    The store is not shared between processes, so it may only be used by the daemons and pools that run in-process.
+    """
+
+    clients = {}  # type: Dict[str, MemoryEtcd3Client]
+
+    def __init__(self, history=10000, clock=time.monotonic):
+        super().__init__(clock)
+
+        self._kvs = {}  # type: Dict[bytes, MemoryKeyValue]
+        # the keys of `_kvs` in order, the ranges are sliced out of it
+        self._keys = []  # type: List[bytes]
+        self._revision = 1
+        self._history = deque(maxlen=history)  # type: Deque[Tuple[int, Any]]
+        self._leases = {}  # type: Dict[int, MemoryLease]
+        self._lease_ids = count(1)
+
+    @classmethod
+    def instance(cls, name='default') -> 'MemoryEtcd3Client':
+        if name not in cls.clients:
+            cls.clients[name] = MemoryEtcd3Client()
+        return cls.clients[name]
+
+    @contextmanager
+    def _storage(self, write=True):
+        # the changes are never rolled back, the exceptions are raised before anything is changed, see `_apply`
+        yield
+
+    def _revision_get(self) -> int:
+        return self._revision
+
+    def _revision_set(self, revision: int):
+        self._revision = revision
+
+    def _kv_get(self, key: bytes) -> Optional[MemoryKeyValue]:
+        return self._kvs.get(key)
+
+    def _kv_range(self, key: bytes, range_end: bytes) -> List[MemoryKeyValue]:
+        lo = bisect_left(self._keys, key)
+        hi = len(self._keys) if range_end == b'\0' else bisect_left(self._keys, range_end, lo)
+
+        return [self._kvs[k] for k in self._keys[lo:hi]]
+
+    def _kv_set(self, kv: MemoryKeyValue):
+        if kv.key not in self._kvs:
+            insort(self._keys, kv.key)
+
+        self._kvs[kv.key] = kv
+
+    def _kv_del(self, key: bytes):
+        del self._kvs[key]
+        del self._keys[bisect_left(self._keys, key)]
+
+    def _history_append(self, revision: int, events: List[Any]):
+        for ev in events:
+            self._history.append((revision, ev))
+
+    def _history_first(self) -> Optional[int]:
+        return self._history[0][0] if len(self._history) else None
+
+    def _history_since(self, revision: int) -> List[Tuple[int, Any]]:
+        r = []
+
+        for rev, ev in reversed(self._history):
+            if rev < revision:
+                break
+            r.append((rev, ev))
+
+        r.reverse()
+
+        return r
+
+    def _lease_get(self, lease_id: int) -> Optional[MemoryLease]:
+        return self._leases.get(lease_id)
+
+    def _lease_set(self, lease: MemoryLease):
+        self._leases[lease.id] = lease
+
+    def _lease_del(self, lease_id: int):
+        del self._leases[lease_id]
+
+    def _lease_next_id(self) -> int:
+        r = next(self._lease_ids)
+
+        while r in self._leases:
+            r = next(self._lease_ids)
+
+        return r
+
+    def _lease_keys(self, lease_id: int) -> List[bytes]:
+        return [k for k, kv in self._kvs.items() if kv.lease == lease_id]
+
+    def _leases_expired(self, now) -> List[int]:
+        return [x.id for x in self._leases.values() if x.deadline <= now]
@@ -12,6 +12,30 @@ Compare = BaseCompare
 Modify = TX_MOD
 
 
+class Join:
+    """
+    Maps an operation onto the mapper of the operation right before it, so that its `deserialize_range` receives the
+    results of both.
+    """
+
+
+def deserialize_items(items, maps: MapTuple):
+    groups = []
+    last = None
+
+    for z, y in zip(items, maps):
+        if y is Join:
+            assert last is not None, 'Join must follow a mapped operation'
+            last[1].append(z)
+        elif y:
+            last = (y, [z])
+            groups.append(last)
+        else:
+            last = None
+
+    return [y.deserialize_range(*zs) for y, zs in groups]
+
+
 class Transaction(NamedTuple):
     comp: Tuple[Compare, ...]
     succ: Tuple[Modify, ...]
@@ -80,13 +104,13 @@ class Transaction(NamedTuple):
         # we might want the mapper not to be so strict.
 
         if ok:
-            items_ok = [y.deserialize_range(z) for z, y in zip(items, self.succ_map) if y]
+            items_ok = deserialize_items(items, self.succ_map)
         else:
-            items_ok = [None for _ in self.succ_map]
+            items_ok = [None for y in self.succ_map if y is not Join]
 
         if not ok:
-            items_fail = [y.deserialize_range(z) for z, y in zip(items, self.fail_map) if y]
+            items_fail = deserialize_items(items, self.fail_map)
         else:
-            items_fail = [None for _ in self.fail_map]
+            items_fail = [None for y in self.fail_map if y is not Join]
 
         return ok, items_ok, items_fail
@@ -0,0 +1,202 @@
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, List, Optional, Tuple
+
+from tfci.db.mem import BaseEtcd3Client, MemoryKeyValue, MemoryLease, MemoryPutEvent, MemoryDeleteEvent
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS kv ('
+    'key BLOB PRIMARY KEY, value BLOB NOT NULL, create_revision INTEGER NOT NULL, mod_revision INTEGER NOT NULL, '
+    'version INTEGER NOT NULL, lease INTEGER NOT NULL'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS kv_lease ON kv (lease) WHERE lease != 0',
+    'CREATE TABLE IF NOT EXISTS lease (id INTEGER PRIMARY KEY, ttl INTEGER NOT NULL, deadline REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS lease_deadline ON lease (deadline)',
+    'CREATE TABLE IF NOT EXISTS event ('
+    'revision INTEGER NOT NULL, seq INTEGER NOT NULL, deleted INTEGER NOT NULL, key BLOB NOT NULL, '
+    'value BLOB NOT NULL, create_revision INTEGER NOT NULL, mod_revision INTEGER NOT NULL, version INTEGER NOT NULL, '
+    'lease INTEGER NOT NULL, PRIMARY KEY (revision, seq)'
+    ') WITHOUT ROWID',
+]
+
+KV_COLUMNS = 'key, value, create_revision, mod_revision, version, lease'
+
+
+class SQLiteEtcd3Client(BaseEtcd3Client):
+    """
+    A durable single-node stand-in for `etcd3.Etcd3Client`, stored in an SQLite database in WAL mode.
+
+    Every operation is a single SQLite transaction, so several processes may share the same file. The watches of a
+    process are notified of the changes made by the others by polling the history every `poll` seconds.
+    """
+
+    def __init__(self, path, history=10000, poll=0.05, synchronous='NORMAL', timeout=30., clock=time.time):
+        super().__init__(clock)
+
+        self.path = path
+        self.history = history
+        self.poll = poll
+
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'PRAGMA synchronous={synchronous}')
+        self._depth = 0
+
+        self._poller = None  # type: Optional[threading.Thread]
+        self._closed = threading.Event()
+
+        with self._lock:
+            with self._storage():
+                for x in SCHEMA:
+                    self._conn.execute(x)
+
+                self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('revision', 1), ('lease', 0)")
+
+    def close(self):
+        self._closed.set()
+
+        if self._poller is not None:
+            self._poller.join()
+
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _storage(self, write=True):
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        # a write lock is taken upfront, so that a reader is never asked to retry the upgrade of its snapshot
+        self._conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        self._depth += 1
+
+        try:
+            yield
+        except:
+            self._conn.execute('ROLLBACK')
+            raise
+        else:
+            self._conn.execute('COMMIT')
+        finally:
+            self._depth -= 1
+
+    def _meta_get(self, name) -> int:
+        r, = self._conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return r
+
+    def _meta_set(self, name, value: int):
+        self._conn.execute('UPDATE meta SET value = ? WHERE name = ?', (value, name))
+
+    def _revision_get(self) -> int:
+        return self._meta_get('revision')
+
+    def _revision_set(self, revision: int):
+        self._meta_set('revision', revision)
+
+    def _kv_get(self, key: bytes) -> Optional[MemoryKeyValue]:
+        r = self._conn.execute(f'SELECT {KV_COLUMNS} FROM kv WHERE key = ?', (key,)).fetchone()
+        return None if r is None else MemoryKeyValue(*r)
+
+    def _kv_range(self, key: bytes, range_end: bytes) -> List[MemoryKeyValue]:
+        if range_end == b'\0':
+            r = self._conn.execute(f'SELECT {KV_COLUMNS} FROM kv WHERE key >= ? ORDER BY key', (key,))
+        else:
+            r = self._conn.execute(f'SELECT {KV_COLUMNS} FROM kv WHERE key >= ? AND key < ? ORDER BY key',
+                                   (key, range_end))
+
+        return [MemoryKeyValue(*x) for x in r]
+
+    def _kv_set(self, kv: MemoryKeyValue):
+        self._conn.execute(
+            f'INSERT OR REPLACE INTO kv ({KV_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+            (kv.key, kv.value, kv.create_revision, kv.mod_revision, kv.version, kv.lease)
+        )
+
+    def _kv_del(self, key: bytes):
+        self._conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def _history_append(self, revision: int, events: List[Any]):
+        self._conn.executemany(
+            'INSERT INTO event VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (revision, i, isinstance(x, MemoryDeleteEvent), x.key, x.value, x.create_revision, x.mod_revision,
+                 x.version, x.lease)
+                for i, x in enumerate(events)
+            ]
+        )
+        self._conn.execute('DELETE FROM event WHERE revision <= ?', (revision - self.history,))
+
+    def _history_first(self) -> Optional[int]:
+        r, = self._conn.execute('SELECT MIN(revision) FROM event').fetchone()
+        return r
+
+    def _history_since(self, revision: int) -> List[Tuple[int, Any]]:
+        r = self._conn.execute(
+            f'SELECT revision, deleted, {KV_COLUMNS} FROM event WHERE revision >= ? ORDER BY revision, seq',
+            (revision,)
+        )
+
+        return [
+            (rev, (MemoryDeleteEvent if deleted else MemoryPutEvent)(MemoryKeyValue(*kv)))
+            for rev, deleted, *kv in r
+        ]
+
+    def _lease_get(self, lease_id: int) -> Optional[MemoryLease]:
+        r = self._conn.execute('SELECT id, ttl, deadline FROM lease WHERE id = ?', (lease_id,)).fetchone()
+        return None if r is None else MemoryLease(*r)
+
+    def _lease_set(self, lease: MemoryLease):
+        self._conn.execute('INSERT OR REPLACE INTO lease VALUES (?, ?, ?)', (lease.id, lease.ttl, lease.deadline))
+
+    def _lease_del(self, lease_id: int):
+        self._conn.execute('DELETE FROM lease WHERE id = ?', (lease_id,))
+
+    def _lease_next_id(self) -> int:
+        r = self._meta_get('lease') + 1
+
+        while self._lease_get(r) is not None:
+            r += 1
+
+        self._meta_set('lease', r)
+
+        return r
+
+    def _lease_keys(self, lease_id: int) -> List[bytes]:
+        return [x for x, in self._conn.execute('SELECT key FROM kv WHERE lease = ?', (lease_id,))]
+
+    def _leases_expired(self, now) -> List[int]:
+        return [x for x, in self._conn.execute('SELECT id FROM lease WHERE deadline <= ?', (now,))]
+
+    # watches
+
+    def _poll(self):
+        while not self._closed.wait(self.poll):
+            try:
+                self._deliver()
+            except:
+                logger.exception('While polling the history')
+
+    def add_watch_callback(self, key, callback, range_end=None, start_revision=None, **kwargs):
+        r = super().add_watch_callback(key, callback, range_end, start_revision, **kwargs)
+
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name=f'{self.__class__.__name__}.poll', daemon=True)
+                self._poller.start()
+
+        return r
+
+    def _deliver(self):
+        if not self._closed.is_set():
+            super()._deliver()
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from typing import Optional
+
+import tfci.dsl.compiler
+from tfci.dsl.compiler import compiler_compile_bytecode, SupportedOpcodes, Parser
+from tfci.dsl.struct import Bytecode
+
+logger = logging.getLogger(__name__)
+
+
+class ProgramCache:
+    """
+    Content-addressed storage of compiled programs.
+
+    Entries are keyed by the hash of the program text, of the opcode set it had been compiled against and of the
+    version of the compiler, so a change in either simply results in a miss.
+    """
+
+    magic = b'TFBC'
+    format = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, text: str, supported_opcodes: SupportedOpcodes, optimize=False) -> str:
+        h = hashlib.sha256()
+        h.update(b'%d\0%d\0%d\0' % (cls.format, tfci.dsl.compiler.COMPILER_VERSION, optimize))
+
+        for k in sorted(supported_opcodes.keys()):
+            v = supported_opcodes[k]
+            h.update(f'{k}={v.__class__.__module__}.{v.__class__.__qualname__}\0'.encode())
+
+        h.update(b'\0')
+        h.update(text.encode())
+
+        return h.hexdigest()
+
+    def key_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.bc')
+
+    def get(self, key) -> Optional[Bytecode]:
+        try:
+            with open(self.key_path(key), 'rb') as f_in:
+                bts = f_in.read()
+        except FileNotFoundError:
+            return None
+
+        hdr = self.magic + bytes([self.format])
+
+        if not bts.startswith(hdr):
+            logger.warning(f'Cache entry `{key}` has an unknown format')
+            return None
+
+        try:
+            return pickle.loads(bts[len(hdr):])
+        except Exception:
+            logger.exception(f'Cache entry `{key}` could not be loaded')
+            return None
+
+    def put(self, key, program: Bytecode):
+        path = self.key_path(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        f_h, name = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(f_h, 'wb') as f_out:
+                f_out.write(self.magic + bytes([self.format]))
+                f_out.write(pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(name, path)
+        except:
+            os.unlink(name)
+            raise
+
+    def compile(self, filename, text, supported_opcodes: SupportedOpcodes, parser=Parser.PyParsing,
+                optimize=False) -> Bytecode:
+        key = self.key(text, supported_opcodes, optimize)
+
+        r = self.get(key)
+
+        if r is not None:
+            self.hits += 1
+            return r
+
+        self.misses += 1
+
+        r = compiler_compile_bytecode(filename, text, supported_opcodes, parser, optimize)
+
+        try:
+            self.put(key, r)
+        except OSError:
+            logger.exception(f'Could not store `{filename}` in the cache')
+
+        return r
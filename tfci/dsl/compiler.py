@@ -1,15 +1,26 @@
-from typing import Dict, Type
+from enum import Enum
+from typing import Dict, Type, Optional, List
 
 from pyparsing import ParseException
 
 from tfci.dsl.exception import CompilerException
 from tfci.dsl.parser import lines
-from tfci.dsl.ast import Location, Label, Opcode, Empty, Command, Comment, Lines
-from tfci.dsl.struct import ProgramDefinitionItem, ProgramDefinition
+from tfci.dsl.scanner import scan
+from tfci.dsl.ast import Location, Label, Opcode, Empty, Command, Comment, Lines, Constant, ConstantType, Map, \
+    Identifier
+from tfci.dsl.struct import ProgramDefinitionItem, ProgramDefinition, Bytecode, BytecodeItem, OpcodeArg, OpcodeArgs
 import tfci.opcode
 
 
-def compiler_first_pass(text) -> Lines:
+class Parser(Enum):
+    PyParsing = 'pyparsing'
+    Scanner = 'scanner'
+
+
+def compiler_first_pass(text, parser=Parser.PyParsing) -> Lines:
+    if parser == Parser.Scanner:
+        return scan(text)
+
     try:
         xx = lines.parseString(text, parseAll=True)[0]
         return xx
@@ -19,6 +30,10 @@ def compiler_first_pass(text) -> Lines:
 
 HALT_LABEL = '$halt'
 
+# the version of what the compiler produces, to be bumped by every change of the output for the same program, e.g. of
+# `Bytecode`, of the passes or of the optimizer; the compiled programs are cached by it, see `tfci.dsl.cache`
+COMPILER_VERSION = 1
+
 
 def compiler_second_pass(lines: Lines) -> Lines:
     rtn = []
@@ -97,9 +112,186 @@ def compiler_program_pass(lines: Lines) -> ProgramDefinition:
     return r
 
 
-def compiler_compile_text(filename, text, supported_opcodes) -> ProgramDefinition:
+def compiler_bytecode_arg(arg: OpcodeArg, labels: Dict[str, int]) -> OpcodeArg:
+    if isinstance(arg, Constant) and arg.type == ConstantType.Address and arg.value in labels:
+        return Constant(arg.type, labels[arg.value], arg.loc)
+    elif isinstance(arg, Map):
+        return Map(arg.identifier, compiler_bytecode_arg(arg.to, labels), arg.loc)
+    else:
+        return arg
+
+
+def compiler_bytecode_levels(args: OpcodeArgs) -> int:
+    r = 0
+
+    for arg in args:
+        if isinstance(arg, Map):
+            r = max(r, compiler_bytecode_levels([arg.identifier, arg.to]))
+        elif isinstance(arg, Identifier):
+            r = max(r, arg.level + 1)
+
+    return r
+
+
+def compiler_bytecode_pass(program: ProgramDefinition) -> Bytecode:
+    labels = {k: i for i, k in enumerate(program.keys())}
+
+    opcodes = []
+    opcodes_idx = {}  # type: Dict[str, int]
+    items = []
+
+    for x in program.values():
+        if x.opcode not in opcodes_idx:
+            opcodes_idx[x.opcode] = len(opcodes)
+            opcodes.append(x.opcode)
+
+        items.append(
+            BytecodeItem(
+                opcodes_idx[x.opcode],
+                [compiler_bytecode_arg(y, labels) for y in x.args],
+                None if x.next_label is None else labels[x.next_label],
+                x.loc,
+                compiler_bytecode_levels(x.args),
+            )
+        )
+
+    return Bytecode(opcodes, items, labels)
+
+
+def compiler_local_address(arg: OpcodeArg) -> Optional[int]:
+    if isinstance(arg, Constant) and arg.type == ConstantType.Address and isinstance(arg.value, int):
+        return arg.value
+    else:
+        return None
+
+
+def compiler_optimize_skip(program: Bytecode, ip: int) -> Optional[int]:
+    """
+    :return: the address a thread at `ip` would continue from without doing anything else, None if the instruction
+             has any other effect
+    """
+    x = program.items[ip]
+    name = program.opcodes[x.opcode]
+
+    if name == 'nop':
+        return x.next_ip
+    elif name == 'j' and len(x.args) == 1:
+        return compiler_local_address(x.args[0])
+    elif name in ['je', 'jne'] and len(x.args) == 3 and all(isinstance(y, Constant) for y in x.args):
+        a, b, jmp = x.args
+
+        if ConstantType.Address in (a.type, b.type):
+            # local addresses had been replaced by offsets and may no longer compare the same way
+            return None
+        elif (a.value == b.value) == (name == 'je'):
+            return compiler_local_address(jmp)
+        else:
+            return x.next_ip
+    else:
+        return None
+
+
+def compiler_optimize_pass(program: Bytecode) -> Bytecode:
+    """
+    Removes the instructions that only move the instruction pointer (`nop`, local `j`, `je`/`jne` on constants) by
+    threading every jump to its final destination, then drops whatever is not reachable from the named labels.
+
+    All of the named labels are kept, a label of a removed instruction points to where it would have led.
+    """
+    targets = {}  # type: Dict[int, int]
+
+    def target(ip: int) -> int:
+        seen = []
+
+        while ip not in targets:
+            if ip in seen:
+                # a loop consisting only of jumps, the instruction we have entered it through stays
+                break
+
+            seen.append(ip)
+
+            nxt = compiler_optimize_skip(program, ip)
+
+            if nxt is None:
+                break
+
+            ip = nxt
+
+        r = targets.get(ip, ip)
+
+        for x in seen:
+            targets[x] = r
+
+        return r
+
+    def jumps(args: List[OpcodeArg]):
+        for arg in args:
+            if isinstance(arg, Map):
+                arg = arg.to
+
+            addr = compiler_local_address(arg)
+
+            if addr is not None:
+                yield addr
+
+    roots = [v for k, v in program.labels.items() if not k.startswith('$')]
+
+    if len(program.items):
+        roots.append(0)
+
+    reachable = set()
+    pending = [target(x) for x in roots]
+
+    while len(pending):
+        ip = pending.pop()
+
+        if ip in reachable:
+            continue
+
+        reachable.add(ip)
+
+        x = program.items[ip]
+
+        if program.opcodes[x.opcode] not in ['hlt', 'j'] and x.next_ip is not None:
+            pending.append(target(x.next_ip))
+
+        pending.extend(target(y) for y in jumps(x.args))
+
+    new_ips = {v: i for i, v in enumerate(sorted(reachable))}
+
+    def remap(arg: OpcodeArg) -> OpcodeArg:
+        addr = compiler_local_address(arg)
+
+        if addr is not None:
+            return Constant(arg.type, new_ips[target(addr)], arg.loc)
+        elif isinstance(arg, Map):
+            return Map(arg.identifier, remap(arg.to), arg.loc)
+        else:
+            return arg
+
+    items = []
+
+    for ip in sorted(reachable):
+        x = program.items[ip]
+
+        items.append(
+            BytecodeItem(
+                x.opcode,
+                [remap(y) for y in x.args],
+                None if x.next_ip is None else new_ips.get(target(x.next_ip)),
+                x.loc,
+                x.levels,
+            )
+        )
+
+    labels = {k: new_ips[target(v)] for k, v in program.labels.items() if target(v) in new_ips}
+
+    return Bytecode(program.opcodes, items, labels)
+
+
+def compiler_compile_text(filename, text, supported_opcodes, parser=Parser.PyParsing) -> ProgramDefinition:
     try:
-        xx = compiler_first_pass(text)
+        xx = compiler_first_pass(text, parser)
         xx = compiler_second_pass(xx)
         xx = compiler_third_pass(xx, supported_opcodes)
         xx = compiler_program_pass(xx)
@@ -110,3 +302,11 @@ def compiler_compile_text(filename, text, supported_opcodes) -> ProgramDefinitio
         raise e from None
 
 
+def compiler_compile_bytecode(filename, text, supported_opcodes, parser=Parser.PyParsing, optimize=False) -> Bytecode:
+    r = compiler_bytecode_pass(compiler_compile_text(filename, text, supported_opcodes, parser))
+
+    if optimize:
+        r = compiler_optimize_pass(r)
+
+    return r
+
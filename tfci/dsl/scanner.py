@@ -0,0 +1,250 @@
+"""
+A hand-written replacement of the grammar in :mod:`tfci.dsl.parser`.
+
+It is a single pass over the text that builds exactly the same AST nodes (and `Location`s) as the pyparsing grammar,
+including its quirks: tabs are expanded before parsing, there is no backtracking inside a line once a label had been
+matched and a trailing `Empty` is emitted for the end of the text.
+"""
+import re
+from typing import Optional, Tuple, Union
+
+from tfci.dsl.ast import Location, ConstantType, Constant, Label, Opcode, Identifier, Empty, Map, Command, Comment, \
+    Lines
+from tfci.dsl.exception import CompilerException
+
+WHITESPACE = re.compile(r'[ \t]*')
+# `pp.quotedString` is defined before the default whitespace is changed, so it also skips over newlines
+STRING_WHITESPACE = re.compile(r'[ \t\n\r]*')
+DELIMITER = re.compile(r'[ \t]+')
+IDENTIFIER = re.compile(r'[A-Za-z0-9_.\-]+')
+KEY_PATH = re.compile(r'[A-Za-z0-9_.\-:/]+')
+REST_OF_LINE = re.compile(r'.*')
+
+# pyparsing matches the body of a quoted string first and only then looks for the closing quote
+QUOTED_BODY = {
+    '"': re.compile(r'"(?:[^"\n\r\\]|(?:"")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*'),
+    "'": re.compile(r"'(?:[^'\n\r\\]|(?:'')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*"),
+}
+
+Arg = Union[Identifier, Constant]
+
+
+class Scanner:
+    def __init__(self, text: str):
+        self.text = text.expandtabs()
+        self.len = len(self.text)
+
+    def skip(self, loc) -> int:
+        if loc >= self.len:
+            return loc
+        return WHITESPACE.match(self.text, loc).end()
+
+    def peek(self, loc) -> str:
+        return self.text[loc] if loc < self.len else ''
+
+    def label(self, loc) -> Optional[Tuple[Label, int]]:
+        loc = self.skip(loc)
+        m = IDENTIFIER.match(self.text, loc)
+
+        if m is None:
+            return None
+
+        end = self.skip(m.end())
+
+        if self.peek(end) != ':':
+            return None
+
+        return Label(m.group(), Location(loc)), end + 1
+
+    def identifier(self, loc) -> Optional[Tuple[Identifier, int]]:
+        loc = self.skip(loc)
+        level = 0
+        end = loc
+
+        while self.peek(end) == '^':
+            level += 1
+            end = self.skip(end + 1)
+
+        m = IDENTIFIER.match(self.text, end)
+
+        if m is None:
+            return None
+
+        return Identifier(level, m.group(), Location(loc)), m.end()
+
+    def string(self, loc) -> Optional[Tuple[Constant, int]]:
+        if loc < self.len:
+            loc = STRING_WHITESPACE.match(self.text, loc).end()
+
+        c = self.peek(loc)
+
+        if c not in QUOTED_BODY:
+            return None
+
+        end = QUOTED_BODY[c].match(self.text, loc).end()
+
+        if self.peek(end) != c:
+            return None
+
+        return Constant(ConstantType.String, self.text[loc + 1:end], Location(loc)), end + 1
+
+    def constant(self, loc) -> Optional[Tuple[Constant, int]]:
+        r = self.string(loc)
+
+        if r is not None:
+            return r
+
+        loc = self.skip(loc)
+        c = self.peek(loc)
+
+        if c == '@':
+            m = KEY_PATH.match(self.text, self.skip(loc + 1))
+
+            if m is None:
+                return None
+
+            return Constant(ConstantType.Address, m.group(), Location(loc)), m.end()
+        elif c == '%':
+            m = IDENTIFIER.match(self.text, self.skip(loc + 1))
+
+            if m is None:
+                return None
+
+            try:
+                value = int(m.group())
+            except ValueError:
+                raise CompilerException(loc, f'Tokenizer error: "Invalid integer `{m.group()}`"')
+
+            return Constant(ConstantType.Integer, value, Location(loc)), m.end()
+        else:
+            return None
+
+    def arg(self, loc) -> Optional[Tuple[Union[Arg, Map], int]]:
+        loc = self.skip(loc)
+
+        r = self.identifier(loc)
+
+        if r is None:
+            return self.constant(loc)
+
+        ident, end = r
+        eq = self.skip(end)
+
+        if self.peek(eq) != '=':
+            return r
+
+        r = self.identifier(eq + 1)
+
+        if r is None:
+            r = self.constant(eq + 1)
+
+        if r is None:
+            return ident, end
+
+        to, end = r
+
+        return Map(ident, to, Location(loc)), end
+
+    def comment(self, loc) -> Optional[Tuple[Comment, int]]:
+        loc = self.skip(loc)
+
+        if self.peek(loc) != '#':
+            return None
+
+        m = REST_OF_LINE.match(self.text, loc + 1)
+
+        return Comment(m.group(), Location(loc)), m.end()
+
+    def command(self, loc) -> Optional[Tuple[Command, int]]:
+        loc = self.skip(loc)
+
+        r = self.label(loc)
+
+        if r is None:
+            label, end = Label(None, Location(loc)), loc
+        else:
+            label, end = r
+
+        op_loc = self.skip(end)
+        m = IDENTIFIER.match(self.text, op_loc)
+
+        if m is None:
+            return None
+
+        opcode = Opcode(m.group().lower(), Location(op_loc))
+        end = m.end()
+
+        args = []
+
+        r = self.arg(end)
+
+        while r is not None:
+            arg, end = r
+            args.append(arg)
+
+            m = DELIMITER.match(self.text, end)
+
+            if m is None:
+                break
+
+            r = self.arg(m.end())
+
+        r = self.comment(end)
+
+        if r is None:
+            comment = None
+        else:
+            comment, end = r
+
+        return Command(label, opcode, args, comment, Location(loc)), end
+
+    def line(self, loc):
+        r = self.comment(loc)
+
+        if r is None:
+            r = self.command(loc)
+
+        if r is None:
+            r = self.label(loc)
+
+        if r is None:
+            loc = self.skip(loc)
+            r = Empty('', Location(loc)), loc
+
+        return r
+
+    def eol(self, loc) -> Optional[int]:
+        loc = self.skip(loc)
+
+        if loc < self.len:
+            return loc + 1 if self.text[loc] == '\n' else None
+        elif loc == self.len:
+            return loc + 1
+        else:
+            return None
+
+    def lines(self) -> Lines:
+        start = self.skip(0)
+
+        item, loc = self.line(start)
+        items = [item]
+
+        while True:
+            end = self.eol(loc)
+
+            if end is None:
+                break
+
+            item, loc = self.line(end)
+            items.append(item)
+
+        loc = self.skip(loc)
+
+        if loc < self.len:
+            raise CompilerException(loc, f'Tokenizer error: "Expected end of text, found {self.text[loc]!r}"')
+
+        return Lines(items, Location(start))
+
+
+def scan(text: str) -> Lines:
+    return Scanner(text).lines()
@@ -1,4 +1,5 @@
-from typing import List, Union, NamedTuple, Optional, Dict
+import hashlib
+from typing import Any, List, Union, NamedTuple, Optional, Dict
 
 from tfci.dsl.ast import Constant, Identifier, Map, Location
 
@@ -6,6 +7,35 @@ OpcodeArg = Union[Identifier, Constant, Map]
 OpcodeArgs = List[OpcodeArg]
 
 
+
+class ProgramOffset(NamedTuple):
+    """
+    An offset in the bytecode of the program identified by `program`, see `Bytecode.digest`. Whenever a thread is
+    resumed by another program, it is resolved by the label of the instruction instead.
+    """
+    program: str
+    offset: int
+    label: Optional[str]
+
+
+# a thread may point either at a label (as written in the program) or at an offset in the bytecode; bare offsets are
+# only used within the bytecode itself, see `tfci.dsm.rt.ProgramPages`
+ProgramAddress = Union[ProgramOffset, int, str]
+
+
+def program_address(x: Any) -> Any:
+    """
+    JSON has no tuples, the `ProgramOffset`s stored in the threads or the stack frames are loaded back as lists.
+
+    :return: `x`, unless it is such a list
+    """
+    if isinstance(x, list) and len(x) == 3 and isinstance(x[0], str) and isinstance(x[1], int) and \
+            (x[2] is None or isinstance(x[2], str)):
+        return ProgramOffset(*x)
+
+    return x
+
+
 class ProgramDefinitionItem(NamedTuple):
     opcode: str
     args: OpcodeArgs
@@ -21,3 +51,43 @@ ProgramDefinition = Dict[str, ProgramDefinitionItem]
 # ProgramPages = ProgramDefinition
 
 
+class BytecodeItem(NamedTuple):
+    opcode: int
+    args: OpcodeArgs
+    next_ip: Optional[int]
+    loc: Location
+    # how many stack frames the arguments reference
+    levels: int
+
+    def __repr__(self):
+        return f'({self.opcode} {self.args} {self.next_ip})'
+
+
+class Bytecode(NamedTuple):
+    opcodes: List[str]
+    items: List[BytecodeItem]
+    labels: Dict[str, int]
+
+    def resolve(self, ip: ProgramAddress) -> Optional[int]:
+        if isinstance(ip, int):
+            return ip if 0 <= ip < len(self.items) else None
+        else:
+            return self.labels.get(ip)
+
+    def label(self, ip: int) -> Optional[str]:
+        for k, v in self.labels.items():
+            if v == ip:
+                return k
+        return None
+
+    def digest(self) -> str:
+        """
+        The identity of the layout of the bytecode: the programs of the same digest have the same labels at the same
+        offsets, so that an offset into one of them may be resolved by any other.
+        """
+        h = hashlib.sha256(b'%d\0' % len(self.items))
+
+        for k, v in self.labels.items():
+            h.update(f'{k}\0{v}\0'.encode())
+
+        return h.hexdigest()[:16]
@@ -1,9 +1,9 @@
-from typing import NamedTuple, Optional, List, Set
+from typing import NamedTuple, Optional, List, Set, Any
 
 from etcd3 import Etcd3Client
 
 from tfci.dsl.ast import Identifier, Constant
-from tfci.dsl.struct import OpcodeArgs
+from tfci.dsl.struct import OpcodeArgs, ProgramAddress
 from tfci.dsm.struct import StackFrame, ThreadContext
 
 
@@ -25,10 +25,14 @@ class ExecutionContext(NamedTuple):
     singleton: ExecutionSingleton
 
     args: OpcodeArgs
-    nip: Optional[str]
+    nip: Optional[ProgramAddress]
     thread: ThreadContext
     stack: List[StackFrame]
     stacks_updated: Set[int]
+    # whatever the opcode had prepared for this instruction when the program was loaded
+    prepared: Any = None
+    # tfci.opcode.BoundArgs of the instruction
+    bound: Any = None
 
     @classmethod
     def new(
@@ -36,11 +40,13 @@ class ExecutionContext(NamedTuple):
         singleton: ExecutionSingleton,
 
         args: OpcodeArgs,
-        nip: Optional[str],
+        nip: Optional[ProgramAddress],
         thread: ThreadContext,
-        stack: List[StackFrame]
+        stack: List[StackFrame],
+        prepared: Any = None,
+        bound: Any = None,
     ):
-        return ExecutionContext(singleton, args, nip, thread, stack, set())
+        return ExecutionContext(singleton, args, nip, thread, stack, set(), prepared, bound)
 
     def resolve_item(self, arg):
         if isinstance(arg, Identifier):
@@ -88,6 +94,15 @@ class ExecutionContext(NamedTuple):
         if len(self.args) <= idx:
             raise ExecutionError(f'`{self.thread.id}:{self.thread.ip}` cannot resolve arg at index {idx}: too few args')
 
+        if self.bound is not None:
+            x = self.bound.items[idx]
+
+            if x is None:
+                raise ExecutionError(
+                    f'(resolve_arg) `{self.thread.id}:{self.thread.ip}` Incorrect arg: {repr(self.args[idx])}')
+
+            return x.resolve(self)
+
         jmp = self.args[idx]
 
         if isinstance(jmp, Identifier):
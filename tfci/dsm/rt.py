@@ -1,31 +1,144 @@
-from typing import Dict
+from typing import Dict, Optional, List, Tuple, Any
 
 import tfci.opcode
+from tfci.dsl.ast import Constant, ConstantType, Map
+from tfci.dsl.cache import ProgramCache
+from tfci.dsl.compiler import compiler_compile_bytecode, Parser
 from tfci.dsl.exception import CompilerException
-from tfci.dsl.struct import ProgramDefinition
+from tfci.dsl.struct import Bytecode, BytecodeItem, ProgramAddress, ProgramOffset, OpcodeArg
 
 OpcodeDefinition = Dict[str, tfci.opcode.OpcodeDef]
 
 
 class ProgramPages:
-    def __init__(self, db, opcodes: OpcodeDefinition):
+    """
+    The compiled program the threads are stepped through. Subclasses tell where its text comes from, see `source`.
+    """
+
+    def __init__(self, db, opcodes: OpcodeDefinition, cache: Optional[ProgramCache] = None,
+                 parser: Parser = Parser.PyParsing, optimize=False):
         self.db = db
         self.opcodes = opcodes
-        self._cache = None  # type: ProgramDefinition
+        self.cache = cache
+        self.parser = parser
+        self.optimize = optimize
+        self._program = None  # type: Bytecode
+        self._digest = None  # type: str
+        self._opcodes = None  # type: List[tfci.opcode.OpcodeDef]
+        self._prepared = None  # type: List[Any]
+        self._bound = None  # type: List[tfci.opcode.BoundArgs]
+        self._levels = None  # type: List[int]
+
+    def source(self) -> Tuple[str, str]:
+        """
+        :return: the filename and the text of the program
+        """
+        raise NotImplementedError(f'{self.__class__.__name__} does not define a source')
+
+    def compile(self, filename, text) -> Bytecode:
+        if self.cache is None:
+            return compiler_compile_bytecode(filename, text, self.opcodes, self.parser, self.optimize)
+        else:
+            return self.cache.compile(filename, text, self.opcodes, self.parser, self.optimize)
+
+    def load(self) -> Tuple[str, str, Bytecode]:
+        p_filename, p_text = self.source()
+        return p_filename, p_text, self.compile(p_filename, p_text)
+
+    def qualify(self, program: Bytecode) -> Bytecode:
+        """
+        Replace the offsets the threads may store, the next instructions and the addresses of the arguments, by the
+        `ProgramOffset` of this program.
+        """
+        labels = {}
+
+        # the named labels are preferred, they survive most of the edits of a program
+        for k, v in reversed(list(program.labels.items())):
+            if v not in labels or not k.startswith('$'):
+                labels[v] = k
+
+        offsets = [ProgramOffset(self._digest, i, labels.get(i)) for i in range(len(program.items))]
+
+        def arg(x: OpcodeArg) -> OpcodeArg:
+            if isinstance(x, Constant) and x.type == ConstantType.Address and isinstance(x.value, int):
+                return Constant(x.type, offsets[x.value], x.loc)
+            elif isinstance(x, Map):
+                return Map(x.identifier, arg(x.to), x.loc)
+            else:
+                return x
+
+        return program._replace(items=[
+            x._replace(args=[arg(y) for y in x.args], next_ip=None if x.next_ip is None else offsets[x.next_ip])
+            for x in program.items
+        ])
+
+    @property
+    def program(self) -> Bytecode:
+        if self._program is None:
+            self.p_filename, self.p_text, program = self.load()
+            self._digest = program.digest()
+            self._program = self.qualify(program)
+            self._opcodes = [self.opcodes[x] for x in self._program.opcodes]
+            self._prepared = [self._opcodes[x.opcode].prepare(x.args) for x in self._program.items]
+            self._bound = [self._opcodes[x.opcode].bind(x.args) for x in self._program.items]
+            self._levels = [max(x.levels, self._opcodes[x.opcode].levels) for x in self._program.items]
+
+        return self._program
+
+    def resolve(self, ip: ProgramAddress) -> Optional[int]:
+        program = self.program
 
-    def __contains__(self, item):
-        try:
+        # a `ProgramOffset` may have been through a codec that turned it into a list
+        if isinstance(ip, (tuple, list)):
+            digest, offset, label = ip
 
-            return True or self[item]
-        except KeyError:
-            return False
+            if digest != self._digest:
+                return None if label is None else program.labels.get(label)
 
-    def __getitem__(self, item):
-        if not self._cache:
-            from test_tfci_core.test_compiler import load_test_program
-            self.p_filename, self.p_text, self._cache = load_test_program(self.opcodes)
+            ip = offset
 
-        return self._cache[item]
+        return program.resolve(ip)
+
+    def opcode(self, item: BytecodeItem) -> tfci.opcode.OpcodeDef:
+        return self._opcodes[item.opcode]
+
+    def prepared(self, ip: ProgramAddress) -> Any:
+        return self._prepared[self.resolve(ip)]
+
+    def bound(self, ip: ProgramAddress) -> tfci.opcode.BoundArgs:
+        return self._bound[self.resolve(ip)]
+
+    def levels(self, ip: ProgramAddress) -> int:
+        """
+        :return: how many stack frames should be fetched along with the thread at `ip`
+        """
+        return self._levels[self.resolve(ip)]
+
+    def __contains__(self, item: ProgramAddress):
+        return self.resolve(item) is not None
+
+    def __getitem__(self, item: ProgramAddress) -> BytecodeItem:
+        ip = self.resolve(item)
+
+        if ip is None:
+            raise KeyError(item)
+
+        return self.program.items[ip]
 
     def decorate_exception(self, exc: CompilerException):
-        return exc.with_text(self.p_text).with_filename(self.p_filename)
\ No newline at end of file
+        return exc.with_text(self.p_text).with_filename(self.p_filename)
+
+
+class FileProgramPages(ProgramPages):
+    """
+    The program is read from a file, such as the one of `Settings.program`.
+    """
+
+    def __init__(self, filename: str, db, opcodes: OpcodeDefinition, cache: Optional[ProgramCache] = None,
+                 parser: Parser = Parser.PyParsing, optimize=False):
+        super().__init__(db, opcodes, cache, parser, optimize)
+        self.filename = filename
+
+    def source(self) -> Tuple[str, str]:
+        with open(self.filename) as f_in:
+            return self.filename, f_in.read()
@@ -1,27 +1,150 @@
-import json
-from typing import Dict, NamedTuple, List, Tuple, Optional
+import zlib
+from typing import Dict, NamedTuple, List, Tuple, Optional, Sequence
 from uuid import uuid4
 
 from etcd3 import Etcd3Client
+from etcd3.utils import increment_last_byte, to_bytes
 
 from tfci.db import ops
-from tfci.db.ops import Transaction
+from tfci.db.codec import BINARY, THREAD
+from tfci.db.ops import Transaction, Modify, Compare
 from tfci.db.mapper import NamedTupleEx, MapperBase
-from tfci_core.const import JOBS_STACK, JOBS_THREAD, JOBS_LOCK
+from tfci.dsl.struct import ProgramAddress, program_address
+from tfci_core.const import JOBS_STACK, JOBS_THREAD, JOBS_LOCK, JOBS_STACK_VAR, TXN_MAX_OPS, JOBS_SHARDS
 
 UNSET = object()
 
 
+def thread_shard(id: str, shards=JOBS_SHARDS) -> int:
+    return zlib.crc32(id.encode()) % shards
+
+
+def shard_prefix(shard: int) -> str:
+    return f'{shard:02x}/'
+
+
+class ShardedMapper(MapperBase):
+    """
+    Keys of the mapper are spread over the shards of `JOBS_SHARDS` by their ID, so that a worker may only watch the
+    prefixes of the shards it had been assigned.
+    """
+    key_fmt = '%s'
+
+    @classmethod
+    def key_fn(cls, id):
+        return cls.key_fmt % (shard_prefix(thread_shard(id)) + id,)
+
+    @classmethod
+    def key_fn_rev(cls, key):
+        shard, sep, id = key[len(cls.prefix()):].partition('/')
+
+        # the keys written before the sharding are flat, see `migrate`
+        return id if sep else shard
+
+    @classmethod
+    def prefix(cls, shard: Optional[int] = None) -> str:
+        return cls.key_fmt % ('' if shard is None else shard_prefix(shard),)
+
+    @classmethod
+    def migrate(cls, db: Etcd3Client) -> int:
+        """
+        Move the keys written before the sharding, as `<prefix><id>`, to the shards of their IDs, along with their leases.
+
+        :return: how many keys had been moved
+        """
+        prefix = cls.prefix()
+        r = 0
+
+        for v, v_m in db.get_prefix(prefix):
+            key = v_m.key.decode()
+
+            if '/' in key[len(prefix):]:
+                continue
+
+            ok, _ = db.transaction(
+                compare=[
+                    db.transactions.mod(key) == v_m.mod_revision,
+                    db.transactions.version(cls.key_fn(cls.key_fn_rev(key))) == 0,
+                ],
+                success=[
+                    db.transactions.put(cls.key_fn(cls.key_fn_rev(key)), v, lease=v_m.lease_id or None),
+                    db.transactions.delete(key),
+                ],
+                failure=[]
+            )
+
+            r += 1 if ok else 0
+
+        return r
+
+
+class StackVars(dict):
+    """
+    Variables of a stack frame that remember which of them had been changed since they were loaded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = set()
+        self.deleted = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed.discard(key)
+        self.deleted.add(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.changed.discard(key)
+            self.deleted.add(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.changed.discard(key)
+        self.deleted.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        self.changed.clear()
+        self.deleted.update(self.keys())
+        super().clear()
+
+    def snapshot(self):
+        return dict(self), set(self.changed), set(self.deleted)
+
+    def restore(self, snapshot):
+        vals, self.changed, self.deleted = snapshot
+        super().clear()
+        super().update(vals)
+
+
 class StackFrame(NamedTupleEx, MapperBase):
     id: str
     vals: Dict
     version: int
+    # every variable is stored under a key of its own, so that an update only writes the variables that changed
+    delta: bool
 
     @classmethod
-    def new(cls, id, vals=None):
+    def new(cls, id, vals=None, delta=False):
         if vals is None:
             vals = {}
-        return StackFrame(id, vals, -1)
+        return StackFrame(id, StackVars(vals), -1, delta)
 
     def get(self, item):
         return self.vals[item]
@@ -30,16 +153,134 @@ class StackFrame(NamedTupleEx, MapperBase):
         self.vals[key] = value
 
     def serialize(self):
-        return json.dumps(self.vals)
+        # the frame key of a delta frame only carries the version
+        return '' if self.delta else self.encode(self.vals)
 
     @classmethod
     def deserialize(cls, key, version, bts):
-        return StackFrame(key, json.loads(bts), int(version))
+        if len(bts) == 0:
+            return StackFrame(key, StackVars(), int(version), True)
+        else:
+            return StackFrame(key, StackVars(cls.decode(bts)), int(version), False)
+
+    @classmethod
+    def deserialize_range(cls, items, var_items=()):
+        r = super().deserialize_range(items)
+
+        if r is None or not r.delta:
+            return r
+
+        prefix = len(cls.var_key_fn(r.id, ''))
+
+        return StackFrame(
+            r.id,
+            StackVars({meta.key.decode()[prefix:]: cls.decode(v) for v, meta in var_items}),
+            r.version,
+            True
+        )
 
     @classmethod
     def key_fn(cls, id):
         return JOBS_STACK % (id,)
 
+    @classmethod
+    def var_key_fn(cls, id, name):
+        return JOBS_STACK_VAR % (id, name)
+
+    @classmethod
+    def var_range(cls, id) -> Tuple[bytes, bytes]:
+        prefix = to_bytes(cls.var_key_fn(id, ''))
+        return prefix, increment_last_byte(prefix)
+
+    def put_ops(self) -> List[Modify]:
+        """
+        :return: operations storing the frame; a delta frame that had been loaded only writes the changed variables
+        """
+        r = [ops.Put(self.key, self.serialize())]
+
+        if self.delta:
+            if self.version < 0 or not isinstance(self.vals, StackVars):
+                changed, deleted = self.vals.keys(), []
+            else:
+                changed, deleted = self.vals.changed, self.vals.deleted
+
+            r += [ops.Put(self.var_key_fn(self.id, k), self.encode(self.vals[k])) for k in sorted(changed)]
+            r += [ops.Delete(self.var_key_fn(self.id, k)) for k in sorted(deleted)]
+
+        return r
+
+    @classmethod
+    def delete_ops(cls, id) -> List[Modify]:
+        return [ops.Delete(cls.key_fn(id)), ops.Delete(*cls.var_range(id))]
+
+    def put(self):
+        return Transaction.new().success(
+            *((None, x) for x in self.put_ops())
+        )
+
+    @classmethod
+    def delete(cls, id) -> Transaction:
+        return cls.exists(id).success(
+            *((None, x) for x in cls.delete_ops(id))
+        )
+
+    @classmethod
+    def load(cls, id) -> Transaction:
+        return Transaction.new().success(
+            (cls, ops.Get(cls.key_fn(id))),
+            (ops.Join, ops.Get(*cls.var_range(id))),
+        )
+
+    @classmethod
+    def load_all(cls, db: Etcd3Client) -> Dict[str, 'StackFrame']:
+        r = super().load_all(db)
+
+        prefix = JOBS_STACK_VAR % ('', '')
+
+        for v, v_m in db.get_prefix(prefix):
+            id, name = v_m.key.decode()[len(prefix):].split('/', 1)
+
+            if id in r and r[id].delta:
+                dict.__setitem__(r[id].vals, name, cls.decode(v))
+
+        return r
+
+
+class StackFrames(Sequence):
+    """
+    Stack frames of a thread, the ones that had not been fetched along with the thread are loaded once referenced.
+    """
+
+    def __init__(self, db: Etcd3Client, sp: List[str], frames: List[Optional[StackFrame]]):
+        self.db = db
+        self.sp = sp
+        self.frames = list(frames) + [UNSET] * (len(sp) - len(frames))
+
+    def __len__(self):
+        return len(self.sp)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        r = self.frames[idx]
+
+        if r is UNSET:
+            idx = idx % len(self)
+
+            ok, (r,), _ = StackFrame.load(self.sp[idx]).exec(self.db)
+
+            self.frames[idx] = r
+
+        return r
+
+    @property
+    def loaded(self) -> List[Optional[StackFrame]]:
+        return [x for x in self.frames if x is not UNSET]
+
+    def __repr__(self):
+        return repr([x if x is not UNSET else '...' for x in self.frames])
+
 
 class FollowUp(NamedTuple):
     create_threads: List['ThreadContext']
@@ -57,54 +298,92 @@ class FollowUp(NamedTuple):
         )
 
 
-class ThreadContext(NamedTupleEx, MapperBase):
+class ThreadLock(NamedTupleEx, ShardedMapper):
     id: str
-    ip: str  # like: "/sys/eg:entrypoint"
+    ident: str
+    version: int
+
+    key_fmt = JOBS_LOCK
+
+    def serialize(self):
+        return self.ident
+
+    @classmethod
+    def deserialize(cls, key, version, bts):
+        return ThreadLock(key, bts.decode(), version)
+
+
+class ThreadContext(NamedTupleEx, ShardedMapper):
+    id: str
+    ip: ProgramAddress  # like: "/sys/eg:entrypoint" or a `ProgramOffset` into the bytecode
 
     # we could have instead a list of stack pointers.
     sp: List[str]
     version: int
 
     @classmethod
-    def new(cls, id: str, ip: str, sp=None):
+    def new(cls, id: str, ip: ProgramAddress, sp=None):
         if sp is None:
             sp = []
-        return ThreadContext(id, ip, sp, -1)
+        return ThreadContext(id, program_address(ip), sp, -1)
 
     def copy(self):
         return ThreadContext(uuid4().hex, self.ip, self.sp, self.version)
 
+    codecs = {BINARY.name: THREAD}
+    key_fmt = JOBS_THREAD
+
     def serialize(self):
-        return json.dumps([self.ip, self.sp])
+        return self.encode([self.ip, self.sp])
 
     @classmethod
     def deserialize(cls, key, version, bts):
-        return ThreadContext(key, *json.loads(bts), version)
+        ip, sp = cls.decode(bts)
 
-    @classmethod
-    def key_fn(self, id):
-        return JOBS_THREAD % (id,)
+        return ThreadContext(key, program_address(ip), sp, version)
 
     @property
     def lock_key(self):
-        return JOBS_LOCK % (self.id,)
-
-    def lock(self, db: Etcd3Client, lock_ident, lock_lease) -> Tuple[
-        bool, Optional['ThreadContext'], List[Optional[StackFrame]]]:
+        return ThreadLock.key_fn(self.id)
 
+    def lock_tx(self, lock_ident, lock_lease, levels: Optional[int] = None) -> Transaction:
         tx = Transaction.new().compare(
             ops.Version(self.lock_key) == 0,
             ops.Version(self.key) > 0
         ).success(
             (None, ops.Put(self.lock_key, lock_ident, lease=lock_lease)),
             (ThreadContext, ops.Get(self.key))
-        ).failure(
-            (ThreadContext, ops.Get(self.key))
         )
 
-        for x in self.sp:
+        for x in self.sp[:levels]:
             tx = tx.merge(StackFrame.load(x))
 
+        return tx
+
+    def lock_stack(self, db: Etcd3Client, item: 'ThreadContext', sfs: List[Optional[StackFrame]],
+                   levels: Optional[int] = None) -> StackFrames:
+        if self.sp != item.sp:
+            tx_other = self.exists(self.id)
+
+            for x in item.sp[:levels]:
+                tx_other = tx_other.merge(StackFrame.load(x))
+
+            ok, sfs, _ = tx_other.exec(db)
+
+            assert ok
+
+        return StackFrames(db, item.sp, sfs)
+
+    def lock(self, db: Etcd3Client, lock_ident, lock_lease, levels: Optional[int] = None) -> Tuple[
+        bool, Optional['ThreadContext'], StackFrames]:
+        """
+        :param levels: how many of the stack frames to fetch along with the lock, the rest are loaded on demand
+        """
+
+        tx = self.lock_tx(lock_ident, lock_lease, levels).failure(
+            (ThreadContext, ops.Get(self.key))
+        )
+
         ok: bool
         item: ThreadContext
         sfs: List[Optional[StackFrame]]
@@ -113,22 +392,123 @@ class ThreadContext(NamedTupleEx, MapperBase):
         ok, (item, *sfs), (item_nok,) = tx.exec(db)
 
         if not ok:
-            return False, item_nok, []
+            return False, item_nok, StackFrames(db, [], [])
+        else:
+            return ok, item, self.lock_stack(db, item, sfs, levels)
+
+    def reload(self, db: Etcd3Client, lock_ident, levels: Optional[int] = None) -> Tuple[
+        bool, Optional['ThreadContext'], StackFrames]:
+        """
+        Load a thread that is still locked by `lock_ident`, see `follow(release=False)`.
+        """
+
+        tx = Transaction.new().compare(
+            ops.Value(self.lock_key) == lock_ident,
+            ops.Version(self.key) > 0
+        ).success(
+            (ThreadContext, ops.Get(self.key))
+        )
+
+        for x in self.sp[:levels]:
+            tx = tx.merge(StackFrame.load(x))
+
+        ok, (item, *sfs), _ = tx.exec(db)
+
+        if not ok:
+            return False, None, StackFrames(db, [], [])
         else:
-            if self.sp != item.sp:
-                tx_other = self.exists(self.id)
+            return ok, item, self.lock_stack(db, item, sfs, levels)
+
+    @classmethod
+    def lock_many(
+        cls,
+        db: Etcd3Client,
+        threads: List['ThreadContext'],
+        lock_ident,
+        lock_lease,
+        levels: Optional[List[Optional[int]]] = None,
+        max_ops=TXN_MAX_OPS,
+    ) -> List[Tuple['ThreadContext', 'ThreadContext', StackFrames]]:
+        """
+        Lock as many of the threads as possible, within as few transactions as possible.
+
+        A transaction either locks all of the threads it covers or none of them, in the latter case the threads that
+        could be locked are retried in a single transaction and then by splitting them in halves.
+
+        :param levels: per thread, see `lock`
+        :param max_ops: the maximum number of operations in a single transaction
+        :return: the threads that had been locked, along with the thread as it is stored and its stack frames
+        """
+
+        if levels is None:
+            levels = [None] * len(threads)
+
+        r = []
+
+        chunk = []
+        chunk_ops = 0
+
+        for t, t_levels in zip(threads, levels):
+            t_ops = 2 + 2 * len(t.sp[:t_levels])
+
+            if len(chunk) and chunk_ops + t_ops > max_ops:
+                r += cls._lock_chunk(db, chunk, lock_ident, lock_lease)
+                chunk, chunk_ops = [], 0
+
+            chunk.append((t, t_levels))
+            chunk_ops += t_ops
+
+        if len(chunk):
+            r += cls._lock_chunk(db, chunk, lock_ident, lock_lease)
+
+        return r
+
+    @classmethod
+    def _lock_chunk(cls, db: Etcd3Client, chunk: List[Tuple['ThreadContext', Optional[int]]], lock_ident, lock_lease):
+        if len(chunk) == 0:
+            return []
+        elif len(chunk) == 1:
+            (t, t_levels), = chunk
+
+            ok, item, stack = t.lock(db, lock_ident, lock_lease, t_levels)
+
+            return [(t, item, stack)] if ok and item else []
+
+        tx = Transaction.new()
+
+        for t, t_levels in chunk:
+            tx = tx.merge(t.lock_tx(lock_ident, lock_lease, t_levels)).failure(
+                (ThreadContext, ops.Get(t.key)),
+                (ThreadLock, ops.Get(t.lock_key)),
+            )
+
+        ok, items, items_nok = tx.exec(db)
 
-                for x in item.sp:
-                    tx_other = tx_other.merge(StackFrame.load(x))
+        if ok:
+            r = []
 
-                ok, sfs, _ = tx_other.exec(db)
+            for t, t_levels in chunk:
+                n = 1 + len(t.sp[:t_levels])
+                (item, *sfs), items = items[:n], items[n:]
+                r.append((t, item, t.lock_stack(db, item, sfs, t_levels)))
 
-                assert ok
+            return r
 
-            return ok, item, sfs
+        free = [
+            x for x, item, lock in zip(chunk, items_nok[::2], items_nok[1::2]) if item is not None and lock is None
+        ]
 
-    def update(self, ip: str = UNSET, sp: List[str] = UNSET):
-        new_ip = self.ip if ip == UNSET else ip
+        if len(free) < len(chunk):
+            return cls._lock_chunk(db, free, lock_ident, lock_lease)
+        else:
+            # someone else had been faster, there's no telling which of the threads are still free
+            half = len(chunk) // 2
+            return cls._lock_chunk(db, chunk[:half], lock_ident, lock_lease) + \
+                cls._lock_chunk(db, chunk[half:], lock_ident, lock_lease)
+
+    def update(self, ip: ProgramAddress = UNSET, sp: List[str] = UNSET):
+        # the addresses may have been loaded from the stack frames
+        new_ip = self.ip if ip is UNSET else program_address(ip)
         new_sp = self.sp if sp == UNSET else sp
 
         return ThreadContext(self.id, new_ip, new_sp, self.version)
@@ -137,8 +517,30 @@ class ThreadContext(NamedTupleEx, MapperBase):
         self,
         db: Etcd3Client,
         lock_ident,
-        f: FollowUp
+        f: FollowUp,
+        release=True,
     ):
+        """
+        :param release: whether to delete the lock, otherwise it is kept until the thread halts, it is unlocked or the
+                        lease of the lock expires
+        """
+        compare, success, updated = self.follow_ops(db, lock_ident, f, release)
+
+        ok, _ = db.transaction(
+            compare=compare,
+            success=success,
+            failure=[]
+        )
+
+        return ok, updated
+
+    def follow_ops(
+        self,
+        db: Etcd3Client,
+        lock_ident,
+        f: FollowUp,
+        release=True,
+    ) -> Tuple[List[Compare], List[Modify], Optional['ThreadContext']]:
         updated = None
 
         if self.id in [x.id for x in f.create_threads]:
@@ -156,7 +558,7 @@ class ThreadContext(NamedTupleEx, MapperBase):
         # CREATE: THREAD
         success = [
             db.transactions.put(y.key, y.serialize()) for y in f.create_threads
-        ]
+        ]  # type: List[Modify]
 
         # UNLOCK
 
@@ -164,42 +566,96 @@ class ThreadContext(NamedTupleEx, MapperBase):
 
         # DELETE LOCK
 
-        success += [
-            db.transactions.delete(self.lock_key),
-        ]
+        success += [db.transactions.delete(self.lock_key)] if release or updated is None else []
 
         # UPDATE: STACK
         compare += [
             db.transactions.version(x.key) == x.version for x in f.update_stacks
         ]
 
-        success += [
-            db.transactions.put(x.key, x.serialize()) for x in f.update_stacks
-        ]
+        for x in f.update_stacks:
+            success += x.put_ops()
 
         # CREATE: STACK
-        success += [
-            db.transactions.put(x.key, x.serialize()) for x in f.create_stacks
-        ]
+        for x in f.create_stacks:
+            success += x.put_ops()
 
         # DELETE: STACK
         compare += [
             db.transactions.version(x.key) == x.version for x in f.delete_stacks
         ]
 
-        success += [
-            db.transactions.delete(x.key) for x in f.delete_stacks
-        ]
+        for x in f.delete_stacks:
+            success += x.delete_ops(x.id)
 
+        return compare, success, updated
 
+    @classmethod
+    def follow_many(
+        cls,
+        db: Etcd3Client,
+        lock_ident,
+        items: List[Tuple['ThreadContext', FollowUp]],
+        max_ops=TXN_MAX_OPS,
+        release=True,
+    ) -> Tuple[List[Tuple[bool, Optional['ThreadContext']]], int]:
+        """
+        Commit the follow-ups of many threads in as few transactions as possible, each of them still succeeds or fails
+        on its own.
+
+        A transaction holds the follow-ups that touch disjoint keys, if it fails its follow-ups are split in halves
+        until the ones that fail are committed on their own.
+
+        :return: the results of `follow` for every item and the number of transactions used
+        """
+        chunks = []
+
+        chunk, chunk_keys, chunk_ops = [], set(), 0
+
+        for t, f in items:
+            compare, success, updated = t.follow_ops(db, lock_ident, f, release)
+            # every change of a stack frame also writes the key of the frame itself
+            keys = {x.key for x in success}
+            t_ops = max(len(compare), len(success))
+
+            if len(chunk) and (chunk_ops + t_ops > max_ops or not chunk_keys.isdisjoint(keys)):
+                chunks.append(chunk)
+                chunk, chunk_keys, chunk_ops = [], set(), 0
+
+            chunk.append((compare, success, updated))
+            chunk_keys |= keys
+            chunk_ops += t_ops
+
+        if len(chunk):
+            chunks.append(chunk)
+
+        r = []
+        txs = 0
 
+        for chunk in chunks:
+            chunk_r, chunk_txs = cls._follow_chunk(db, chunk)
+            r += chunk_r
+            txs += chunk_txs
+
+        return r, txs
+
+    @classmethod
+    def _follow_chunk(cls, db: Etcd3Client, chunk: List[Tuple[List[Compare], List[Modify], Optional['ThreadContext']]]):
         ok, _ = db.transaction(
-            compare=compare,
-            success=success,
+            compare=[x for compare, _, _ in chunk for x in compare],
+            success=[x for _, success, _ in chunk for x in success],
             failure=[]
         )
 
-        return ok, updated
+        if ok or len(chunk) == 1:
+            return [(ok, updated) for _, _, updated in chunk], 1
+
+        half = len(chunk) // 2
+
+        a, a_txs = cls._follow_chunk(db, chunk[:half])
+        b, b_txs = cls._follow_chunk(db, chunk[half:])
+
+        return a + b, 1 + a_txs + b_txs
 
     def unlock(self, db: Etcd3Client, lock_ident):
         ok, _ = db.transaction(
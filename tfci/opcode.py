@@ -1,6 +1,7 @@
+import asyncio
 import inspect
 from pprint import pprint
-from typing import Union, Callable, List, Generic, TypeVar, Type
+from typing import Union, Callable, List, Generic, TypeVar, Type, Any, NamedTuple, Optional, Dict
 
 from tfci.dsl.ast import Constant, Identifier, Map, Command
 from tfci.dsl.exception import CompilerException
@@ -12,13 +13,17 @@ T = TypeVar('T')
 
 
 class OpArg(Generic[T]):
-    def __init__(self, ctx: ExecutionContext, arg: Union[Constant, Identifier]):
+    # the accessors built by `BoundArgs` are shared by every execution of an instruction, so they are not bound to a
+    # context: the opcodes pass theirs to `get` and `set`
+    __slots__ = ('ctx', 'arg')
+
+    def __init__(self, ctx: Optional[ExecutionContext], arg: Union[Constant, Identifier]):
         self.ctx = ctx
         self.arg = arg
 
-    def get(self) -> T:
+    def get(self, ctx: Optional[ExecutionContext] = None) -> T:
         if isinstance(self.arg, Identifier):
-            return self.ctx.stack_get(
+            return (self.ctx if ctx is None else ctx).stack_get(
                 self.arg.name,
                 self.arg.level
             )
@@ -27,30 +32,102 @@ class OpArg(Generic[T]):
         else:
             raise NotImplementedError(f'{self.arg}')
 
+    def bind(self, ctx: ExecutionContext) -> 'OpArg[T]':
+        return OpArg(ctx, self.arg)
+
+    def resolve(self, ctx: ExecutionContext) -> T:
+        return self.bind(ctx).get()
+
     @classmethod
     def map(cls, ctx, arg):
         if isinstance(arg, Identifier):
             return RefOpArg(ctx, arg)
         elif isinstance(arg, Constant):
-            return OpArg(ctx, arg)
+            return ConstOpArg(arg)
         else:
             raise NotImplementedError(f'{ctx} {arg}')
 
 
+class ConstOpArg(OpArg, Generic[T]):
+    # does not depend on the context, so the same instance is used by every execution of an instruction
+    __slots__ = ('value',)
+
+    def __init__(self, arg: Constant):
+        super().__init__(None, arg)
+        self.value = arg.value
+
+    def get(self, ctx: Optional[ExecutionContext] = None) -> T:
+        return self.value
+
+    def bind(self, ctx: ExecutionContext) -> 'ConstOpArg[T]':
+        return self
+
+    def resolve(self, ctx: ExecutionContext) -> T:
+        return self.value
+
+
 class RefOpArg(OpArg, Generic[T]):
-    def set(self, value: T):
-        assert not isinstance(self.arg, Constant), 'Cannot set a constant argument'
+    __slots__ = ('name', 'level')
 
-        self.ctx.stack_set(
-            value,
-            self.arg.name,
-            self.arg.level
-        )
+    def __init__(self, ctx: Optional[ExecutionContext], arg: Identifier):
+        super().__init__(ctx, arg)
+        self.name = arg.name
+        self.level = arg.level
+
+    def get(self, ctx: Optional[ExecutionContext] = None) -> T:
+        return (self.ctx if ctx is None else ctx).stack_get(self.name, self.level)
+
+    def set(self, value: T, ctx: Optional[ExecutionContext] = None):
+        (self.ctx if ctx is None else ctx).stack_set(value, self.name, self.level)
+
+    def bind(self, ctx: ExecutionContext) -> 'RefOpArg[T]':
+        return RefOpArg(ctx, self.arg)
+
+    def resolve(self, ctx: ExecutionContext) -> T:
+        return ctx.stack_get(self.name, self.level)
+
+
+class BoundArgs(NamedTuple):
+    # in the order of the instruction arguments, None for a map
+    items: List[Optional[OpArg]]
+    pos: List[OpArg]
+    kw: Dict[str, OpArg]
+
+    @classmethod
+    def new(cls, args: OpcodeArgs) -> 'BoundArgs':
+        items = []
+        pos = []
+        kw = {}
+
+        for arg in args:
+            if isinstance(arg, Identifier) or isinstance(arg, Constant):
+                x = OpArg.map(None, arg)
+                items.append(x)
+                pos.append(x)
+            elif isinstance(arg, Map):
+                items.append(None)
+                kw[arg.identifier.name] = OpArg.map(None, arg.to)
+            else:
+                raise NotImplementedError(f'{args}')
+
+        return BoundArgs(items, pos, kw)
 
 
 OpcodeFunction = Callable[[ExecutionContext], FollowUp]
 
 
+def run_sync(coro):
+    """
+    Run an `async def` opcode outside of an event loop, e.g. by the `ExecutionEngine`.
+    """
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 class opcode:
     def __init__(self, name, is_simple=True):
         assert not callable(name), 'Correct usage: @opcode(opcode_name), not @opcode'
@@ -66,6 +143,15 @@ class opcode:
 
 class OpcodeDef:
     name = None  # type: str
+    # the opcode only reads and changes the thread and its stacks, so it may be executed along with the instructions
+    # before it within the same lock of the thread
+    is_local = False
+    # how many stack frames the opcode uses regardless of its arguments
+    levels = 0
+    # the arguments are passed bound to the context of every execution, so that `get()` and `set(value)` work without
+    # the context; this allocates the accessors on every step, the in-tree opcodes call `get(ctx)` and `set(value, ctx)`
+    # on the shared ones instead
+    bind_args = False
 
     def __init__(self):
         assert self.name is not None, 'name attribute must be set'
@@ -76,32 +162,78 @@ class OpcodeDef:
     def check(self, c: Command):
         pass
 
+    def prepare(self, args: OpcodeArgs) -> Any:
+        """
+        Called once for every instruction of the opcode when a program is loaded.
+
+        :return: the value passed to the instruction as `ExecutionContext.prepared`
+        """
+        return None
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: the counters of the opcode published along with the statistics of the worker, or None if it has none
+        """
+        return None
+
     @classmethod
     def find_module(cls, mod) -> List[Type['OpcodeDef']]:
-        return [x for x in (getattr(mod, x) for x in dir(mod)) if inspect.isclass(x) and issubclass(x, OpcodeDef) and x != OpcodeDef]
+        return [x for x in (getattr(mod, x) for x in dir(mod)) if
+                inspect.isclass(x) and issubclass(x, OpcodeDef) and x.name is not None]
 
-    def __call__(self, ctx: ExecutionContext) -> FollowUp:
-        def map_args(args: OpcodeArgs):
-            pos = []
-            kw = {}
-            for i, arg in enumerate(args):
-                if isinstance(arg, Identifier) or isinstance(arg, Constant):
-                    pos.append(OpArg.map(ctx, arg))
-                elif isinstance(arg, Map):
-                    kw[arg.identifier.name] = OpArg.map(ctx, arg.to)
-                else:
-                    raise NotImplementedError(f'{args}')
-            return pos, kw
-
-        args, kwargs = map_args(ctx.args)
-
-        self.fn(ctx, *args, **kwargs)
+    def bind(self, args: OpcodeArgs) -> BoundArgs:
+        """
+        Called once for every instruction of the opcode when a program is loaded.
+
+        :return: the accessors of the arguments, passed to the instruction as `ExecutionContext.bound`
+        """
+        return BoundArgs.new(args)
+
+    @property
+    def is_async(self):
+        """
+        Whether `fn` is an `async def`, such opcodes are awaited by the `AsyncExecutionEngine` instead of being run in an
+        executor.
+        """
+        return inspect.iscoroutinefunction(self.fn)
 
+    def fn_args(self, ctx: ExecutionContext):
+        bound = ctx.bound
+
+        if bound is None:
+            bound = BoundArgs.new(ctx.args)
+
+        if self.bind_args:
+            return [ctx, *[x.bind(ctx) for x in bound.pos]], {k: v.bind(ctx) for k, v in bound.kw.items()}
+
+        return [ctx, *bound.pos], bound.kw
+
+    def follow_up(self, ctx: ExecutionContext) -> FollowUp:
         return FollowUp.new(
             create_threads=[ctx.thread.update(ip=ctx.nip)],
             update_stacks=[ctx.stack[x] for x in ctx.stacks_updated]
         )
 
+    def __call__(self, ctx: ExecutionContext) -> FollowUp:
+        if self.is_async:
+            return run_sync(self.call_async(ctx))
+
+        args, kwargs = self.fn_args(ctx)
+
+        self.fn(*args, **kwargs)
+
+        return self.follow_up(ctx)
+
+    async def call_async(self, ctx: ExecutionContext) -> FollowUp:
+        args, kwargs = self.fn_args(ctx)
+
+        r = self.fn(*args, **kwargs)
+
+        if inspect.isawaitable(r):
+            await r
+
+        return self.follow_up(ctx)
+
 
 class SysOpcodeDef(OpcodeDef):
     def __init__(self):
@@ -114,4 +246,15 @@ class SysOpcodeDef(OpcodeDef):
         pass
 
     def __call__(self, ctx: ExecutionContext) -> FollowUp:
+        if self.is_async:
+            return run_sync(self.call_async(ctx))
+
         return self.fn(ctx)
+
+    async def call_async(self, ctx: ExecutionContext) -> FollowUp:
+        r = self.fn(ctx)
+
+        if inspect.isawaitable(r):
+            r = await r
+
+        return r
@@ -1,14 +1,16 @@
 import logging
 from importlib import import_module
 import random
-from typing import List, Iterator, Tuple, AnyStr, Type
+from typing import List, Iterator, Tuple, AnyStr, Type, Optional
 
 import etcd3
 
 import tfci
 import tfci.opcode
 import tfci.daemon
-from tfci.dsm.rt import OpcodeDefinition
+from tfci.dsl.cache import ProgramCache
+from tfci.dsl.compiler import Parser
+from tfci.dsm.rt import OpcodeDefinition, ProgramPages, FileProgramPages
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +20,7 @@ class TFException(Exception):
 
 
 class Settings:
-    def __init__(self, plugins=None, etcd=None):
+    def __init__(self, plugins=None, etcd=None, cache=None, codec=None, program=None, parser=None, optimize=False):
         if plugins is None:
             plugins = []
 
@@ -27,6 +29,15 @@ class Settings:
         self.plugins = plugins  # type: List[tfci.plugin.Plugin]
         self.plugins_by_name = {x.name: x for x in self.plugins}
         self.etcd = etcd
+        self.cache = cache
+        # the name of the codec the values are written with, see :mod:`tfci.db.codec`
+        self.codec = codec
+        # the file of the program the threads are stepped through
+        self.program = program
+        # how the program is compiled: the name of its parser, see `tfci.dsl.compiler.Parser`, and whether to optimize
+        # its bytecode
+        self.parser = parser
+        self.optimize = optimize
 
     def setup_logging(self):
         import sys
@@ -42,6 +53,17 @@ class Settings:
 
         logger.setLevel(logging.DEBUG)
 
+    def setup_codec(self):
+        if self.codec is None:
+            return
+
+        from tfci.db.codec import codec_set
+
+        try:
+            codec_set(self.codec)
+        except KeyError as e:
+            raise TFException(str(e))
+
     @classmethod
     def from_module(cls, module):
         try:
@@ -83,10 +105,29 @@ class Settings:
                 if opcode.name in opcodes:
                     raise TFException(f'`{opcode.name}` is already defined in {opcodes[opcode.name]}')
 
-                opcodes[opcode.name] = opcode
+                opcodes[opcode.name] = opcode()
 
         return opcodes
 
+    def get_program_cache(self) -> Optional[ProgramCache]:
+        if self.cache is None:
+            return None
+        return ProgramCache(self.cache)
+
+    def get_program_pages(self, db, opcodes: OpcodeDefinition) -> ProgramPages:
+        if self.program is None:
+            raise TFException('No `program` is set')
+        return FileProgramPages(self.program, db, opcodes, self.get_program_cache(), self.get_parser(), self.optimize)
+
+    def get_parser(self) -> Parser:
+        if self.parser is None:
+            return Parser.PyParsing
+
+        try:
+            return Parser(self.parser)
+        except ValueError:
+            raise TFException(f'Unknown parser `{self.parser}`, one of: {", ".join(x.value for x in Parser)}')
+
     def get_logger(self):
         import logging
         return logging.getLogger()
@@ -96,6 +137,17 @@ class Settings:
 
         self.get_logger().getChild('db').debug(f'Selected {x}')
 
+        if 'mem' in x:
+            # an in-process store, only visible to the daemons running in this process
+            from tfci.db.mem import MemoryEtcd3Client
+
+            return MemoryEtcd3Client.instance(x['mem'])
+        elif 'sqlite' in x:
+            # a single-node store that may be shared by the processes of a single host
+            from tfci.db.sqlite import SQLiteEtcd3Client
+
+            return SQLiteEtcd3Client(x['sqlite'])
+
         kwargs = dict(
             host=x['h'],
             port=x['p'],
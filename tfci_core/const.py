@@ -3,4 +3,22 @@ PREFIX = '/jobs'
 JOBS_THREAD = f'{PREFIX}/thread/%s'
 JOBS_LOCK = f'{PREFIX}/lock/%s'
 JOBS_STACK = f'{PREFIX}/stack/%s'
+JOBS_STACK_VAR = f'{PREFIX}/stackvar/%s/%s'
+
+# threads and their locks are stored as `<prefix>/<shard>/<id>`, see `tfci.dsm.struct.thread_shard`
+JOBS_SHARDS = 16
+# the number of runnable threads of a shard, as seen by the worker it is assigned to
+JOBS_BACKLOG = f'{PREFIX}/backlog/%s'
+# the last scaling decision of the pool of a worker, by the ident of the worker
+JOBS_SCALE = f'{PREFIX}/scale/%s'
+# the counters of the steals of a worker, by the ident of the worker, see `WorkerDaemon.steal`
+JOBS_STEALS = f'{PREFIX}/steals/%s'
+# the statistics of the group commits of a process of the pool of a worker, by `<ident of the worker>/<process>`
+JOBS_COMMIT = f'{PREFIX}/commit/%s'
+# the counters of the opcodes of a process of the pool of a worker, by `<ident of the worker>/<process>`, see
+# `OpcodeDef.stats`
+JOBS_OPCODES = f'{PREFIX}/opcodes/%s'
+
+# the default `--max-txn-ops` of etcd, the limit applies to each of the compare, success and failure lists
+TXN_MAX_OPS = 128
 
@@ -1,11 +1,16 @@
 import base64
 import logging
+import math
 import multiprocessing
 import multiprocessing.connection
+import os
 import pickle
+import queue
 import setproctitle
 import signal
 import subprocess
+import threading
+import time
 import typing
 from enum import Enum
 from uuid import uuid4
@@ -21,7 +26,60 @@ def argv_decode(x):
     return pickle.loads(base64.b64decode(x))
 
 
-def task_process_pool_process(ident, addr, cls, cls_args):
+class TaskCodec:
+    """
+    The wire format of the tasks sent to the processes of a pool and of their results. Every frame holds a batch of
+    either, an empty frame asks a process to exit.
+    """
+
+    def encode_tasks(self, items: typing.List[typing.Tuple[str, typing.Any]]) -> bytes:
+        raise NotImplementedError('')
+
+    def decode_tasks(self, bts: bytes) -> typing.List[typing.Tuple[str, typing.Any]]:
+        raise NotImplementedError('')
+
+    def encode_results(self, items: typing.List[typing.Tuple[str, bool, typing.Any]]) -> bytes:
+        """
+        :param items: `(task_id, True, returned)` or `(task_id, False, exception)`
+        """
+        raise NotImplementedError('')
+
+    def decode_results(self, bts: bytes) -> typing.List[typing.Tuple[str, bool, typing.Any]]:
+        raise NotImplementedError('')
+
+
+class PickleTaskCodec(TaskCodec):
+    def encode_tasks(self, items):
+        return pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+
+    def decode_tasks(self, bts):
+        return pickle.loads(bts)
+
+    def encode_results(self, items):
+        try:
+            return pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # logger.exception('Could not serialize exception')
+            items = [(task_id, ok, rtn if ok or self._picklable(rtn) else None) for task_id, ok, rtn in items]
+            return pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _picklable(x):
+        try:
+            pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        else:
+            return True
+
+    def decode_results(self, bts):
+        return pickle.loads(bts)
+
+
+PICKLE = PickleTaskCodec()
+
+
+def task_process_pool_process(ident, addr, cls, cls_args, window='1', codec=None):
     running = True
 
     def stop(*args):
@@ -29,37 +87,91 @@ def task_process_pool_process(ident, addr, cls, cls_args):
         running = False
 
     with multiprocessing.connection.Client(addr, family='AF_UNIX') as c:
+        # the processes connect in any order
+        c.send(ident)
+
         # signal.signal(signal.SIGINT, stop)
         setproctitle.setproctitle(f'pool-{ident}')
 
         cls = argv_decode(cls)
         cls_args = argv_decode(cls_args)
+        codec = PICKLE if codec is None else argv_decode(codec)  # type: TaskCodec
 
-        singleton = cls(ident, *cls_args)
+        # every task in flight, or every frame of them if the instances are `batched`, is executed by an instance of its
+        # own, on a thread of its own
+        singletons = [cls(ident, *cls_args) for _ in range(int(window))]
 
-        singleton.startup()
-        try:
-            while running:
-                (task_id, task) = c.recv()
+        for singleton in singletons:
+            singleton.startup()
+
+        tasks = queue.Queue()
+        results = queue.Queue()
+
+        def send(items):
+            # a single instance has nothing to batch its results with
+            if len(singletons) == 1:
+                c.send_bytes(codec.encode_results(items))
+            else:
+                for x in items:
+                    results.put(x)
+
+        def send_many():
+            while True:
+                # the results of the tasks that had finished meanwhile are sent in a single frame
+                items = [results.get()]
+
+                while True:
+                    try:
+                        items.append(results.get_nowait())
+                    except queue.Empty:
+                        break
+
+                c.send_bytes(codec.encode_results(items))
+
+        def execute(singleton):
+            while True:
+                items = tasks.get()
 
                 try:
-                    rtn = singleton(task_id, task)
+                    r = singleton.call_many(items)
                 except Exception as e:
                     logger.exception(f'Error happened {e}')
-                    try:
-                        c.send((task_id, False, e))
-                    except:
-                        # logger.exception('Could not serialize exception')
-                        c.send((task_id, False, None))
+                    r = [(task_id, False, e) for task_id, _ in items]
+
+                send(r)
+
+        for x in singletons:
+            threading.Thread(target=execute, args=(x,), daemon=True).start()
+
+        if len(singletons) > 1:
+            threading.Thread(target=send_many, daemon=True).start()
+
+        try:
+            while running:
+                bts = c.recv_bytes()
+
+                # the process is retired, it is idle by then
+                if not bts:
+                    break
+
+                items = codec.decode_tasks(bts)
+
+                if cls.batched:
+                    tasks.put(items)
                 else:
-                    c.send((task_id, True, rtn))
-        except KeyboardInterrupt:
+                    for x in items:
+                        tasks.put([x])
+        except (KeyboardInterrupt, EOFError):
             pass
         except:
             logger.exception('')
 
 
 class WorkerInstance:
+    # the tasks of a frame are handed to a single instance at once, see `call_many`, rather than spread over the
+    # instances of the window
+    batched = False
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -69,72 +181,361 @@ class WorkerInstance:
     def __call__(self, task_id, payload):
         pass
 
+    def call_many(self, items: typing.List[typing.Tuple[str, typing.Any]]) -> typing.List[
+        typing.Tuple[str, bool, typing.Any]]:
+        """
+        :return: the identifier of every task, whether it succeeded and its result or the exception it raised
+        """
+        r = []
+
+        for task_id, payload in items:
+            try:
+                r.append((task_id, True, self(task_id, payload)))
+            except Exception as e:
+                logger.exception(f'Error happened {e}')
+                r.append((task_id, False, e))
+
+        return r
+
+
+class ForkedProcess:
+    """
+    The subset of `subprocess.Popen` used by the pool, for a `multiprocessing.Process`.
+    """
+
+    def __init__(self, p: multiprocessing.Process):
+        self.p = p
+
+    @property
+    def pid(self):
+        return self.p.pid
+
+    def terminate(self):
+        self.p.terminate()
+
+    def kill(self):
+        # the process is a child of the fork server, which may have reaped it already
+        try:
+            os.kill(self.p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def poll(self):
+        return self.p.exitcode
+
+    def wait(self):
+        self.p.join()
+        return self.p.exitcode
+
 
 class TaskProcessRecord:
-    def __init__(self, q: multiprocessing.connection.Connection, p: subprocess.Popen):
+    def __init__(self, q: multiprocessing.connection.Connection, p: typing.Union[subprocess.Popen, ForkedProcess]):
         self.queue = q
         self.process = p
         self.is_dead = False
 
-    def recv(self):
+    def recv(self) -> typing.Optional[bytes]:
         try:
-            return self.queue.recv()
-        except EOFError:
+            return self.queue.recv_bytes()
+        except (EOFError, ConnectionError):
             self.is_dead = True
 
-    def send(self, item: typing.Any):
+    def send(self, bts: bytes):
         try:
-            self.queue.send(item)
-        except BrokenPipeError:
+            self.queue.send_bytes(bts)
+        except ConnectionError:
             self.is_dead = True
 
 
+class TaskLost(Exception):
+    """
+    The process of the task had exited or had been killed for exceeding the deadline, before the task had finished.
+    """
+
+    def __init__(self, task_id, reason):
+        super().__init__(task_id, reason)
+        self.task_id = task_id
+        self.reason = reason
+
+
 class PoolEvent(Enum):
     ProcessStarted = 'PROCESS_STARTED'
     TaskFinished = 'TASK_FINISHED'
 
 
 class TaskProcessPool:
-    def __init__(self, parallel, cls: typing.Type[WorkerInstance], cls_args):
+    """
+    :param window: how many tasks each of the processes executes concurrently
+    :param preload: the modules to import once into a fork server, the processes are then forked from it instead of
+                    being started from scratch
+    :param deadline: for how long (in seconds) a task may be executed before its process is considered hung, None
+                     lets the tasks run for as long as they take
+    :param codec: the wire format of the tasks and of their results, the tasks assigned are sent in batches by
+                  `poll_many`
+    :param restart_backoff: for how long (in seconds) no process is started after one had exited before it connected,
+                            doubled by every such exit in a row up to `restart_backoff_max`
+    """
+
+    def __init__(self, parallel, cls: typing.Type[WorkerInstance], cls_args, window=1,
+                 preload: typing.Optional[typing.List[str]] = None, deadline: typing.Optional[float] = None,
+                 codec: TaskCodec = PICKLE, restart_backoff=1., restart_backoff_max=60.):
         self.listener = multiprocessing.connection.Listener(family='AF_UNIX')
+        self.closed = False
 
         self.parallel = parallel
+        self.window = window
         self.cls = cls
         self.cls_args = cls_args
+        self.deadline = deadline
+        self.codec = codec
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+
+        self.context = None
+
+        if preload is not None:
+            self.context = multiprocessing.get_context('forkserver')
+            self.context.set_forkserver_preload([__name__, cls.__module__] + preload)
+
+        # how long it took every process to start up and connect
+        self.start_times = []  # type: typing.List[float]
+
+        # the processes that had been started, but had not connected yet
+        self.starting = {}  # type: typing.Dict[str, typing.Tuple[typing.Any, float]]
+        # the connections accepted by the thread of the listener, by the ident of their process
+        self.accepted = {}  # type: typing.Dict[str, multiprocessing.connection.Connection]
+        self.accepted_cond = threading.Condition()
+        self.accepted_recv, self.accepted_send = multiprocessing.Pipe(duplex=False)
 
         self.processes = {}  # type: typing.Dict[int, TaskProcessRecord]
-        self.free = []
+        # the processes that had been asked to exit, until they do
+        self.retired = []  # type: typing.List[TaskProcessRecord]
+        # the number of tasks in flight, per process
+        self.load = {}  # type: typing.Dict[str, int]
         self.assigned = {}
+        self.assigned_time = {}  # type: typing.Dict[str, float]
+        # the tasks assigned, but not sent yet, per process
+        self.outbox = {}  # type: typing.Dict[str, typing.List[typing.Tuple[str, typing.Any]]]
+        # the results received, but not returned yet, see `poll`
+        self.received = []  # type: typing.List[typing.Tuple[str, bool, typing.Any]]
+        # the moving average of the time it takes to execute a task
+        self.latency = 0.
+        # the processes replaced, by the reason
+        self.lost = {'exited': 0, 'hung': 0, 'start': 0}
+        # the processes that exited before they connected since one last did, and until when none is started because
+        # of them
+        self.start_failures = 0
+        self.start_after = 0.
+
+        self.acceptor = threading.Thread(target=self.accept, name=f'{self.__class__.__name__}.accept', daemon=True)
+        self.acceptor.start()
 
         for x in range(self.parallel):
-            self.process_start()
-
-    def process_start(self):
+            self.process_start(wait=False)
+
+        self.wait_started()
+
+    def accept(self):
+        while True:
+            try:
+                q = self.listener.accept()
+                ident = q.recv()
+            except (OSError, EOFError):
+                if self.closed:
+                    return
+                logger.exception('While accepting a process')
+                continue
+
+            # see `close`
+            if ident is None:
+                return
+
+            with self.accepted_cond:
+                self.accepted[ident] = q
+                self.accepted_cond.notify_all()
+
+            self.accepted_send.send_bytes(b'')
+
+    def process_start(self, wait=True):
+        """
+        :param wait: until the process connects, otherwise it is added to the pool by `poll_many` once it does
+        """
         ident = uuid4().hex
         import sys
 
         args = [
-            sys.executable,
-            '-m',
-            __name__,
             ident,
             self.listener.address,
             argv_encode(self.cls),
-            argv_encode(self.cls_args)
+            argv_encode(self.cls_args),
+            str(self.window),
+            argv_encode(self.codec),
         ]
 
-        # p = subprocess.Popen(args, stdout=sys.stdout, stderr=sys.stderr)
-        p = subprocess.Popen(args)
-        q = self.listener.accept()
+        t = time.monotonic()
+
+        if self.context is None:
+            # p = subprocess.Popen(args, stdout=sys.stdout, stderr=sys.stderr)
+            p = subprocess.Popen([sys.executable, '-m', __name__] + args)
+        else:
+            p = ForkedProcess(self.context.Process(target=task_process_pool_process, args=args))
+            p.p.start()
 
-        logger.debug(f'Process started: {ident}')
+        self.starting[ident] = (p, t)
 
-        self.processes[ident] = TaskProcessRecord(q, p)
-        self.free.append(ident)
+        if wait:
+            self.process_wait(ident)
+
+        return ident
+
+    def process_wait(self, ident):
+        with self.accepted_cond:
+            while ident not in self.accepted:
+                if self.starting[ident][0].poll() is not None:
+                    raise RuntimeError(f'Process exited before it connected: {ident}')
+
+                self.accepted_cond.wait(0.1)
+
+        self.started()
+
+    def wait_started(self):
+        for x in list(self.starting):
+            if x in self.starting:
+                self.process_wait(x)
+
+    def started(self):
+        with self.accepted_cond:
+            accepted, self.accepted = self.accepted, {}
+
+        for ident, q in accepted.items():
+            if ident not in self.starting:
+                q.close()
+                continue
+
+            p, t = self.starting.pop(ident)
+
+            self.start_times.append(time.monotonic() - t)
+
+            logger.debug(f'Process started: {ident} in {self.start_times[-1]:.3f}s')
+
+            self.processes[ident] = TaskProcessRecord(q, p)
+            self.load[ident] = 0
+
+            self.start_failures = 0
 
     @property
     def available(self):
-        return len(self.free)
+        return sum(self.window - x for x in self.load.values())
+
+    @property
+    def capacity(self):
+        return len(self.processes) * self.window
+
+    @property
+    def busy(self):
+        return len(self.assigned)
+
+    def resize(self, parallel) -> int:
+        """
+        Start or retire processes until there are `parallel` of them. The processes started are added to the pool once
+        they connect. Only the idle processes are retired, so the pool may stay larger than asked for. While the starts
+        are backed off, see `supervise`, the processes missing are started by it later on.
+
+        :return: the number of processes, including the ones starting or to be started
+        """
+        self.reap()
+
+        while len(self.processes) + len(self.starting) < parallel and time.monotonic() >= self.start_after:
+            self.process_start(wait=False)
+
+        idle = [k for k, v in self.load.items() if v == 0][:len(self.processes) + len(self.starting) - parallel]
+
+        for x in idle:
+            self.process_retire(x)
+
+        self.parallel = max(parallel, len(self.processes) + len(self.starting))
+
+        return self.parallel
+
+    def process_retire(self, proc_id):
+        assert self.load[proc_id] == 0, f"Must be idle: ProcID={proc_id}"
+
+        logger.debug(f'Process retired: {proc_id}')
+
+        x = self.processes.pop(proc_id)
+        del self.load[proc_id]
+
+        x.send(b'')
+        x.queue.close()
+
+        self.retired.append(x)
+
+    def reap(self):
+        self.retired = [x for x in self.retired if x.process.poll() is None]
+
+    def supervise(self) -> typing.List[typing.Tuple[str, bool, typing.Any]]:
+        """
+        Replace the processes that had exited, or had been executing a task for longer than the deadline. After a
+        process exits before it connects, e.g. because it can not start at all, the next one is started only after an
+        exponential backoff.
+
+        :return: the tasks of the processes replaced, failed with `TaskLost`
+        """
+        self.reap()
+        self.started()
+
+        now = time.monotonic()
+
+        hung = set()
+
+        if self.deadline:
+            hung = {self.assigned[k] for k, t in self.assigned_time.items() if now - t > self.deadline}
+
+        r = []
+
+        for proc_id, x in list(self.processes.items()):
+            if proc_id in hung:
+                reason = 'hung'
+            elif x.is_dead or x.process.poll() is not None:
+                reason = 'exited'
+            else:
+                continue
+
+            tasks = [k for k, v in self.assigned.items() if v == proc_id]
+
+            logger.warning(f'Process {reason}: {proc_id}, replacing it and failing {tasks}')
+
+            for k in tasks:
+                self.resign(k)
+                r.append((k, False, TaskLost(k, reason)))
+
+            self.lost[reason] += 1
+
+            x.queue.close()
+            x.process.kill()
+
+            del self.processes[proc_id]
+            del self.load[proc_id]
+
+            self.retired.append(x)
+
+        for ident, (p, _) in list(self.starting.items()):
+            if p.poll() is not None:
+                self.lost['start'] += 1
+                self.start_failures += 1
+
+                delay = min(self.restart_backoff_max, self.restart_backoff * 2 ** (self.start_failures - 1))
+                self.start_after = max(self.start_after, now + delay)
+
+                logger.error(f'Process exited before it connected: {ident}, starting the next one in {delay:.1f}s')
+
+                del self.starting[ident]
+
+        # the capacity is kept, without waiting for the replacements
+        while len(self.processes) + len(self.starting) < self.parallel and now >= self.start_after:
+            self.process_start(wait=False)
+
+        return r
 
     def __contains__(self, item):
         return item in self.assigned
@@ -142,64 +543,245 @@ class TaskProcessPool:
     def assign(self, task_id, task):
         assert self.available > 0, "Must be available"
 
-        proc_id = self.free.pop()
+        # the least loaded process
+        proc_id = min(self.load, key=self.load.get)
+        self.load[proc_id] += 1
 
         logger.info(f'Assigning {task_id}: {list(self.assigned.keys())}')
 
         self.assigned[task_id] = proc_id
-        self.processes[proc_id].send((task_id, task))
+        self.assigned_time[task_id] = time.monotonic()
+        self.outbox.setdefault(proc_id, []).append((task_id, task))
+
+    def flush(self):
+        """
+        Send the tasks assigned since the last time, a single frame per process.
+        """
+        outbox, self.outbox = self.outbox, {}
+
+        for proc_id, items in outbox.items():
+            if proc_id in self.processes:
+                self.processes[proc_id].send(self.codec.encode_tasks(items))
 
     def resign(self, task_id):
         assert task_id in self.assigned, f"Must be assigned: TaskID={task_id}"
 
         proc_id = self.assigned[task_id]
         del self.assigned[task_id]
-        self.free.append(proc_id)
+        del self.assigned_time[task_id]
+        self.load[proc_id] -= 1
         return proc_id
 
+    def latency_update(self, task_id):
+        x = time.monotonic() - self.assigned_time[task_id]
+        self.latency = x if not self.latency else 0.8 * self.latency + 0.2 * x
+
     def cancel(self, task_id):
+        """
+        Terminates the process of the task, along with the rest of the tasks it had in flight.
+        """
         proc_id = self.resign(task_id)
 
+        for x in [k for k, v in self.assigned.items() if v == proc_id]:
+            self.resign(x)
+
         self.processes[proc_id].process.terminate()
-        del self.processes[proc_id]
+        self.retired.append(self.processes.pop(proc_id))
+        del self.load[proc_id]
         self.process_start()
 
     def poll(self, timeout=5):
+        if not self.received:
+            self.received = self.poll_many(timeout)
+
+        if not self.received:
+            return None
+
+        return self.received.pop(0)
+
+    def poll_many(self, timeout=5, others=()) -> typing.List[typing.Tuple[str, bool, typing.Any]]:
+        """
+        Wait for the results of the tasks along with any of `others` being ready.
+
+        :param others: connections to wait for besides the ones of the processes, they are not read from
+        :return: the results of every task that had finished, along with the ones lost, see `supervise`
+        """
+        r, self.received = self.received, []
+
+        self.flush()
+
         map = {x.queue: x for k, x in self.processes.items()}
 
-        items = multiprocessing.connection.wait(list(map.keys()), timeout=timeout)
+        # wakes up by the time the oldest of the tasks exceeds the deadline
+        if self.deadline and self.assigned_time:
+            timeout = max(0., min(timeout, min(self.assigned_time.values()) + self.deadline - time.monotonic()))
 
-        items = [map[x] for x in items]
+        # and by the time the processes missing may be started
+        if len(self.processes) + len(self.starting) < self.parallel:
+            timeout = max(0., min(timeout, self.start_after - time.monotonic()))
 
-        if len(items) == 0:
-            return None
+        items = multiprocessing.connection.wait(
+            list(map.keys()) + [self.accepted_recv] + list(others),
+            timeout=timeout
+        )
 
-        x, *items = items
+        # the processes that connected are added by `supervise`
+        while self.accepted_recv.poll():
+            self.accepted_recv.recv_bytes()
 
-        x = x.recv()
+        for x in items:
+            if x not in map:
+                continue
 
-        if x is None:
-            return None
+            # a process with a window may have sent several frames
+            while True:
+                bts = map[x].recv()
 
-        task_id, ok, task_rtn = x
+                if bts is None:
+                    break
 
-        proc_id = self.resign(task_id)
+                for task_id, ok, task_rtn in self.codec.decode_results(bts):
+                    self.latency_update(task_id)
+                    self.resign(task_id)
+
+                    r.append((task_id, ok, task_rtn))
+
+                if not x.poll():
+                    break
+
+        return r + self.supervise()
 
-        return task_id, ok, task_rtn
+    def stats(self):
+        return {
+            'started': len(self.start_times),
+            'start_time_avg': sum(self.start_times) / len(self.start_times) if self.start_times else 0.,
+            'start_time_max': max(self.start_times, default=0.),
+            'start_time_last': self.start_times[-1] if self.start_times else 0.,
+            'processes': len(self.processes),
+            'starting': len(self.starting),
+            'retired': len(self.retired),
+            'lost': dict(self.lost),
+            'start_failures': self.start_failures,
+            'latency': self.latency,
+        }
 
     def close(self):
         for x in self.processes.values():
             logger.info(f'Killing {x.process.pid}')
             x.queue.close()
             x.process.kill()
-        for x in self.processes.values():
-            logger.info(f'Waiting {x.process.pid}')
-            x.process.wait()
+        others = [x.process for x in self.retired] + [p for p, _ in self.starting.values()]
+        for x in others:
+            x.kill()
+        for x in [x.process for x in self.processes.values()] + others:
+            logger.info(f'Waiting {x.pid}')
+            x.wait()
         logger.info(f'All processes are clean now')
+
+        # wakes the thread of the listener up
+        self.closed = True
+
+        with multiprocessing.connection.Client(self.listener.address, family='AF_UNIX') as c:
+            c.send(None)
+
+        self.acceptor.join()
+
         self.listener.close()
         logger.info(f'Listener closed as well')
 
 
+
+class ScaleDecision(typing.NamedTuple):
+    processes: int
+    # the number of processes the pool is resized to
+    target: int
+    reason: str
+    # the average ratio of the busy slots of the pool over the interval
+    busy: float
+    backlog: int
+    latency: float
+
+
+class PoolScaler:
+    """
+    Sizes a pool between `min` and `max` processes from the backlog of the tasks, the ratio of the busy slots and the
+    latency of the tasks.
+
+    The pool grows as soon as it is saturated and holds fewer slots than it takes to execute the tasks in flight and
+    the backlog within an `interval`. It shrinks only after it had been busy for less than `low` of its slots without
+    a backlog for `idle` intervals in a row, so that it does not flap between the sizes.
+    """
+
+    def __init__(self, min, max, window=1, interval=5., high=0.8, low=0.3, idle=3):
+        assert 0 < min <= max, f"Must be 0 < {min} <= {max}"
+
+        self.min = min
+        self.max = max
+        self.window = window
+        self.interval = interval
+        self.high = high
+        self.low = low
+        self.idle = idle
+
+        self.last = time.monotonic()
+        self.busy_sum = 0.
+        self.busy_samples = 0
+        self.idle_intervals = 0
+
+        self.ups = 0
+        self.downs = 0
+
+    def sample(self, busy, capacity):
+        self.busy_sum += busy / capacity if capacity else 1.
+        self.busy_samples += 1
+
+    def decide(self, processes, backlog, latency, now=None) -> typing.Optional[ScaleDecision]:
+        """
+        :param latency: the average time it takes to execute a task, 0 if it is not known yet
+        :return: None until an `interval` had passed since the last decision
+        """
+        now = time.monotonic() if now is None else now
+
+        if now - self.last < self.interval:
+            return None
+
+        self.last = now
+
+        busy = self.busy_sum / self.busy_samples if self.busy_samples else 0.
+        self.busy_sum = 0.
+        self.busy_samples = 0
+
+        # a task of the backlog occupies a slot for a part of the interval, or the whole of it while the latency is
+        # not known
+        share = min(1., latency / self.interval) if latency else 1.
+        needed = busy * processes * self.window + backlog * share
+
+        target = min(self.max, max(self.min, math.ceil(needed / self.window)))
+
+        idle = target < processes and busy <= self.low and backlog == 0
+
+        self.idle_intervals = self.idle_intervals + 1 if idle else 0
+
+        if processes < self.min:
+            target, reason = self.min, 'min'
+        elif processes > self.max:
+            target, reason = self.max, 'max'
+        elif target > processes and busy >= self.high:
+            reason = 'backlog'
+        elif idle and self.idle_intervals >= self.idle:
+            reason = 'idle'
+            self.idle_intervals = 0
+        else:
+            target, reason = processes, 'hold'
+
+        if target > processes:
+            self.ups += 1
+        elif target < processes:
+            self.downs += 1
+
+        return ScaleDecision(processes, target, reason, busy, backlog, latency)
+
+
 if __name__ == '__main__':
     import sys
 
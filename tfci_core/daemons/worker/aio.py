@@ -0,0 +1,150 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Callable, List, Any
+
+from tfci.dsm.struct import ThreadContext, FollowUp, StackFrames
+from tfci_core.daemons.worker.worker import ExecutionEngine, StolenThread
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncExecutionEngine(ExecutionEngine):
+    """
+    Steps many threads concurrently on an event loop. Everything that may block, the transactions, the loading of the
+    frames and the opcodes that are not `async def`, is run in `executor`; the `async def` opcodes (e.g. `sleep`) are
+    awaited on the loop.
+    """
+
+    def __init__(self, *args, executor: Optional[ThreadPoolExecutor] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = executor
+
+    async def run_sync(self, fn, *args, **kwargs):
+        # `get_running_loop` is not there before 3.7, from a coroutine `get_event_loop` returns the running loop too
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def step_async(self, thread_orig: ThreadContext, stolen=False) -> Tuple[bool, Optional[ThreadContext]]:
+        """
+        Same as `step`.
+        """
+        ok, thread, stack = await self.run_sync(self.acquire, thread_orig, stolen)
+
+        ok, f = await self.execute_async(thread_orig, ok, thread, stack)
+
+        return await self.run_sync(self.commit, thread_orig, ok, f, release=True if stolen else None)
+
+    async def execute_async(self, thread_orig: ThreadContext, ok: bool, thread: Optional[ThreadContext],
+                            stack: StackFrames) -> Tuple[bool, Optional[FollowUp]]:
+        if not ok or not thread or thread.ip not in self.pages or not self.pages.opcode(self.pages[thread.ip]).is_async:
+            return await self.run_sync(self.execute, thread_orig, ok, thread, stack)
+
+        try:
+            # the frames may still be loaded from the database
+            opcode, ctx = await self.run_sync(self.execute_context, thread_orig, ok, thread, stack)
+
+            f = await opcode.call_async(ctx)
+        except BaseException as e:
+            return await self.run_sync(self.execute_raised, e, thread_orig, thread, stack)
+
+        if self.max_steps > 1:
+            f = await self.run_sync(self.proceed, f, thread, stack)
+
+        return True, f
+
+    def execute_raised(self, e: BaseException, thread_orig: ThreadContext, thread: Optional[ThreadContext],
+                       stack: StackFrames) -> Tuple[bool, Optional[FollowUp]]:
+        """
+        Same as `execute_failed`, but `e` is raised again so that it is being handled by the thread that calls it.
+        """
+        try:
+            raise e
+        except BaseException:
+            return self.execute_failed(e, thread_orig, thread, stack)
+
+
+class AsyncTaskPool:
+    """
+    Same interface as `TaskProcessPool`, but a task is a step of a thread by an `AsyncExecutionEngine`, running on an
+    event loop of a thread of the daemon itself.
+
+    :param concurrency: how many steps may be in flight at once
+    :param engine_fn: creates the engine given the executor of its synchronous calls
+    """
+
+    def __init__(self, concurrency, engine_fn: Callable[[ThreadPoolExecutor], AsyncExecutionEngine],
+                 executor_size=None):
+        self.concurrency = concurrency
+        self.assigned = set()
+
+        self.results = queue.Queue()
+        self.results_recv, self.results_send = multiprocessing.Pipe(duplex=False)
+
+        self.executor = ThreadPoolExecutor(executor_size or concurrency)
+        self.engine = engine_fn(self.executor)
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=f'{self.__class__.__name__}.loop',
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def available(self):
+        return self.concurrency - len(self.assigned)
+
+    def __contains__(self, item):
+        return item in self.assigned
+
+    def assign(self, task_id, task):
+        assert self.available > 0, "Must be available"
+
+        self.assigned.add(task_id)
+
+        asyncio.run_coroutine_threadsafe(self.execute(task_id, task), self.loop)
+
+    async def execute(self, task_id, task):
+        try:
+            if isinstance(task, StolenThread):
+                r = await self.engine.step_async(task.thread, stolen=True)
+            else:
+                r = await self.engine.step_async(task)
+        except Exception as e:
+            logger.exception(f'Error happened {e}')
+            self.results.put((task_id, False, e))
+        else:
+            self.results.put((task_id, True, r))
+
+        self.results_send.send_bytes(b'')
+
+    def poll_many(self, timeout=5, others=()) -> List[Tuple[str, bool, Any]]:
+        multiprocessing.connection.wait([self.results_recv] + list(others), timeout=timeout)
+
+        # every result is queued before its wake up is sent
+        while self.results_recv.poll():
+            self.results_recv.recv_bytes()
+
+        r = []
+
+        while True:
+            try:
+                x = self.results.get_nowait()
+            except queue.Empty:
+                break
+
+            self.assigned.discard(x[0])
+            r.append(x)
+
+        return r
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
@@ -1,41 +1,96 @@
+import hashlib
+import json
 import logging
 import multiprocessing
 import queue
 import signal
+import threading
+import time
 from argparse import ArgumentParser
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, Iterable, List, Union
 from uuid import uuid4
 
 from etcd3.events import DeleteEvent, PutEvent
 
 from tfci.daemon import Daemon
-from tfci_core.daemons.worker.worker import ThreadExecutorInstance
-from tfci_core.const import JOBS_THREAD, JOBS_LOCK
-from tfci.db.db_util import watch_range
-from tfci_core.daemons.generic.pool import TaskProcessPool
-from tfci.dsm.struct import ThreadContext
+from tfci_core.daemons.worker.aio import AsyncTaskPool, AsyncExecutionEngine
+from tfci_core.daemons.worker.wire import THREAD_TASKS
+from tfci_core.daemons.worker.worker import ThreadExecutorInstance, StolenThread
+from tfci_core.const import JOBS_SHARDS, JOBS_BACKLOG, JOBS_SCALE, JOBS_STEALS
+from tfci.db.db_util import watch_range, Lease
+from tfci_core.daemons.generic.pool import TaskProcessPool, PoolScaler, TaskLost
+from tfci.dsm.struct import ThreadContext, ThreadLock, thread_shard
 
 logger = logging.getLogger(__name__)
 
 
+def shards_assign(ident: str, members: Iterable[str], shards=JOBS_SHARDS) -> List[int]:
+    """
+    Rendezvous hashing: a shard belongs to the member with the highest weight for it, so that a change of the
+    membership only moves the shards of the members that joined or left.
+
+    :return: the shards assigned to `ident`
+    """
+
+    def weight(member, shard):
+        return hashlib.md5(f'{member}/{shard}'.encode()).digest()
+
+    members = set(members) | {ident}
+
+    return [x for x in range(shards) if max(members, key=lambda m: weight(m, x)) == ident]
+
+
 class WorkerDaemon(Daemon):
     name = 'worker'
     version = '0.0.1'
     description = 'task queue support'
 
-    def __init__(self, parallel, **kwargs):
+    def __init__(self, parallel, parallel_min, parallel_max, scale_interval, window, preload, async_steps, max_steps,
+                 max_time, deadline, claim, steal_interval, group_commit, group_commit_delay, **kwargs):
         super().__init__(**kwargs)
         self.parallel = parallel
-        self.manager = multiprocessing.Manager()
+        self.parallel_min = parallel if parallel_min is None else parallel_min
+        self.parallel_max = parallel if parallel_max is None else parallel_max
+        self.scale_interval = scale_interval
+        self.window = window
+        self.preload = preload
+        self.async_steps = async_steps
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.deadline = deadline
+        self.claim = claim
+        self.steal_interval = steal_interval
+        self.group_commit = group_commit
+        self.group_commit_delay = group_commit_delay
 
         self.daemons = {}
         self.ctx = {}
         self.lock = {}
+        # the threads that may be assigned to the pool: known, unlocked and not assigned, in the order they became so
+        self.ready = OrderedDict()
         self.watches = []
 
-        self.route_queue = self.manager.Queue()  # type: Queue
+        self.shards = set()
+        self.watches_shards = []
+        # the threads claimed by the daemon to release once they are done, their shards had been reassigned meanwhile
+        self.releasing = set()
+
+        # the backlog of the shards as it had been published last time
+        self.backlog = {}
+        self.backlog_last = 0.
+        self.steal_last = 0.
+        self.steals = {'attempts': 0, 'stolen': 0, 'contended': 0}
+
+        # the watch events, which are put from the threads of the watches; the pipe wakes the main loop up
+        self.route_queue = queue.Queue()  # type: queue.Queue
+        self.route_recv, self.route_send = multiprocessing.Pipe(duplex=False)
+        self.route_signalled = threading.Event()
         self.running = True
-        self.pool = None  # type: Optional[TaskProcessPool]
+        self.pool = None  # type: Optional[Union[TaskProcessPool, AsyncTaskPool]]
+        self.scaler = None  # type: Optional[PoolScaler]
+        # the scaling decision as it had been published last time
+        self.scale_published = None
 
     @classmethod
     def arguments(cls, args: ArgumentParser):
@@ -48,10 +103,120 @@ class WorkerDaemon(Daemon):
             help='How many processes in parallel to use for ?'
         )
 
+        args.add_argument(
+            '--parallel-min',
+            dest='parallel_min',
+            default=None,
+            type=int,
+            help='The least number of processes to shrink the pool to while idle, defaults to --parallel'
+        )
+
+        args.add_argument(
+            '--parallel-max',
+            dest='parallel_max',
+            default=None,
+            type=int,
+            help='The largest number of processes to grow the pool to while backlogged, defaults to --parallel'
+        )
+
+        args.add_argument(
+            '--scale-interval',
+            dest='scale_interval',
+            default=5.,
+            type=float,
+            help='How often (in seconds) to decide on the number of processes of the pool'
+        )
+
+        args.add_argument(
+            '--window',
+            dest='window',
+            default=1,
+            type=int,
+            help='How many threads each of the processes may step concurrently'
+        )
+
+        args.add_argument(
+            '--no-preload',
+            dest='preload',
+            default=True,
+            action='store_false',
+            help='Start every process from scratch instead of forking it from a server with the plugins preloaded'
+        )
+
+        args.add_argument(
+            '--async',
+            dest='async_steps',
+            default=0,
+            type=int,
+            help='Step up to this many threads concurrently on an event loop of the daemon instead of using processes'
+        )
+
+        args.add_argument(
+            '--max-steps',
+            dest='max_steps',
+            default=64,
+            type=int,
+            help='How many local instructions may be executed per single lock of a thread'
+        )
+
+        args.add_argument(
+            '--max-time',
+            dest='max_time',
+            default=0.1,
+            type=float,
+            help='For how long (in seconds) a thread may execute local instructions per single lock'
+        )
+
+        args.add_argument(
+            '--deadline',
+            dest='deadline',
+            default=0.,
+            type=float,
+            help='For how long (in seconds) a step may take before its process is replaced and the thread is unlocked, '
+                 '0 (the default) lets the steps take as long as they do'
+        )
+
+        args.add_argument(
+            '--claim',
+            dest='claim',
+            default=False,
+            action='store_true',
+            help='Keep the threads locked between the steps for as long as the lease of the daemon lives'
+        )
+
+        args.add_argument(
+            '--steal-interval',
+            dest='steal_interval',
+            default=0.5,
+            type=float,
+            help='How often (in seconds) to publish the backlog of the shards and to steal the threads of other shards '
+                 'while idle, 0 disables stealing'
+        )
+
+        args.add_argument(
+            '--group-commit',
+            dest='group_commit',
+            default=0,
+            type=int,
+            help='Commit the steps of up to this many threads sent to a process together, 0 commits each on its own'
+        )
+
+        args.add_argument(
+            '--group-commit-delay',
+            dest='group_commit_delay',
+            default=0.01,
+            type=float,
+            help='For how long (in seconds) the steps may wait for the others to be committed with'
+        )
+
     def startup(self):
         super().startup()
 
     def ctx_put(self, key, val):
+        # the events of the shards that had been reassigned may still be queued
+        if thread_shard(key) not in self.shards:
+            return
+
         the_ctx = ThreadContext.deserialize(key, -1, val)
         self.ctx[key] = the_ctx
 
@@ -62,8 +227,14 @@ class WorkerDaemon(Daemon):
         if key in self.ctx:
             del self.ctx[key]
 
+        self.ready.pop(key, None)
+
     def lock_put(self, key, val):
-        self.lock[key] = val
+        if thread_shard(key) not in self.shards:
+            return
+
+        self.lock[key] = ThreadLock.deserialize(key, -1, val).ident
+        self.ready_update(key)
 
         # if key in self.pool:
         #     self.pool.cancel(key)
@@ -80,73 +251,288 @@ class WorkerDaemon(Daemon):
             if key in self.ctx:
                 self.ctx_lock_change(key)
 
+    def is_locked(self, key):
+        # the threads claimed by this daemon may be stepped by any of its processes
+        lock = self.lock.get(key)
+        return bool(lock) and not (self.claim and lock == self.ident)
+
+    def ready_update(self, key):
+        if key in self.ctx and not self.is_locked(key) and key not in self.pool:
+            # a thread that is already queued keeps its place
+            self.ready.setdefault(key)
+        else:
+            self.ready.pop(key, None)
+
+    def ready_assign(self, key):
+        del self.ready[key]
+        self.pool.assign(key, self.ctx[key])
+
     def ctx_lock_change(self, key):
-        if self.lock.get(key):
+        self.ready_update(key)
+
+        if key in self.ready and self.pool.available:
+            self.ready_assign(key)
+
+    def ctx_pool_fill(self):
+        while self.pool.available > 0 and len(self.ready) and self.lease_wait_max > 0:
+            self.ready_assign(next(iter(self.ready)))
+
+    def runnable(self) -> List[str]:
+        return list(self.ready)
+
+    def backlog_publish(self):
+        now = time.monotonic()
+
+        if not self.steal_interval or now - self.backlog_last < self.steal_interval:
             return
 
-        if not self.pool.available:
+        self.backlog_last = now
+
+        backlog = {x: 0 for x in self.shards}
+
+        for x in self.runnable():
+            backlog[thread_shard(x)] = backlog.get(thread_shard(x), 0) + 1
+
+        for shard, n in backlog.items():
+            # only the changes are written, an idle cluster does not generate any revisions
+            if self.backlog.get(shard) != n:
+                self.db.put(JOBS_BACKLOG % (f'{shard:02x}',), str(n), lease=self.lease)
+
+        self.backlog = backlog
+
+    def steal(self):
+        """
+        While none of the threads of the shards assigned are runnable, lock up to a half of the runnable threads of
+        the most backlogged shard of another worker and step each of them once.
+        """
+        now = time.monotonic()
+
+        if not self.steal_interval or now - self.steal_last < self.steal_interval:
             return
 
-        if key not in self.pool and key in self.ctx:
-            self.pool.assign(key, self.ctx[key])
+        if self.pool.available == 0 or len(self.ready):
+            return
 
-    def ctx_pool_fill(self):
-        ctxs = [x for x in self.ctx.keys() if x not in self.lock]
+        self.steal_last = now
+        self.steals['attempts'] += 1
 
-        while self.pool.available > 0 and len(ctxs) and self.lease_wait_max > 0:
-            item = ctxs.pop()
-            self.ctx_lock_change(item)
+        prefix = JOBS_BACKLOG % ('',)
+
+        backlog = {}
+
+        for v, v_m in self.db.get_prefix(prefix):
+            shard = int(v_m.key.decode()[len(prefix):], 16)
+
+            if shard not in self.shards:
+                backlog[shard] = int(v)
+
+        if not len(backlog):
+            return
+
+        shard, n = max(backlog.items(), key=lambda x: x[1])
+
+        if n == 0:
+            return
+
+        locked = {ThreadLock.key_fn_rev(v_m.key.decode()) for _, v_m in self.db.get_prefix(ThreadLock.prefix(shard))}
+
+        threads = [
+            ThreadContext.deserialize(ThreadContext.key_fn_rev(v_m.key.decode()), v_m.version, v)
+            for v, v_m in self.db.get_prefix(ThreadContext.prefix(shard))
+        ]
+
+        # the rest is left to the worker the shard is assigned to
+        threads = [x for x in threads if x.id not in locked][:min(self.pool.available, max(1, n // 2))]
+
+        stolen = ThreadContext.lock_many(
+            self.db,
+            threads,
+            self.ident,
+            Lease(self.lease.id).to_etcd3(),
+            [0] * len(threads)
+        )
+
+        for x, item, _ in stolen:
+            self.pool.assign(x.id, StolenThread(item))
+
+        self.steals['stolen'] += len(stolen)
+        self.steals['contended'] += len(threads) - len(stolen)
+
+        logger.info(f'Stole {len(stolen)} of {n} threads of the shard {shard}: {self.steals}')
+
+        # the attempts that found nothing to steal are only written along with the next steal, an idle cluster does not
+        # generate any revisions
+        self.db.put(JOBS_STEALS % (self.ident,), json.dumps(self.steals), lease=self.lease)
+
+    def pool_scale(self):
+        if self.scaler is None:
+            return
+
+        self.scaler.sample(self.pool.busy, self.pool.capacity)
+
+        decision = self.scaler.decide(self.pool.parallel, len(self.ready), self.pool.latency)
+
+        if decision is None:
+            return
+
+        if decision.target != decision.processes:
+            processes = self.pool.resize(decision.target)
+
+            logger.info(f'Pool resized to {processes} processes: {decision}')
+
+            self.ctx_pool_fill()
+
+        # as with the backlog, only the changes are written
+        published = (decision.processes, decision.target, decision.reason)
+
+        if self.scale_published == published:
+            return
+
+        self.scale_published = published
+
+        self.db.put(
+            JOBS_SCALE % (self.ident,),
+            json.dumps(dict(decision._asdict(), ups=self.scaler.ups, downs=self.scaler.downs)),
+            lease=self.lease
+        )
+
+    def route_put(self, item):
+        self.route_queue.put(item)
+
+        # a single wake up is pending at a time, no matter how many events are queued
+        if not self.route_signalled.is_set():
+            self.route_signalled.set()
+            self.route_send.send_bytes(b'')
 
     def events_process(self):
-        try:
-            (cb, *args) = self.route_queue.get(timeout=0)
+        """
+        Process all of the watch events queued so far.
+        """
+        while self.route_recv.poll():
+            self.route_recv.recv_bytes()
+
+        # cleared before draining, so that an event queued from now on signals again
+        self.route_signalled.clear()
+
+        while True:
+            try:
+                (cb, *args) = self.route_queue.get_nowait()
+            except queue.Empty:
+                return
+
             getattr(self, cb)(*args)
-        except (multiprocessing.TimeoutError, queue.Empty) as e:
-            return
 
     def get_prefix(self, key, fn):
+        # the values are passed as they are stored, only the codecs tell how they are decoded
         for y, x in self.db.get_prefix(key):
-            fn(x.key.decode()[len(key):], y.decode())
+            fn(x.key.decode()[len(key):], y)
 
     def daemon_put(self, key, value):
         self.daemons[key] = value
 
+        self.shards_rebalance()
+
     def daemon_delete(self, key):
-        print(self.daemons)
-        del self.daemons[key]
+        self.daemons.pop(key, None)
 
-    def watch_restart(self):
-        def create_cb(q, p, d):
-            p = p.__name__
-            d = d.__name__
+        self.shards_rebalance()
+
+    def shards_rebalance(self):
+        shards = set(shards_assign(self.ident, self.daemons.keys()))
+
+        if shards == self.shards:
+            return
+
+        logger.info(f'Shards assigned: {sorted(shards)} of {len(self.daemons)} workers')
+
+        removed = self.shards - shards
+        added = shards - self.shards
+
+        self.shards = shards
+
+        claimed = [k for k, v in self.lock.items() if thread_shard(k) in removed and v == self.ident]
+
+        # the threads in flight are released once they are done, see `task_done`
+        self.releasing.update(k for k in claimed if self.pool is not None and k in self.pool)
+        self.release([k for k in claimed if k not in self.releasing])
+
+        self.ctx = {k: v for k, v in self.ctx.items() if thread_shard(k) not in removed}
+        self.lock = {k: v for k, v in self.lock.items() if thread_shard(k) not in removed}
+        self.ready = OrderedDict((k, v) for k, v in self.ready.items() if thread_shard(k) not in removed)
+
+        # as in `run`, the locks are loaded before the threads so that none of the threads is assigned while locked
+        for x in sorted(added):
+            self.get_prefix(ThreadLock.prefix(x), self.lock_put)
+
+        for x in sorted(added):
+            self.get_prefix(ThreadContext.prefix(x), self.ctx_put)
+
+        if self.watches:
+            self.watch_shards_restart()
+
+    def release(self, thread_ids: List[str]):
+        """
+        Hand back the threads claimed by the daemon, see `ExecutionEngine.release`, for the workers their shards are
+        assigned to to proceed with them.
+        """
+        if not self.claim:
+            return
+
+        for x in thread_ids:
+            # the engine of the async mode keeps track of the threads it had claimed
+            if isinstance(self.pool, AsyncTaskPool):
+                self.pool.engine.release(x)
+            else:
+                ThreadContext(x, None, [], None).unlock(self.db, self.ident)
+
+    def watch_cb(self, p, d):
+        p = p.__name__
+        d = d.__name__
 
-            def cb(prefix, event):
-                ident = event.key.decode()[len(prefix):]
+        def cb(prefix, event):
+            ident = event.key.decode()[len(prefix):]
 
-                print(prefix, event)
+            print(prefix, event)
 
-                if isinstance(event, DeleteEvent):
+            if isinstance(event, DeleteEvent):
 
-                    q.put((d, ident))
-                elif isinstance(event, PutEvent):
-                    q.put((p, ident, event.value.decode()))
-                else:
-                    self.settings.get_logger().error(f'UnknownEvent: {event}')
+                self.route_put((d, ident))
+            elif isinstance(event, PutEvent):
+                self.route_put((p, ident, event.value))
+            else:
+                self.settings.get_logger().error(f'UnknownEvent: {event}')
 
-            return cb
+        return cb
 
+    def watch_restart(self):
         self.watch_stop()
 
-        watch_id1 = watch_range(self.db, JOBS_THREAD % ('',),
-                                create_cb(self.route_queue, self.ctx_put, self.ctx_delete))
-        watch_id2 = watch_range(self.db, JOBS_LOCK % ('',),
-                                create_cb(self.route_queue, self.lock_put, self.lock_delete))
         watch_daemons = watch_range(self.db, f'/daemons/{self.name}/',
-                                    create_cb(self.route_queue, self.daemon_put, self.daemon_delete))
+                                    self.watch_cb(self.daemon_put, self.daemon_delete))
+
+        self.watches = [watch_daemons]
+
+        self.watch_shards_restart()
 
-        self.watches = [watch_id1, watch_id2, watch_daemons]
+    def watch_shards_restart(self):
+        self.watch_shards_stop()
+
+        for x in sorted(self.shards):
+            self.watches_shards.append(
+                watch_range(self.db, ThreadContext.prefix(x), self.watch_cb(self.ctx_put, self.ctx_delete))
+            )
+            self.watches_shards.append(
+                watch_range(self.db, ThreadLock.prefix(x), self.watch_cb(self.lock_put, self.lock_delete))
+            )
+
+    def watch_shards_stop(self):
+        for w in self.watches_shards:
+            self.db.cancel_watch(w)
+        self.watches_shards = []
 
     def watch_stop(self):
+        self.watch_shards_stop()
+
         for w in self.watches:
             self.db.cancel_watch(w)
         self.watches = []
@@ -158,54 +544,107 @@ class WorkerDaemon(Daemon):
     def run(self):
         signal.signal(signal.SIGINT, lambda a, b: self.stop())
 
-        self.pool = TaskProcessPool(
-            # lambda: self.manager.Queue(),
-            self.parallel,
-            ThreadExecutorInstance,
-            (self.ident, self.lease.id, self.settings)
-        )
-
-        self.get_prefix('/daemons/', self.daemon_put)
-        self.get_prefix(JOBS_LOCK % ('',), self.lock_put)
-        self.get_prefix(JOBS_THREAD % ('',), self.ctx_put)
+        if self.async_steps:
+            self.pool = AsyncTaskPool(self.async_steps, self.async_engine)
+        else:
+            self.pool = TaskProcessPool(
+                self.parallel,
+                ThreadExecutorInstance,
+                (self.ident, self.lease.id, self.settings, self.max_steps, self.max_time, self.claim, self.group_commit,
+                 self.group_commit_delay),
+                self.window,
+                sorted({type(x).__module__ for x in self.settings.plugins}) if self.preload else None,
+                self.deadline or None,
+                THREAD_TASKS,
+            )
+
+            logger.info(f'Pool started: {self.pool.stats()}')
+
+            if (self.parallel_min, self.parallel_max) != (self.parallel, self.parallel):
+                self.scaler = PoolScaler(self.parallel_min, self.parallel_max, self.window, self.scale_interval)
+
+        # the threads written before the sharding would never be watched
+        for x in [ThreadLock, ThreadContext]:
+            moved = x.migrate(self.db)
+
+            if moved:
+                logger.info(f'Moved {moved} keys of {x.__name__} to their shards')
+
+        # loads the threads and the locks of the shards assigned
+        self.get_prefix(f'/daemons/{self.name}/', self.daemon_put)
         self.watch_restart()
 
         while self.running:
             polling = True
             while polling and self.running:
                 self.events_process()
-                # todo: we also need to check if every of the subprocesses is still running!
 
                 self.ctx_pool_fill()
+                self.pool_scale()
+                self.backlog_publish()
+                self.steal()
 
-                x = self.pool.poll(min(0.5, self.lease_wait_max))
+                timeout = min(0.5, self.lease_wait_max)
 
-                if self.lease_wait_max < self.lease_threshold:
-                    polling = False
+                if self.steal_interval:
+                    timeout = min(timeout, self.steal_interval)
 
-                if x:
-                    task_id, is_ok, task_result = x
+                # wakes up as soon as either a task is done or a watch event arrives
+                for x in self.pool.poll_many(timeout, [self.route_recv]):
+                    self.task_done(*x)
 
-                    if is_ok:
-                        (ok, thread_obj) = task_result
-
-                        if ok:
-                            if thread_obj is None and task_id in self.ctx:
-                                del self.ctx[task_id]
-                            elif thread_obj is not None:
-                                self.ctx[thread_obj.id] = thread_obj
-                            logger.error(f'Task OK {task_id}')
-                        else:
-                            logger.error(f'Task FAIL {task_id}')
-                    else:
-                        logger.error(f'Exception raised in subtask: {task_result}')
+                if self.lease_wait_max < self.lease_threshold:
+                    polling = False
 
             self.lease_renew()
 
+    def task_done(self, task_id, is_ok, task_result):
+        if is_ok:
+            (ok, thread_obj) = task_result
+
+            if ok:
+                if thread_obj is None and task_id in self.ctx:
+                    del self.ctx[task_id]
+                elif thread_obj is not None and thread_shard(thread_obj.id) in self.shards:
+                    self.ctx[thread_obj.id] = thread_obj
+                    self.ready_update(thread_obj.id)
+                logger.error(f'Task OK {task_id}')
+            else:
+                logger.error(f'Task FAIL {task_id}')
+        else:
+            logger.error(f'Exception raised in subtask: {task_result}')
+
+            # the thread would stay locked for as long as the lease of the daemon lives
+            if isinstance(task_result, TaskLost):
+                ThreadContext(task_id, None, [], None).unlock(self.db, self.ident)
+
+        # the shard of the thread had been reassigned while it was in flight
+        if task_id in self.releasing:
+            self.releasing.discard(task_id)
+            self.release([task_id])
+
+        self.ready_update(task_id)
+
+    def async_engine(self, executor) -> AsyncExecutionEngine:
+        opcodes = self.settings.get_opcodes()
+
+        return AsyncExecutionEngine(
+            self.ident,
+            Lease(self.lease.id),
+            opcodes,
+            self.settings.get_program_pages(self.db, opcodes),
+            self.db,
+            self.max_steps,
+            self.max_time,
+            claim=self.claim,
+            executor=executor,
+        )
+
     def teardown(self):
         self.watch_stop()
         if self.pool:
             self.pool.close()
+        self.release([k for k, v in self.lock.items() if v == self.ident])
         super().teardown()
 
 
@@ -0,0 +1,151 @@
+"""
+The wire format of the tasks of `ThreadExecutorInstance`: the threads to step and the results of their steps.
+
+A frame is a tag byte followed by its fields. The fields are strings separated by NUL, so that a whole frame is encoded
+by a single `join` and decoded by a single `split`. Every item is the identifier of its task and its flags, followed by
+the thread if it has one: its identifier (empty if it is the one of the task), version, instruction pointer (three
+fields for a `ProgramOffset`), the number of its stack frames and their identifiers.
+
+The results that carry an exception are rare, the frames holding any of them are pickled instead.
+"""
+from typing import Any, List, Optional, Tuple
+
+from tfci.dsl.struct import ProgramOffset
+from tfci.dsm.struct import ThreadContext
+from tfci_core.daemons.generic.pool import TaskCodec, PICKLE
+from tfci_core.daemons.worker.worker import StolenThread
+
+TAG_FIELDS = b'F'
+TAG_PICKLE = b'P'
+
+SEP = '\0'
+
+# the item holds a thread
+F_THREAD = 0x01
+# the instruction pointer is an offset rather than an address
+F_IP_INT = 0x02
+# tasks: the thread had been stolen, see `StolenThread`
+F_STOLEN = 0x04
+# results: the step succeeded
+F_OK = 0x08
+# the instruction pointer is a `ProgramOffset`
+F_IP_OFFSET = 0x10
+
+
+def _encode_item(task_id: str, flags: int, thread: Optional[ThreadContext], r: List[str]):
+    if thread is None:
+        r += [task_id, str(flags)]
+        return
+
+    flags |= F_THREAD
+
+    ip = thread.ip
+
+    if isinstance(ip, int):
+        flags |= F_IP_INT
+        ip = [str(ip)]
+    elif isinstance(ip, str):
+        ip = [ip]
+    else:
+        flags |= F_IP_OFFSET
+        program, offset, label = ip
+        ip = [program, str(offset), label or '']
+
+    r += [
+        task_id,
+        str(flags),
+        '' if thread.id == task_id else thread.id,
+        str(thread.version),
+    ]
+    r += ip
+    r.append(str(len(thread.sp)))
+    r += thread.sp
+
+
+def _encode(r: List[str]) -> bytes:
+    bts = SEP.join(r)
+
+    # none of the fields may hold a separator of its own
+    if bts.count(SEP) != len(r) - 1:
+        raise ValueError('Fields must not contain NUL')
+
+    return TAG_FIELDS + bts.encode()
+
+
+def _decode(bts: bytes) -> List[Tuple[str, int, Optional[ThreadContext]]]:
+    if bts[:1] != TAG_FIELDS:
+        raise ValueError(f'Unknown tag: {bts[:1]}')
+
+    fields = bts[1:].decode().split(SEP)
+    n = len(fields)
+    i = 0
+
+    r = []
+
+    while i < n:
+        task_id = fields[i]
+        flags = int(fields[i + 1])
+        i += 2
+
+        if flags & F_THREAD:
+            ident, version, ip = fields[i:i + 3]
+            i += 3
+
+            if flags & F_IP_INT:
+                ip = int(ip)
+            elif flags & F_IP_OFFSET:
+                ip = ProgramOffset(ip, int(fields[i]), fields[i + 1] or None)
+                i += 2
+
+            size = int(fields[i])
+            sp = fields[i + 1:i + 1 + size]
+            i += 1 + size
+
+            thread = ThreadContext(ident or task_id, ip, sp, int(version))
+        else:
+            thread = None
+
+        r.append((task_id, flags, thread))
+
+    return r
+
+
+class ThreadTaskCodec(TaskCodec):
+    def encode_tasks(self, items: List[Tuple[str, Any]]) -> bytes:
+        r = []
+
+        for task_id, task in items:
+            if isinstance(task, StolenThread):
+                _encode_item(task_id, F_STOLEN, task.thread, r)
+            elif isinstance(task, ThreadContext):
+                _encode_item(task_id, 0, task, r)
+            else:
+                raise TypeError(f'Task of type {type(task).__name__} is not serializable')
+
+        return _encode(r)
+
+    def decode_tasks(self, bts: bytes) -> List[Tuple[str, Any]]:
+        return [
+            (task_id, StolenThread(thread) if flags & F_STOLEN else thread)
+            for task_id, flags, thread in _decode(bts)
+        ]
+
+    def encode_results(self, items: List[Tuple[str, bool, Any]]) -> bytes:
+        if not all(ok for _, ok, _ in items):
+            return TAG_PICKLE + PICKLE.encode_results(items)
+
+        r = []
+
+        for task_id, _, (step_ok, thread) in items:
+            _encode_item(task_id, F_OK if step_ok else 0, thread, r)
+
+        return _encode(r)
+
+    def decode_results(self, bts: bytes) -> List[Tuple[str, bool, Any]]:
+        if bts[:1] == TAG_PICKLE:
+            return PICKLE.decode_results(bts[1:])
+
+        return [(task_id, True, (bool(flags & F_OK), thread)) for task_id, flags, thread in _decode(bts)]
+
+
+THREAD_TASKS = ThreadTaskCodec()
@@ -1,19 +1,30 @@
+import json
 import logging
-from typing import Tuple, Optional
+import time
+from typing import Any, Tuple, Optional, List, NamedTuple
 
 from etcd3 import Etcd3Client
 
 from tfci.dsl.exception import CompilerException
 from tfci.dsm.executor import ExecutionError, ExecutionSingleton, ExecutionContext
-from tfci.dsm.struct import FollowUp, ThreadContext
+from tfci.dsm.struct import FollowUp, ThreadContext, StackFrames
 from tfci.dsm.rt import OpcodeDefinition, ProgramPages
+from tfci.opcode import OpcodeDef
 from tfci.db.db_util import Lease
+from tfci_core.const import JOBS_COMMIT, JOBS_OPCODES
 from tfci_core.daemons.generic.pool import WorkerInstance
 from tfci.settings import Settings
 
 logger = logging.getLogger(__name__)
 
 
+class StolenThread(NamedTuple):
+    """
+    A thread of a shard assigned to another worker, that had already been locked by the stealing daemon.
+    """
+    thread: ThreadContext
+
+
 class ExecutionEngine:
     def __init__(
         self,
@@ -22,18 +33,30 @@ class ExecutionEngine:
         opcodes: OpcodeDefinition,
         pages: ProgramPages,
         db: Etcd3Client,
+        max_steps=1,
+        max_time: Optional[float] = None,
+        group_commit: Optional['GroupCommit'] = None,
+        claim=False,
     ):
         self.ident = ident
         self.lease = lease
         self.opcodes = opcodes
         self.pages = pages
         self.db = db
+        # how many instructions a single lock of a thread may execute and for how long
+        self.max_steps = max_steps
+        self.max_time = max_time
+        # commits the follow-ups of `step_many` together
+        self.group_commit = group_commit
+        # keep the locks of the threads between the steps, for as long as the lease lives or until they are released
+        self.claim = claim
+        self.claimed = set()
 
         self.singleton = ExecutionSingleton(self.db)
 
     def gen_trace(self, pdi, stack, thread):
-        print('TRACE', self.ident, thread.id, thread.ip, pdi.opcode, pdi.args, pdi.next_label)
-        for s in stack:
+        print('TRACE', self.ident, thread.id, thread.ip, self.pages.program.opcodes[pdi.opcode], pdi.args, pdi.next_ip)
+        for s in stack.loaded:
             print('\t', s)
         print('ENDTRACE')
 
@@ -52,97 +75,465 @@ class ExecutionEngine:
         if stack:
             logger.error('STACK')
 
-            for s in stack:
+            for s in stack.loaded:
                 logger.error(f'\t{s}')
 
             logger.error('STACK_NOT')
 
-    def step(self, thread_orig: ThreadContext):
-        ok, thread, stack = thread_orig.lock(
+    def proceed(self, f: FollowUp, thread: ThreadContext, stack: StackFrames) -> FollowUp:
+        """
+        Executes the local instructions following the one that returned `f` while the thread is still locked.
+
+        :return: the combined follow-up of all of the instructions executed
+        """
+
+        deadline = None if self.max_time is None else time.monotonic() + self.max_time
+
+        updated = {}
+
+        for _ in range(self.max_steps - 1):
+            if len(f.create_threads) != 1 or len(f.create_stacks) or len(f.delete_stacks):
+                break
+
+            nthread = f.create_threads[0]
+
+            if nthread.id != thread.id or nthread.sp != thread.sp or nthread.ip not in self.pages:
+                break
+
+            if deadline is not None and time.monotonic() > deadline:
+                break
+
+            pdi = self.pages[nthread.ip]
+            opcode = self.pages.opcode(pdi)
+
+            if not opcode.is_local:
+                break
+
+            for x in f.update_stacks:
+                updated[x.id] = x
+
+            vals = [(x, x.vals.snapshot()) for x in stack.loaded if x is not None]
+
+            try:
+                f = opcode(
+                    ExecutionContext.new(
+                        self.singleton,
+                        pdi.args,
+                        pdi.next_ip,
+                        nthread,
+                        stack,
+                        self.pages.prepared(nthread.ip),
+                        self.pages.bound(nthread.ip),
+                    )
+                )
+            except:
+                # commit everything up to this instruction, the next step is going to execute (and fail) it on its own
+                for x, x_vals in vals:
+                    x.vals.restore(x_vals)
+
+                f = FollowUp.new([nthread])
+
+                break
+
+            thread = nthread
+
+        for x in f.update_stacks:
+            updated[x.id] = x
+
+        deleted = [x.id for x in f.delete_stacks]
+
+        return FollowUp(
+            f.create_threads,
+            [x for k, x in updated.items() if k not in deleted],
+            f.create_stacks,
+            f.delete_stacks,
+        )
+
+    def levels(self, thread: ThreadContext) -> Optional[int]:
+        return self.pages.levels(thread.ip) if thread.ip in self.pages else None
+
+    def acquire(self, thread_orig: ThreadContext, stolen=False) -> Tuple[bool, Optional[ThreadContext], StackFrames]:
+        levels = self.levels(thread_orig)
+
+        def lock():
+            return thread_orig.lock(self.db, self.ident, self.lease.to_etcd3(), levels)
+
+        def reload():
+            return thread_orig.reload(self.db, self.ident, levels)
+
+        if stolen:
+            return reload()
+
+        if not self.claim:
+            return lock()
+
+        # the thread may also have been claimed by another process of the same daemon
+        for fn in ([reload, lock] if thread_orig.id in self.claimed else [lock, reload]):
+            ok, thread, stack = fn()
+
+            if ok:
+                break
+
+        return ok, thread, stack
+
+    def release(self, thread_id: str) -> bool:
+        """
+        Hand back the ownership of a claimed thread.
+        """
+        self.claimed.discard(thread_id)
+
+        return ThreadContext(thread_id, None, [], None).unlock(self.db, self.ident)
+
+    def release_all(self):
+        for x in list(self.claimed):
+            self.release(x)
+
+    def claimed_update(self, thread_id: str, ok: bool, updated: Optional[ThreadContext]):
+        if not self.claim:
+            return
+
+        if ok and updated is not None:
+            self.claimed.add(thread_id)
+        else:
+            self.claimed.discard(thread_id)
+
+    def step(self, thread_orig: ThreadContext, stolen=False):
+        """
+        :param stolen: the thread had already been locked by the ident of the engine, see `WorkerDaemon.steal`, the
+                       lock is always released so that the owner of the shard may proceed with the thread
+        """
+        ok, thread, stack = self.acquire(thread_orig, stolen)
+
+        return self.step_locked(thread_orig, ok, thread, stack, release=True if stolen else None)
+
+    def step_many(self, threads: List[ThreadContext]) -> List[Tuple[ThreadContext, bool, Optional[ThreadContext]]]:
+        """
+        Lock as many of the threads as possible in a few transactions and step each of the ones that had been locked.
+
+        :return: the threads that had been locked, along with the results of their steps
+        """
+        reloaded = []
+
+        if self.claim:
+            for x in [x for x in threads if x.id in self.claimed]:
+                ok, thread, stack = x.reload(self.db, self.ident, self.levels(x))
+
+                if ok:
+                    reloaded.append((x, thread, stack))
+                else:
+                    self.claimed.discard(x.id)
+
+            ids = {x.id for x, _, _ in reloaded}
+            threads = [x for x in threads if x.id not in ids]
+
+        locked = reloaded + ThreadContext.lock_many(
             self.db,
+            threads,
             self.ident,
-            self.lease.to_etcd3()
+            self.lease.to_etcd3(),
+            [self.levels(x) for x in threads]
         )
 
-        tid = thread.id if thread else thread_orig.id
-        tip = thread.ip if thread else None
-        tsp = thread.sp if thread else None
+        if self.group_commit is None:
+            return [(x, *self.step_locked(x, True, thread, stack)) for x, thread, stack in locked]
+
+        for x, thread, stack in locked:
+            self.group_commit.submit(x, *self.execute(x, True, thread, stack))
+
+        r = [(x, *y) for (x, _, _), y in zip(locked, self.group_commit.flush())]
+
+        for x, ok, updated in r:
+            self.claimed_update(x.id, ok, updated)
+
+        return r
+
+    def step_locked(self, thread_orig: ThreadContext, ok: bool, thread: Optional[ThreadContext], stack: StackFrames,
+                    release: Optional[bool] = None):
+        ok, f = self.execute(thread_orig, ok, thread, stack)
+
+        return self.commit(thread_orig, ok, f, release)
+
+    def commit(self, thread_orig: ThreadContext, ok: bool, f: Optional[FollowUp], release: Optional[bool] = None):
+        if f is None:
+            self.claimed_update(thread_orig.id, False, None)
+            return False, None
 
-        # print('A', thread, tip)
-        pdi = self.pages[tip] if (tip and tip in self.pages) else None
+        release = not self.claim if release is None else release
 
+        ok_follow, updated = thread_orig.follow(self.db, self.ident, f, release=release)
+
+        self.claimed_update(thread_orig.id, ok and ok_follow and not release, updated)
+
+        return (ok_follow, updated) if ok else (False, None)
+
+    def execute(self, thread_orig: ThreadContext, ok: bool, thread: Optional[ThreadContext],
+                stack: StackFrames) -> Tuple[bool, Optional[FollowUp]]:
+        """
+        :return: whether the instructions had been executed and the follow-up to commit, if any
+        """
         try:
-            if not ok:
-                logger.error(f'Thread `{thread_orig.id}` lock failed')
-                return False, None
+            x = self.execute_context(thread_orig, ok, thread, stack)
 
-            if not thread:
-                logger.error(f'Thread `{thread_orig.id}` could not be found')
+            if x is None:
                 return False, None
 
-            if thread.ip not in self.pages:
-                raise ExecutionError(f'Thread `{thread.id}` IP=`{thread.ip}` could not be found')
+            opcode, ctx = x
 
-            # self.gen_trace(pdi, stack, thread)
+            f = opcode(ctx)  # type: FollowUp
+        except BaseException as e:
+            return self.execute_failed(e, thread_orig, thread, stack)
+        else:
+            if self.max_steps > 1:
+                f = self.proceed(f, thread, stack)
 
-            # that's where we essentially execute anything.
+        return True, f
 
-            opcode = self.opcodes[pdi.opcode]
+    def execute_context(self, thread_orig: ThreadContext, ok: bool, thread: Optional[ThreadContext],
+                        stack: StackFrames) -> Optional[Tuple[OpcodeDef, ExecutionContext]]:
+        """
+        :return: the opcode of the instruction the thread is at and its context, unless the thread could not be locked
+        """
+        if not ok:
+            logger.error(f'Thread `{thread_orig.id}` lock failed')
+            return None
 
-            # we may check here is opcode supports idempotency (?) it must
+        if not thread:
+            logger.error(f'Thread `{thread_orig.id}` could not be found')
+            return None
 
-            f = opcode(
-                ExecutionContext.new(
-                    self.singleton,
-                    pdi.args,
-                    pdi.next_label,
-                    thread,
-                    stack,
-                )
-            )  # type: FollowUp
-        except ExecutionError as e:
-            thread_orig.follow(
-                self.db, self.ident,
-                FollowUp.new()
-            )
+        if thread.ip not in self.pages:
+            raise ExecutionError(f'Thread `{thread.id}` IP=`{thread.ip}` could not be found')
 
+        # self.gen_trace(pdi, stack, thread)
+
+        # that's where we essentially execute anything.
+
+        pdi = self.pages[thread.ip]
+        opcode = self.pages.opcode(pdi)
+
+        # we may check here is opcode supports idempotency (?) it must
+
+        return opcode, ExecutionContext.new(
+            self.singleton,
+            pdi.args,
+            pdi.next_ip,
+            thread,
+            stack,
+            self.pages.prepared(thread.ip),
+            self.pages.bound(thread.ip),
+        )
+
+    def execute_failed(self, e: BaseException, thread_orig: ThreadContext, thread: Optional[ThreadContext],
+                       stack: StackFrames) -> Tuple[bool, Optional[FollowUp]]:
+        """
+        Must be called while handling `e`.
+        """
+        tid = thread.id if thread else thread_orig.id
+        tip = thread.ip if thread else None
+        tsp = thread.sp if thread else None
+
+        pdi = self.pages[tip] if (tip is not None and tip in self.pages) else None
+
+        if isinstance(e, ExecutionError):
             self.gen_exc(pdi, stack, tid, tip, thread_orig, tsp)
-            return False, None
-        except:
-            # everything that is not an execution error should be just retried
-            thread_orig.unlock(self.db, self.ident)
-            self.gen_exc(pdi, stack, tid, tip, thread_orig, tsp)
-            return False, None
+
+            # the thread is removed
+            return False, FollowUp.new()
+
+        # everything that is not an execution error should be just retried
+        thread_orig.unlock(self.db, self.ident)
+        self.gen_exc(pdi, stack, tid, tip, thread_orig, tsp)
+        return False, None
+
+
+class GroupCommit:
+    """
+    Commits the follow-ups of independent threads together, see `ThreadContext.follow_many`.
+
+    The follow-ups are committed once `max_size` of them are pending or the first of them had been pending for
+    `max_delay` seconds.
+
+    :param release: see `ThreadContext.follow`, must be `False` for an engine that claims its threads
+    """
+
+    def __init__(self, db: Etcd3Client, ident: str, max_size=64, max_delay=0.01, release=True):
+        self.db = db
+        self.ident = ident
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.release = release
+
+        self.pending = []  # type: List[Tuple[ThreadContext, bool, Optional[FollowUp], float]]
+        self.done = []  # type: List[Tuple[bool, Optional[ThreadContext]]]
+
+        self.batches = 0
+        self.submitted = 0
+        self.items = 0
+        self.transactions = 0
+        self.failed = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+
+    def submit(self, thread_orig: ThreadContext, ok: bool, f: Optional[FollowUp]):
+        """
+        :param ok: `f` is committed either way, but the result of a thread that had not been executed is a failure
+        """
+        self.pending.append((thread_orig, ok, f, time.monotonic()))
+
+        if len(self.pending) >= self.max_size or time.monotonic() - self.pending[0][3] >= self.max_delay:
+            self.commit()
+
+    def commit(self):
+        items = [(x, f) for x, _, f, _ in self.pending if f is not None]
+
+        if len(items):
+            rs, txs = ThreadContext.follow_many(self.db, self.ident, items, release=self.release)
+
+            self.batches += 1
+            self.items += len(items)
+            self.transactions += txs
+            self.failed += sum(1 for ok, _ in rs if not ok)
         else:
-            ok, updated = thread_orig.follow(
-                self.db, self.ident,
-                f
-            )
+            rs = []
+
+        rs = iter(rs)
+        now = time.monotonic()
+
+        for x, ok, f, t in self.pending:
+            r = (False, None) if f is None else next(rs)
+            self.done.append(r if ok else (False, None))
+
+            self.submitted += 1
+            self.latency_sum += now - t
+            self.latency_max = max(self.latency_max, now - t)
+
+        self.pending = []
+
+    def flush(self) -> List[Tuple[bool, Optional[ThreadContext]]]:
+        """
+        :return: the results of all of the follow-ups submitted since the last flush, in order
+        """
+        self.commit()
+
+        r, self.done = self.done, []
 
-        return ok, updated
+        return r
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'transactions': self.transactions,
+            'failed': self.failed,
+            'batch_size_avg': self.items / self.batches if self.batches else 0.,
+            'latency_avg': self.latency_sum / self.submitted if self.submitted else 0.,
+            'latency_max': self.latency_max,
+        }
 
 
 class ThreadExecutorInstance(WorkerInstance):
-    def __init__(self, proc_ident, ident, lease_id, settings: Settings):
+    batched = True
+    # how often (in seconds) the statistics of the group commits and the opcodes are published at most
+    stats_interval = 5.
+
+    def __init__(self, proc_ident, ident, lease_id, settings: Settings, max_steps=1, max_time=None, claim=False,
+                 group_commit=0, group_commit_delay=0.01):
+        """
+        :param group_commit: commit the steps of up to this many threads of a frame together, see `GroupCommit`, 0
+                             commits each of them on its own
+        """
         super().__init__()
         self.proc_ident = proc_ident
         self.ident = ident
+        self.lease_id = lease_id
         self.settings = settings
 
         db = self.settings.get_db()
         opcodes = self.settings.get_opcodes()
 
+        self.group_commit = GroupCommit(
+            db,
+            self.ident,
+            group_commit,
+            group_commit_delay,
+            release=not claim
+        ) if group_commit else None
+
+        # the statistics as they had been published last time, by key
+        self.stats_last = None
+        self.stats_published = {}
+
         self.engine = ExecutionEngine(
             self.ident,
             Lease(lease_id),
             opcodes,
-            ProgramPages(db, opcodes),
-            db
+            self.settings.get_program_pages(db, opcodes),
+            db,
+            max_steps,
+            max_time,
+            group_commit=self.group_commit,
+            claim=claim,
         )
 
     def startup(self):
         self.settings.setup_logging()
+        self.settings.setup_codec()
         logger.info(f'TaskExecutor {self.ident} {self.proc_ident} startup')
 
     def __call__(self, thread_id, thread_orig: ThreadContext) -> Tuple[bool, Optional[ThreadContext]]:
+        if isinstance(thread_orig, StolenThread):
+            return self.engine.step(thread_orig.thread, stolen=True)
+
         return self.engine.step(thread_orig)
+
+    def call_many(self, items: List[Tuple[str, ThreadContext]]) -> List[Tuple[str, bool, Any]]:
+        """
+        The threads of a frame are locked together, see `ExecutionEngine.step_many`. The ones that could not be locked
+        fail their steps the way `ExecutionEngine.step` does.
+        """
+        stolen = [(task_id, x) for task_id, x in items if isinstance(x, StolenThread)]
+        threads = [(task_id, x) for task_id, x in items if not isinstance(x, StolenThread)]
+
+        stepped = {x.id: (ok, updated) for x, ok, updated in self.engine.step_many([x for _, x in threads])}
+
+        self.stats_publish()
+
+        return super().call_many(stolen) + [
+            (task_id, True, stepped.get(x.id, (False, None))) for task_id, x in threads
+        ]
+
+    def stats(self):
+        """
+        :return: the statistics of the process by the key they are published under
+        """
+        key = f'{self.ident}/{self.proc_ident}'
+
+        r = {}
+
+        if self.group_commit is not None:
+            r[JOBS_COMMIT % (key,)] = self.group_commit.stats()
+
+        opcodes = {name: op.stats() for name, op in self.engine.opcodes.items()}
+        opcodes = {name: x for name, x in opcodes.items() if x is not None}
+
+        if opcodes:
+            r[JOBS_OPCODES % (key,)] = opcodes
+
+        return r
+
+    def stats_publish(self, now=None):
+        now = time.monotonic() if now is None else now
+
+        if self.stats_last is not None and now - self.stats_last < self.stats_interval:
+            return
+
+        self.stats_last = now
+
+        for key, stats in self.stats().items():
+            # as with the scaling decisions of the pool, only the changes are written
+            if self.stats_published.get(key) == stats:
+                continue
+
+            self.stats_published[key] = stats
+
+            self.engine.db.put(key, json.dumps(stats), lease=self.lease_id)
@@ -2,6 +2,7 @@ from uuid import uuid4
 
 from tfci.dsl.ast import Identifier, Constant, Map, Command
 from tfci.dsl.exception import CompilerException
+from tfci.dsl.struct import program_address
 from tfci.dsm.executor import ExecutionError, ExecutionContext
 from tfci.opcode import opcode, SysOpcodeDef
 from tfci.dsm.struct import StackFrame, FollowUp, ThreadContext
@@ -9,6 +10,7 @@ from tfci.dsm.struct import StackFrame, FollowUp, ThreadContext
 
 class NopOpcode(SysOpcodeDef):
     name = 'nop'
+    is_local = True
 
     def fn(self, ctx: ExecutionContext) -> FollowUp:
         if ctx.nip:
@@ -43,11 +45,13 @@ def push_pop(csf: StackFrame, ctx: ExecutionContext, args=None):
 
 class PushOpcode(SysOpcodeDef):
     name = 'push'
+    is_local = True
 
     def fn(self, ctx: ExecutionContext) -> FollowUp:
         # how do we know which stacks have been changed ?
 
-        csf = StackFrame.new(uuid4().hex)
+        # a new frame is stored the same way as the one it is pushed onto
+        csf = StackFrame.new(uuid4().hex, delta=len(ctx.stack) > 0 and ctx.stack[0] is not None and ctx.stack[0].delta)
 
         push_pop(csf, ctx)
 
@@ -71,6 +75,8 @@ class PullOpcode(SysOpcodeDef):
 
 class PopOpcode(SysOpcodeDef):
     name = 'pop'
+    is_local = True
+    levels = 2
 
     def fn(self, ctx: ExecutionContext) -> FollowUp:
         # so a stack frame needs to load the parent stack frame
@@ -93,6 +99,8 @@ class PopOpcode(SysOpcodeDef):
 
 class ClrOpcode(SysOpcodeDef):
     name = 'clr'
+    is_local = True
+    levels = 2
 
     def fn(self, ctx: ExecutionContext) -> FollowUp:
         # if we had access to the meta-info, then we could easily remove it ourselves
@@ -116,6 +124,7 @@ class ClrOpcode(SysOpcodeDef):
 
 class JOpcode(SysOpcodeDef):
     name = 'j'
+    is_local = True
 
     def check(self, c: Command):
         if len(c.args) != 1:
@@ -132,6 +141,7 @@ class JOpcode(SysOpcodeDef):
 
 class JEOpcode(SysOpcodeDef):
     name = 'je'
+    is_local = True
 
     def check(self, c: Command):
         if len(c.args) != 3:
@@ -141,7 +151,7 @@ class JEOpcode(SysOpcodeDef):
         a, b, jmp_if_true = ctx.resolve_arg(0), ctx.resolve_arg(1), ctx.resolve_arg(2)
 
         nip = ctx.nip
-        if a == b:
+        if program_address(a) == program_address(b):
             nip = jmp_if_true
 
         return FollowUp.new([ctx.thread.update(ip=nip)])
@@ -149,6 +159,7 @@ class JEOpcode(SysOpcodeDef):
 
 class JNEOpcode(SysOpcodeDef):
     name = 'jne'
+    is_local = True
 
     def check(self, c: Command):
         if len(c.args) != 3:
@@ -158,7 +169,7 @@ class JNEOpcode(SysOpcodeDef):
         a, b, jmp_if_true = ctx.resolve_arg(0), ctx.resolve_arg(1), ctx.resolve_arg(2)
 
         nip = ctx.nip
-        if a != b:
+        if program_address(a) != program_address(b):
             nip = jmp_if_true
 
         return FollowUp.new([ctx.thread.update(ip=nip)])
@@ -166,6 +177,8 @@ class JNEOpcode(SysOpcodeDef):
 
 class LdOpcode(SysOpcodeDef):
     name = 'ld'
+    is_local = True
+    levels = 1
 
     def fn(self, ctx: ExecutionContext) -> FollowUp:
         if len(ctx.stack) == 0:
@@ -178,6 +191,7 @@ class LdOpcode(SysOpcodeDef):
 
 class HLTOpcode(SysOpcodeDef):
     name = 'hlt'
+    is_local = True
 
     def check(self, c: Command):
         if len(c.args) != 0:
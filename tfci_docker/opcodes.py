@@ -23,22 +23,22 @@ class PullOpcode(OpcodeDef):
     name = 'dckr_pull'
 
     def fn(self, ctx: ExecutionContext, serv_id: OpArg[str], image: OpArg[str], tag: OpArg[str]):
-        server = load_server(ctx, serv_id.get())
+        server = load_server(ctx, serv_id.get(ctx))
 
         with server.client() as c:
-            c.images.pull(image.get(), tag=tag.get())
+            c.images.pull(image.get(ctx), tag=tag.get(ctx))
 
 
 class StartOpcode(OpcodeDef):
     name = 'dckr_start'
 
     def fn(self, ctx: ExecutionContext, serv_id: OpArg[str], name: OpArg[str], image: OpArg[str], *args: OpArg[str]):
-        server = load_server(ctx, serv_id.get())
+        server = load_server(ctx, serv_id.get(ctx))
 
         with server.client() as c:
             c.containers.run(
-                image=image.get(),
-                name=name.get(),
+                image=image.get(ctx),
+                name=name.get(ctx),
                 detach=True
             )
 
@@ -1,4 +1,3 @@
-import json
 import os
 import tempfile
 from enum import Enum
@@ -50,11 +49,11 @@ class ServerDef(NamedTupleEx, MapperBase):
         return AUTH_MAP_REV[self.auth.__class__]
 
     def serialize(self):
-        return json.dumps([[self.auth_type.value, self.auth._asdict()], self.host, self.port])
+        return self.encode([[self.auth_type.value, self.auth._asdict()], self.host, self.port])
 
     @classmethod
     def deserialize(cls, id, version, bts):
-        (auth_type, auth_val), *other = json.loads(bts)
+        (auth_type, auth_val), *other = cls.decode(bts)
 
         auth_cls = AUTH_MAP[Auth(auth_type)]
 
@@ -9,9 +9,9 @@ class ReplyOpcode(OpcodeDef):
     def fn(self, ctx: ExecutionContext, req_id: OpArg[str], **kwargs: OpArg[str]):
         db = ctx.singleton.db
 
-        body = {k: v.get() for k, v in kwargs.items()}
+        body = {k: v.get(ctx) for k, v in kwargs.items()}
 
-        rep = Reply.new(req_id.get(), body)
+        rep = Reply.new(req_id.get(ctx), body)
 
         cmp, upd = rep.create(db)
 
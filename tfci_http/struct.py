@@ -1,4 +1,3 @@
-import json
 import logging
 from typing import Dict, Any, List, Optional
 from uuid import uuid4
@@ -28,11 +27,11 @@ class RouteDef(NamedTupleEx, MapperBase):
         return '/http/subs/%s' % (id,)
 
     def serialize(self):
-        return json.dumps([self.methods, self.route, self.frz_id])
+        return self.encode([self.methods, self.route, self.frz_id])
 
     @classmethod
     def deserialize(cls, id, version, bts):
-        return RouteDef(id, *json.loads(bts), version)
+        return RouteDef(id, *cls.decode(bts), version)
 
 
 class Request(NamedTupleEx, MapperBase):
@@ -100,8 +99,8 @@ class Reply(NamedTupleEx, MapperBase):
         return '/http/replies/%s' % (id,)
 
     def serialize(self):
-        return json.dumps([self.result])
+        return self.encode([self.result])
 
     @classmethod
     def deserialize(cls, key, version, bts):
-        return Reply(key, *json.loads(bts), version)
+        return Reply(key, *cls.decode(bts), version)
@@ -38,7 +38,15 @@ class StackManager(EntityManager):
             help="Add a result value of a python expression on the stack",
         )
 
-    def action_add(self, id, stack_const, stack_exec, **kwargs):
+        args.add_argument(
+            '--delta',
+            dest='stack_delta',
+            action='store_true',
+            default=False,
+            help="Store every variable under a key of its own, so that updates only write the changed variables",
+        )
+
+    def action_add(self, id, stack_const, stack_exec, stack_delta=False, **kwargs):
         if id is None:
             id = uuid4().hex
             print(f'Generated ID {id}')
@@ -63,7 +71,7 @@ class StackManager(EntityManager):
                 print(f'While evaluating {k}={v}')
                 raise
 
-        a, b = StackFrame.new(id, stack).create(self.db)
+        a, b = StackFrame.new(id, stack, stack_delta).create(self.db)
 
         return [a], [b]
 
@@ -1,8 +1,13 @@
+import asyncio
 import logging
+import threading
 import uuid
-from typing import List, Any
+from collections import OrderedDict
+from types import CodeType
+from typing import List, Any, Optional
 
-from tfci.dsl.ast import Command
+from tfci.dsl.ast import Command, Constant, ConstantType
+from tfci.dsl.struct import OpcodeArgs
 from tfci.dsl.exception import CompilerException
 from tfci.opcode import OpcodeDef, OpArg, RefOpArg, SysOpcodeDef
 from tfci.dsm.executor import ExecutionError, ExecutionContext
@@ -17,16 +22,86 @@ class WrappedArgs:
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return [x.get() for x in self.args.__getitem__(key)]
+            return [x.get(self.ctx) for x in self.args.__getitem__(key)]
         else:
-            return self.args[key].get()
+            return self.args[key].get(self.ctx)
+
+
+class CodeCache:
+    """
+    A bounded LRU of the compiled `exr` expressions, shared by the threads of the executor of a process.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        # expressions compiled along with the program
+        self.prepared = 0
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, code: str) -> CodeType:
+        with self.lock:
+            try:
+                r = self.items[code]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(code)
+                return r
+
+        r = compile(code, '<string>', mode='eval')
+
+        with self.lock:
+            self.items[code] = r
+
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+        return r
+
+    def use_prepared(self, code: CodeType) -> CodeType:
+        with self.lock:
+            self.prepared += 1
+
+        return code
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'prepared': self.prepared,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
 
 
 class ExecOpcode(OpcodeDef):
     name = 'exr'
+    is_local = True
+
+    cache = CodeCache()
+
+    def prepare(self, args: OpcodeArgs) -> Optional[CodeType]:
+        if len(args) and isinstance(args[0], Constant) and args[0].type == ConstantType.String:
+            try:
+                return compile(args[0].value, '<string>', mode='eval')
+            except SyntaxError:
+                # will fail at runtime the same way it always did
+                return None
+        else:
+            return None
+
+    def stats(self):
+        return self.cache.stats()
 
     def fn(self, ctx: ExecutionContext, code: OpArg[str], ret: RefOpArg[Any], *args: OpArg[Any]):
-        item = compile(code.get(), '<string>', mode='eval')
+        if ctx.prepared is None:
+            item = self.cache.compile(code.get(ctx))
+        else:
+            item = self.cache.use_prepared(ctx.prepared)
 
         try:
             res = eval(
@@ -38,7 +113,7 @@ class ExecOpcode(OpcodeDef):
         except Exception as e:
             raise ExecutionError("Failed to exr") from e
 
-        ret.set(res)
+        ret.set(res, ctx)
 
 
 class LoggerOpcode(OpcodeDef):
@@ -48,8 +123,8 @@ class LoggerOpcode(OpcodeDef):
         logger = logging.getLogger('OPCODE')
 
         try:
-            level_str = level.get().upper()
-            format_str = format.get()
+            level_str = level.get(ctx).upper()
+            format_str = format.get(ctx)
             level_int = logging._nameToLevel[level_str]
         except KeyError:
             raise ExecutionError(f'Incorrect level: {level_str}')
@@ -57,17 +132,30 @@ class LoggerOpcode(OpcodeDef):
             logger.log(
                 level_int,
                 format_str.format(
-                    *[x.get() for x in args],
-                    **{k: v.get() for k, v in kwargs.items()}
+                    *[x.get(ctx) for x in args],
+                    **{k: v.get(ctx) for k, v in kwargs.items()}
                 )
             )
 
 
+class SleepOpcode(OpcodeDef):
+    name = 'sleep'
+
+    async def fn(self, ctx: ExecutionContext, seconds: OpArg[float]):
+        try:
+            seconds = float(seconds.get(ctx))
+        except (TypeError, ValueError) as e:
+            raise ExecutionError(f'Incorrect number of seconds: {seconds.get(ctx)!r}') from e
+
+        await asyncio.sleep(seconds)
+
+
 class UUID4Opcode(OpcodeDef):
     name = 'uuid4'
+    is_local = True
 
     def fn(self, ctx: ExecutionContext, dest: RefOpArg[str]):
-        dest.set(uuid.uuid4().hex)
+        dest.set(uuid.uuid4().hex, ctx)
 
 
 class FreezeOpcode(OpcodeDef):
@@ -81,8 +169,8 @@ class FreezeOpcode(OpcodeDef):
             )
 
     def fn(self, ctx: ExecutionContext, dest: OpArg[str], cb: OpArg[str]):
-        copy_thread = ctx.thread.copy().update(ip=cb.get())
-        frz = FrozenThreadContext(dest.get(), copy_thread, -1)
+        copy_thread = ctx.thread.copy().update(ip=cb.get(ctx))
+        frz = FrozenThreadContext(dest.get(ctx), copy_thread, -1)
 
         db = ctx.singleton.db
 
@@ -136,7 +224,7 @@ class LockCreateOpcode(OpcodeDef):
     name = 'lock_create'
 
     def fn(self, ctx: ExecutionContext, lock_id: OpArg[str]):
-        ctx.singleton.db.put(f'/locks/{lock_id.get()}', '')
+        ctx.singleton.db.put(f'/locks/{lock_id.get(ctx)}', '')
 
 
 class LockTryLockOpcode(OpcodeDef):
@@ -145,9 +233,9 @@ class LockTryLockOpcode(OpcodeDef):
     def fn(self, ctx: ExecutionContext, lock_id: OpArg[str], locking_id: OpArg[str], is_locked: RefOpArg[bool]):
         db = ctx.singleton.db
 
-        locking_id = locking_id.get()
+        locking_id = locking_id.get(ctx)
 
-        kn = f'/locks/{lock_id.get()}'
+        kn = f'/locks/{lock_id.get(ctx)}'
 
         ok, resp = db.transaction(
             compare=[
@@ -162,9 +250,9 @@ class LockTryLockOpcode(OpcodeDef):
         )
 
         if ok:
-            is_locked.set(True)
+            is_locked.set(True, ctx)
         elif not len(resp):
-            is_locked.set(False)
+            is_locked.set(False, ctx)
         else:
             # not locked now, but we have locked before with the same id
             (it, it_meta), *_ = resp
@@ -173,11 +261,11 @@ class LockTryLockOpcode(OpcodeDef):
 
             print(r, it, locking_id)
 
-            is_locked.set(r)
+            is_locked.set(r, ctx)
 
 
 class LockFree(OpcodeDef):
     name = 'lock_free'
 
     def fn(self, ctx: ExecutionContext, lock_id: OpArg[str]):
-        ctx.singleton.db.delete(f'/locks/{lock_id.get()}')
+        ctx.singleton.db.delete(f'/locks/{lock_id.get(ctx)}')
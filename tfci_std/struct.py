@@ -1,9 +1,9 @@
-import json
 from typing import List
 
 from etcd3 import Etcd3Client
 
 from tfci.db.mapper import MapperBase, NamedTupleEx
+from tfci.dsl.struct import program_address
 from tfci.dsm.struct import StackFrame, ThreadContext
 
 
@@ -25,12 +25,12 @@ class FrozenThreadContext(NamedTupleEx, MapperBase):
         return db.transactions.get(cls.key_fn(id))
 
     def serialize(self):
-        return json.dumps([self.ctx.id, self.ctx.ip, self.ctx.sp])
+        return self.encode([self.ctx.id, self.ctx.ip, self.ctx.sp])
 
     @classmethod
     def deserialize(cls, key, version, bts):
-        id, *its = json.loads(bts)
-        return FrozenThreadContext(id, ThreadContext(id, *its, version), version)
+        id, ip, sp = cls.decode(bts)
+        return FrozenThreadContext(id, ThreadContext(id, program_address(ip), sp, version), version)
 
     def unfreeze(self, db: Etcd3Client):
         ok, _ = db.transaction(